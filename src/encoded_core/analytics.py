@@ -0,0 +1,129 @@
+import atexit
+import json
+import requests
+import structlog
+import time
+from .background import BackgroundQueue
+
+
+log = structlog.getLogger(__name__)
+
+
+GA4_COLLECT_URL = 'https://www.google-analytics.com/mp/collect?measurement_id={m_tid}&api_secret={api_secret}'
+# Measurement Protocol accepts at most 25 events per request
+GA4_MAX_EVENTS_PER_REQUEST = 25
+
+
+class GA4EventDispatcher(BackgroundQueue):
+    """ Sends GA4 Measurement Protocol events from a background thread, so that requests
+        (e.g. @@download) never wait on Google.
+
+        Events are queued with submit() and sent by a single worker thread over one
+        keep-alive session, merged into requests of up to 25 events per client/user.
+        * The queue is bounded (see BackgroundQueue): when it is full, new events are dropped.
+        * After failure_threshold consecutive failed requests the circuit opens and events
+          are dropped without being sent for reset_timeout seconds; the next request after
+          that decides whether it closes again.
+        * Queued events are flushed when the process exits.
+    """
+
+    worker_name = 'ga4-event-dispatcher'
+
+    def __init__(self, max_queue_size=10000, timeout=5, failure_threshold=5, reset_timeout=60,
+                 shutdown_timeout=10):
+        super(GA4EventDispatcher, self).__init__(max_queue_size, shutdown_timeout)
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._session = None
+        self._consecutive_failures = 0
+        self._circuit_opened_at = None
+        self.submitted = 0
+        self.sent = 0
+        self.requests = 0
+        self.failures = 0
+        self.dropped_circuit_open = 0
+
+    def _start(self):
+        self._session = requests.Session()
+
+    def submit(self, url, payload):
+        """ Queues a Measurement Protocol payload for url. Returns False if it was dropped. """
+        if not self._put((url, payload)):
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    @staticmethod
+    def merge(batch):
+        """ Merges queued (url, payload) pairs into as few Measurement Protocol payloads as
+            possible - events can only share a request if they share url, client and user.
+        """
+        merged = {}
+        for url, payload in batch:
+            group = (url, payload.get('client_id'), payload.get('user_id'), payload.get('non_personalized_ads'))
+            if group not in merged:
+                # request level fields (including timestamp_micros) come from the first event queued
+                merged[group] = (url, {k: v for k, v in payload.items() if k != 'events'}, [])
+            merged[group][2].extend(payload.get('events', []))
+        for url, base_payload, events in merged.values():
+            for i in range(0, len(events), GA4_MAX_EVENTS_PER_REQUEST):
+                yield url, dict(base_payload, events=events[i:i + GA4_MAX_EVENTS_PER_REQUEST])
+
+    def _circuit_is_open(self):
+        with self._lock:
+            if self._circuit_opened_at is None:
+                return False
+            if time.time() - self._circuit_opened_at >= self.reset_timeout:
+                # half open - let the next request through to probe
+                self._circuit_opened_at = None
+                self._consecutive_failures = self.failure_threshold - 1
+                return False
+            return True
+
+    def _record_result(self, ok, n_events):
+        with self._lock:
+            self.requests += 1
+            if ok:
+                self.sent += n_events
+                self._consecutive_failures = 0
+            else:
+                self.failures += 1
+                self._consecutive_failures += 1
+                if self._consecutive_failures >= self.failure_threshold:
+                    self._circuit_opened_at = time.time()
+
+    def _dispatch(self, batch):
+        for url, payload in self.merge(batch):
+            n_events = len(payload['events'])
+            if self._circuit_is_open():
+                with self._lock:
+                    self.dropped_circuit_open += n_events
+                continue
+            try:
+                response = self._session.post(url=url, data=json.dumps(payload), timeout=self.timeout, verify=True)
+                ok = response.status_code < 300
+                if not ok:
+                    log.error('GA responded with status %s' % response.status_code)
+            except Exception as e:
+                log.error('Exception encountered posting to GA: %s' % e)
+                ok = False
+            self._record_result(ok, n_events)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'sent': self.sent,
+                'requests': self.requests,
+                'failures': self.failures,
+                'dropped_queue_full': self.dropped_queue_full,
+                'dropped_circuit_open': self.dropped_circuit_open,
+                'queued': self.qsize(),
+                'circuit_open': self._circuit_opened_at is not None,
+            }
+
+
+GA4_EVENT_DISPATCHER = GA4EventDispatcher()
+atexit.register(GA4_EVENT_DISPATCHER.shutdown)
@@ -0,0 +1,113 @@
+import os
+import queue
+import structlog
+import threading
+import time
+
+
+log = structlog.getLogger(__name__)
+
+
+class BackgroundQueue(object):
+    """ Base for process-wide work queues handled by one background worker thread, so that
+        requests hand work off instead of waiting on it (see GA4EventDispatcher and
+        S3DeletionQueue).
+
+        Subclasses queue items with _put() and handle them in _dispatch(batch), which is given
+        everything queued since the worker last looked.
+        * The queue is bounded: when it is full, new items are dropped (and counted).
+        * The worker is started on first use in each process - a forked child needs its own.
+        * shutdown() handles whatever is still queued and stops the worker; register it with
+          atexit so queued items are not lost when the process exits.
+    """
+
+    # name of the worker thread
+    worker_name = 'background-queue'
+
+    def __init__(self, max_queue_size, shutdown_timeout):
+        self.max_queue_size = max_queue_size
+        self.shutdown_timeout = shutdown_timeout
+        self._lock = threading.Lock()
+        self._queue = None
+        self._worker = None
+        self._pid = None
+        self.dropped_queue_full = 0
+
+    def _start(self):
+        """ Called, holding the lock, each time a new worker is about to start """
+
+    def _ensure_worker(self):
+        """ Starts the worker on first use in this process (a forked child needs its own) """
+        pid = os.getpid()
+        with self._lock:
+            if self._worker is not None and self._pid == pid:
+                return
+            self._queue = queue.Queue(maxsize=self.max_queue_size)
+            self._start()
+            self._worker = threading.Thread(target=self._run, name=self.worker_name, daemon=True)
+            self._pid = pid
+            self._worker.start()
+
+    def _put(self, item):
+        """ Queues item for the worker. Returns False if the queue was full and it was dropped. """
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.dropped_queue_full += 1
+            return False
+        return True
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            # take whatever else is already queued, without waiting for more
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in batch  # None is the stop marker put by shutdown()
+            items = [item for item in batch if item is not None]
+            try:
+                if items:
+                    self._dispatch(items)
+            except Exception as e:
+                log.error('Exception encountered in %s: %s' % (self.worker_name, e))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _dispatch(self, batch):
+        raise NotImplementedError
+
+    def qsize(self):
+        """ The number of items queued and not yet taken by the worker """
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def flush(self, timeout=None):
+        """ Waits until every queued item has been handled. Returns False on timeout. """
+        if self._queue is None:
+            return True
+        deadline = None if timeout is None else time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def shutdown(self):
+        """ Handles whatever is still queued and stops the worker """
+        with self._lock:
+            worker, pid = self._worker, self._pid
+        if worker is None or pid != os.getpid():
+            return
+        try:
+            self._queue.put(None, timeout=self.shutdown_timeout)
+        except queue.Full:
+            pass
+        worker.join(self.shutdown_timeout)
+        with self._lock:
+            self._worker = None
@@ -1,20 +1,26 @@
+import copy
 import datetime
 import json
 import os
 import pytz
-import requests
 import structlog
+import uuid
+from botocore.exceptions import ClientError
+from collections import OrderedDict
 from typing import Any, Dict, List
-from dcicutils.misc_utils import ignored
 from pyramid.httpexceptions import (
+    HTTPBadRequest,
     HTTPForbidden,
     HTTPTemporaryRedirect,
     HTTPNotFound,
+    HTTPRequestRangeNotSatisfiable,
 )
 from pyramid.response import Response
 from pyramid.settings import asbool
 from pyramid.view import view_config
 from snovault import (
+    COLLECTIONS,
+    CONNECTION,
     AfterModified,
     BeforeModified,
 )
@@ -35,14 +41,43 @@ from urllib.parse import (
     urlparse,
 )
 from snovault.authentication import session_properties
-from snovault.search.search import make_search_subreq
-from snovault.util import check_user_is_logged_in, make_s3_client
+from snovault.search.search import get_iterable_search_results, make_search_subreq
+from snovault.util import check_user_is_logged_in
 from snovault.types.base import (
     get_item_or_none,
     collection_add,
     item_edit,
 )
-from .types.file import File, external_creds
+from .analytics import GA4_COLLECT_URL, GA4_EVENT_DISPATCHER
+from .s3_utils import (
+    S3_RANGE_CACHE,
+    build_s3_presigned_get_url,
+    get_s3_client,
+    list_uploaded_parts,
+    open_s3_ranges,
+    plan_multipart_upload,
+    presign_upload_parts,
+)
+from .streaming import (
+    DEFAULT_READ_AHEAD_DEPTH,
+    DEFAULT_STREAM_CHUNK_SIZE,
+    READ_AHEAD_CHUNK_SIZE_SETTING,
+    READ_AHEAD_DEPTH_SETTING,
+    READ_AHEAD_SETTING,
+    ZERO_COPY_SETTING,
+    ReadAheadStream,
+    ZeroCopyStream,
+)
+from .types.file import (
+    File,
+    external_creds,
+    external_creds_bulk,
+    FILTERED_REV_STATUSES,
+    get_links,
+    iter_items,
+    prefetch_upload_creds,
+)
+from .types.file_format import get_file_format
 
 
 log = structlog.getLogger(__name__)
@@ -52,42 +87,18 @@ def includeme(config):
     config.scan(__name__)
 
 
-def extract_bucket_and_key(url: str) -> (str, str):
-    """ Takes an HTTPS URL to S3 and extracts the bucket and key """
-    parsed_url = urlparse(url)
-    bucket = parsed_url.netloc.split('.')[0]
-    key = parsed_url.path.strip('/')
-    if '?' in key:  # remove query params
-        key = key.split('?', 1)[0]
-    return bucket, key
-
-
-def generate_creds(e: HTTPTemporaryRedirect) -> dict:
-    """ Processes HTTPTemporary redirect response from the app, grabbing the bucket/key
-        and calling external_creds with upload=False
-    """
-    url = e.location
-    bucket, key = extract_bucket_and_key(url)
-    return external_creds(bucket, key, name=f'DownloadCredentials', upload=False)
-
-
 @view_config(name='download_cli', context=File, permission='view', request_method=['GET'])
 @debug_log
 def download_cli(context, request):
     """ Runs the external_creds function with upload=False assuming user passes auth check """
-    ignored(context)
-    path = request.path
-    # Direct to @@download to track via GA and run perm check
-    try:  # this call will raise HTTPTemporary redirect if successful
-        uri = path.replace('@@download_cli', '@@download')
-        request.embed(uri, as_user=True)
-    except HTTPTemporaryRedirect as e:
-        return generate_creds(e)
-    except Exception as e:
-        msg = f'Error encountered with /embed {e}'
+    filename = request.subpath[0] if request.subpath else None
+    try:
+        target = resolve_download_target(context, request, filename)
+    except ValueError as e:
+        msg = f'Error encountered resolving download {e}'
         log.error(msg)
         return Response(msg, status=400)
-    return Response('Could not retrieve creds', status=400)
+    return external_creds(target['bucket'], target['key'], name='DownloadCredentials', upload=False)
 
 
 @view_config(name='upload', context=File, request_method='GET',
@@ -111,35 +122,51 @@ def get_upload(context, request):
     }
 
 
-@view_config(name='upload', context=File, request_method='POST',
-             permission='edit', validators=[schema_validator({"type": "object"})])
-@debug_log
-def post_upload(context, request):
-    properties = context.upgrade_properties()
-    if properties['status'] not in ('uploading', 'to be uploaded by workflow', 'upload failed'):
-        raise HTTPForbidden('status must be "uploading" to issue new credentials')
-    # accession_or_external = properties.get('accession')
+# Files may only be (re)uploaded in these statuses
+UPLOADABLE_STATUSES = ('uploading', 'to be uploaded by workflow', 'upload failed')
+# Files (and extra files) in these statuses have nothing on S3 to download
+UNDOWNLOADABLE_STATUSES = ('to be uploaded by workflow', 'upload failed')
+
+
+def get_upload_location(context, request, properties):
+    """ Returns the S3 bucket and key that the file should be uploaded to """
     external = context.propsheets.get('external', None)
 
     if external is None:
         # Handle objects initially posted as another state.
         bucket = request.registry.settings['file_upload_bucket']
-        # maybe this should be properties.uuid
-        uuid = context.uuid
-        file_format = get_item_or_none(request, properties.get('file_format'), 'file-formats')
-        try:
-            file_extension = '.' + file_format.get('standard_file_extension')
-        except AttributeError:
-            file_extension = ''
-
-        key = '{uuid}/{accession}.{file_extension}'.format(
-            file_extension=file_extension, uuid=uuid, **properties)
+        key = context.build_upload_key(request.registry, context.uuid, properties)
 
     elif external.get('service') == 's3':
         bucket = external['bucket']
         key = external['key']
     else:
         raise ValueError(external.get('service'))
+    return bucket, key
+
+
+@view_config(name='upload', context=File, request_method='POST',
+             permission='edit', validators=[schema_validator({"type": "object"})])
+@debug_log
+def post_upload(context, request):
+    properties = context.upgrade_properties()
+    if properties['status'] not in UPLOADABLE_STATUSES:
+        raise HTTPForbidden('status must be "uploading" to issue new credentials')
+    update_upload_credentials(context, request, properties)
+
+    rendered = request.embed('/%s/@@object' % context.uuid, as_user=True)
+    result = {
+        'status': 'success',
+        '@type': ['result'],
+        '@graph': [rendered],
+    }
+    return result
+
+
+def update_upload_credentials(context, request, properties):
+    """ Issues new upload credentials for the file (and its extra files) and saves them """
+    # accession_or_external = properties.get('accession')
+    bucket, key = get_upload_location(context, request, properties)
 
     # remove the path from the file name and only take first 32 chars
     name = None
@@ -159,13 +186,170 @@ def post_upload(context, request):
     context.update(new_properties, {'external': creds})
     registry.notify(AfterModified(context, request))
 
-    rendered = request.embed('/%s/@@object' % context.uuid, as_user=True)
-    result = {
+
+@view_config(name='upload_credentials', context=File.AbstractCollection, request_method='POST', permission='list')
+@view_config(name='upload_credentials', context=File.Collection, request_method='POST', permission='list')
+@debug_log
+def bulk_upload_credentials(context, request):
+    """ Issues upload credentials for many files, and their extra files, at once - as @@upload
+        does for one. Takes the same body as @@bulk_download.
+
+        All the credentials are minted up front by prefetch_upload_creds, concurrently and before
+        any file is updated; the updates that follow find them cached instead of each making their
+        own round trip. Each file still gets credentials scoped to its own keys only.
+    """
+    identifiers = get_bulk_request_identifiers(request)
+    collection = get_files_collection(request)
+    errors, files = [], []
+    for identifier in identifiers:
+        name = str(identifier).strip('/').split('/')[-1]
+        item = collection.get(name) if name else None
+        if item is None:
+            errors.append({'identifier': identifier, 'error': 'not found'})
+        elif not request.has_permission('edit', item):
+            errors.append({'identifier': identifier, 'error': 'forbidden'})
+        elif item.upgrade_properties()['status'] not in UPLOADABLE_STATUSES:
+            errors.append({'identifier': identifier, 'error': 'status must be "uploading" to issue new credentials'})
+        else:
+            files.append((identifier, item, item.upgrade_properties()))
+
+    prefetch_upload_creds(request.registry, [(type(item), item.uuid, properties) for _, item, properties in files])
+    graph = []
+    for identifier, item, properties in files:
+        update_upload_credentials(item, request, properties)
+        graph.append({
+            'identifier': identifier,
+            '@id': request.resource_path(item),
+            'upload_credentials': item.propsheets.get('external', {}).get('upload_credentials'),
+            'extra_files_creds': item.extra_files_creds(),
+        })
+    return {
         'status': 'success',
         '@type': ['result'],
-        '@graph': [rendered],
+        '@graph': graph,
+        'errors': errors,
     }
-    return result
+
+
+def get_multipart_upload_location(context, request):
+    """ Checks the file may be uploaded to and returns its properties and upload bucket and key """
+    properties = context.upgrade_properties()
+    if properties['status'] not in UPLOADABLE_STATUSES:
+        raise HTTPForbidden('status must be "uploading" to upload')
+    bucket, key = get_upload_location(context, request, properties)
+    return properties, bucket, key
+
+
+def get_multipart_upload_id(request):
+    """ Returns the upload_id given as a query parameter or, for POSTs, in the JSON body """
+    upload_id = request.params.get('upload_id')
+    if not upload_id and request.method == 'POST':
+        upload_id = request.json_body.get('upload_id')
+    if not upload_id:
+        raise HTTPBadRequest('upload_id is required')
+    return upload_id
+
+
+def multipart_upload_result(context, request, **values):
+    """ Wraps the outcome of a multipart upload step like other @@upload results """
+    return {
+        'status': 'success',
+        '@type': ['result'],
+        '@graph': [dict(values, **{'@id': request.resource_path(context)})],
+    }
+
+
+@view_config(name='upload', context=File, request_method='POST', request_param='multipart=start',
+             permission='edit', validators=[schema_validator({"type": "object"})])
+@debug_log
+def start_multipart_upload(context, request):
+    """ Starts an S3 multipart upload of the file, so any HTTP client can upload it in parallel parts.
+
+        Takes {"file_size": <bytes>, "part_size": <bytes>} and returns the upload_id along with a
+        presigned PUT URL for each part; PUT part n as bytes [(n-1) * part_size, n * part_size)
+        and keep the ETag header of each response for ?multipart=complete.
+    """
+    properties, bucket, key = get_multipart_upload_location(context, request)
+    body = request.json_body
+    try:
+        n_parts = plan_multipart_upload(body.get('file_size'), body.get('part_size'))
+    except ValueError as e:
+        raise HTTPBadRequest(str(e))
+
+    if context.propsheets.get('external') is None or properties['status'] == 'upload failed':
+        # record where the file is going, as @@upload does when it issues credentials
+        new_properties = properties.copy()
+        if properties['status'] == 'upload failed':
+            new_properties['status'] = 'uploading'
+        registry = request.registry
+        registry.notify(BeforeModified(context, request))
+        context.update(new_properties, {'external': external_creds(bucket, key)})
+        registry.notify(AfterModified(context, request))
+
+    client = get_s3_client(request.registry)
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    return multipart_upload_result(
+        context, request, upload_id=upload_id, bucket=bucket, key=key, part_size=body['part_size'],
+        parts=presign_upload_parts(client, bucket, key, upload_id, range(1, n_parts + 1)))
+
+
+@view_config(name='upload', context=File, request_method='GET', request_param='multipart=parts',
+             permission='edit')
+@debug_log
+def list_multipart_upload_parts(context, request):
+    """ Lists the parts uploaded so far under ?upload_id=, to resume an interrupted upload.
+        Pass ?part_numbers=3,7 to also get fresh presigned URLs for the parts still to upload.
+    """
+    _, bucket, key = get_multipart_upload_location(context, request)
+    upload_id = get_multipart_upload_id(request)
+    client = get_s3_client(request.registry)
+    try:
+        part_numbers = [int(n) for n in request.params.get('part_numbers', '').split(',') if n]
+        uploaded = list_uploaded_parts(client, bucket, key, upload_id)
+    except ValueError:
+        raise HTTPBadRequest('part_numbers must be a comma separated list of integers')
+    except ClientError as e:
+        raise HTTPBadRequest(f'Could not list parts of upload {upload_id}: {e}')
+    return multipart_upload_result(
+        context, request, upload_id=upload_id, bucket=bucket, key=key, uploaded_parts=uploaded,
+        parts=presign_upload_parts(client, bucket, key, upload_id, part_numbers))
+
+
+@view_config(name='upload', context=File, request_method='POST', request_param='multipart=complete',
+             permission='edit', validators=[schema_validator({"type": "object"})])
+@debug_log
+def complete_multipart_upload(context, request):
+    """ Completes a multipart upload from {"upload_id": ..., "parts": [{"part_number": n, "etag": ...}]} """
+    _, bucket, key = get_multipart_upload_location(context, request)
+    upload_id = get_multipart_upload_id(request)
+    try:
+        parts = sorted(({'PartNumber': int(part['part_number']), 'ETag': part['etag']}
+                        for part in request.json_body.get('parts') or []), key=lambda part: part['PartNumber'])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPBadRequest('parts must be a list of {"part_number": n, "etag": ...}')
+    if not parts:
+        raise HTTPBadRequest('parts is required')
+    try:
+        response = get_s3_client(request.registry).complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except ClientError as e:
+        raise HTTPBadRequest(f'Could not complete upload {upload_id}: {e}')
+    return multipart_upload_result(context, request, upload_id=upload_id, bucket=bucket, key=key,
+                                   etag=response.get('ETag'))
+
+
+@view_config(name='upload', context=File, request_method='POST', request_param='multipart=abort',
+             permission='edit', validators=[schema_validator({"type": "object"})])
+@debug_log
+def abort_multipart_upload(context, request):
+    """ Aborts the multipart upload {"upload_id": ...}, discarding any parts uploaded """
+    _, bucket, key = get_multipart_upload_location(context, request)
+    upload_id = get_multipart_upload_id(request)
+    try:
+        get_s3_client(request.registry).abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+    except ClientError as e:
+        raise HTTPBadRequest(f'Could not abort upload {upload_id}: {e}')
+    return multipart_upload_result(context, request, upload_id=upload_id, bucket=bucket, key=key)
 
 
 def is_file_to_download(properties, file_format, expected_filename=None):
@@ -202,11 +386,254 @@ def _iter_and_close(stream, chunk_size=1024 * 1024):
         stream.close()
 
 
+def iter_s3_body(stream, settings, content_length=None):
+    """ Returns an app_iter for an S3 body stream - read ahead on a background thread if the
+        download.read_ahead setting is on, otherwise read in step with the client (_iter_and_close).
+        With download.zero_copy on, either way reads into reused buffers rather than new bytes -
+        but only if the response's content_length is known, as chunked responses need bytes.
+    """
+    zero_copy = asbool(settings.get(ZERO_COPY_SETTING, False)) and content_length is not None
+    if asbool(settings.get(READ_AHEAD_SETTING, False)):
+        return ReadAheadStream(stream,
+                               chunk_size=int(settings.get(READ_AHEAD_CHUNK_SIZE_SETTING, DEFAULT_STREAM_CHUNK_SIZE)),
+                               depth=int(settings.get(READ_AHEAD_DEPTH_SETTING, DEFAULT_READ_AHEAD_DEPTH)),
+                               copy=not zero_copy)
+    if zero_copy:
+        return ZeroCopyStream(stream, content_length)
+    return _iter_and_close(stream)
+
+
+# More ranges than this in one request are not split up - S3 is sent the header as-is
+MAX_MULTIPART_RANGES = 50
+
+
+def parse_byte_ranges(range_header):
+    """ Parses a 'bytes=...' Range header into a list of (start, end) pairs, using the same
+        conventions as webob's Range (end exclusive; (-n, None) for the last n bytes; end None
+        for open-ended). Unlike webob, every range is kept, not just the first.
+        Returns None if the header is missing or malformed.
+    """
+    if not range_header:
+        return None
+    units, _, specs = range_header.partition('=')
+    if units.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        start, sep, end = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not start:
+                if not end:
+                    return None
+                ranges.append((-int(end), None))
+            else:
+                start, end = int(start), (int(end) + 1 if end else None)
+                if end is not None and end <= start:
+                    return None
+                ranges.append((start, end))
+        except ValueError:
+            return None
+    return ranges
+
+
+def format_byte_range(byte_range):
+    """ Inverse of parse_byte_ranges for a single (start, end) pair """
+    start, end = byte_range
+    if start < 0:
+        return 'bytes=%s' % start
+    return 'bytes=%s-%s' % (start, '' if end is None else end - 1)
+
+
+def get_byte_ranges_length(byte_ranges, file_size):
+    """ Returns the number of bytes parsed byte_ranges (see parse_byte_ranges) cover in a file of
+        file_size bytes - suffix ranges count their last n bytes, open ranges run to the end
+    """
+    length = 0
+    for start, end in byte_ranges:
+        if start < 0:
+            length += min(-start, file_size)
+        else:
+            end = file_size if end is None else min(end, file_size)
+            length += max(end - start, 0)
+    return length
+
+
+def get_satisfiable_byte_ranges(byte_ranges, file_size):
+    """ Returns the parsed byte_ranges (see parse_byte_ranges) that overlap a file of file_size
+        bytes - those starting before its end, and non-empty suffix ranges of a non-empty file
+    """
+    return [(start, end) for start, end in byte_ranges
+            if (start < 0 and file_size > 0) or 0 <= start < file_size]
+
+
+def get_object_size(conn, param_get_object, properties):
+    """ Returns the size of the S3 object, from file_size if the file has one """
+    file_size = properties.get('file_size')
+    if file_size is None:
+        file_size = conn.head_object(Bucket=param_get_object['Bucket'],
+                                     Key=param_get_object['Key'])['ContentLength']
+    return file_size
+
+
+def _iter_multipart_byteranges(parts, boundary, settings, content_length):
+    """ Yields a multipart/byteranges body (of content_length bytes) from (part headers, S3 body
+        stream) pairs, streaming each part's body in turn and closing every stream whether or not
+        it is consumed
+    """
+    try:
+        for part_headers, body_stream in parts:
+            yield part_headers
+            yield from iter_s3_body(body_stream, settings, content_length=content_length)
+            yield b'\r\n'
+        yield b'--%s--\r\n' % boundary
+    finally:
+        for _, body_stream in parts:
+            body_stream.close()
+
+
+def build_multipart_range_response(request, conn, param_get_object, byte_ranges):
+    """ Fetches every range concurrently and returns a 206 multipart/byteranges response that
+        streams the parts back in the order requested
+    """
+    responses = open_s3_ranges(conn, param_get_object, [format_byte_range(r) for r in byte_ranges],
+                               registry=request.registry)
+    boundary = uuid.uuid4().hex.encode('ascii')
+    parts, content_length = [], 0
+    for response in responses:
+        part_headers = b'--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n' % (
+            boundary,
+            (response.get('ContentType') or 'application/octet-stream').encode('latin-1'),
+            response.get('ContentRange', '').encode('latin-1'))
+        parts.append((part_headers, response['Body']))
+        content_length += len(part_headers) + response['ContentLength'] + 2
+    content_length += len(boundary) + 6
+    return Response(
+        app_iter=_iter_multipart_byteranges(parts, boundary, request.registry.settings, content_length),
+        status_code=206,
+        accept_ranges='bytes',
+        content_type='multipart/byteranges; boundary=%s' % boundary.decode('ascii'),
+        content_length=content_length,
+    )
+
+
+# Registry settings for handing proxied Range downloads off to the front-end proxy
+DOWNLOAD_OFFLOAD_SETTING = 'download.offload'
+DOWNLOAD_OFFLOAD_PREFIX_SETTING = 'download.offload_prefix'
+DEFAULT_DOWNLOAD_OFFLOAD_PREFIX = '/_s3_proxy/'
+
+
+def build_offload_response(settings, location):
+    """ Returns an empty response whose X-Accel-Redirect header tells the front-end proxy
+        (nginx) to fetch the presigned S3 location itself and stream it to the client, so the
+        worker is free as soon as this returns. The location is passed as
+        <prefix><scheme>/<host><path>?<query>, to be served by an internal location such as:
+
+            location ~ ^/_s3_proxy/(https?)/([^/]+)/(.*)$ {
+                internal;
+                proxy_pass $1://$2/$3$is_args$args;
+            }
+
+        The client's Range header is passed on to S3 by the proxy, unchanged.
+    """
+    parsed = urlparse(location)
+    prefix = settings.get(DOWNLOAD_OFFLOAD_PREFIX_SETTING, DEFAULT_DOWNLOAD_OFFLOAD_PREFIX)
+    redirect = '%s/%s/%s%s' % (prefix.rstrip('/'), parsed.scheme, parsed.netloc, parsed.path)
+    if parsed.query:
+        redirect += '?' + parsed.query
+    return Response(headers={'X-Accel-Redirect': redirect})
+
+
+def get_single_range_length(request):
+    """ Returns the number of bytes requested by a single, bounded 'bytes=start-end' Range
+        header, or None for anything else (open-ended, suffix or multiple ranges)
+    """
+    if ',' in request.headers.get('Range', ','):
+        return None
+    byte_range = request.range
+    if byte_range is None or byte_range.end is None or byte_range.start < 0:
+        return None
+    return byte_range.end - byte_range.start
+
+
+def get_download_bucket(registry, external_bucket):
+    """ Returns the bucket to download from given the bucket recorded on the file, which must
+        be one of the configured upload/wfout buckets (metadata may name another environment's)
+    """
+    wfout_bucket = registry.settings['file_wfout_bucket']
+    files_bucket = registry.settings['file_upload_bucket']
+    if external_bucket not in [wfout_bucket, files_bucket]:
+        bucket = files_bucket if 'wfout' not in external_bucket else wfout_bucket
+        log.error(f'Encountered s3 bucket mismatch - ignoring metadata value {external_bucket}'
+                  f' and using registry value {bucket}')
+        return bucket
+    return external_bucket
+
+
+def is_download_proxied(request):
+    """ Whether downloads for this client go through the download_proxy (it is not in AWS) """
+    try:
+        return request.client_addr not in request.registry['aws_ipset']
+    except TypeError:
+        # this fails in testing due to testapp not having ip
+        return False
+
+
+def resolve_download_target(context, request, filename=None):
+    """ Resolves a download of context - the File itself or, when filename names one, one of its
+        extra_files - to the S3 'bucket', 'key' and 'filename' to serve, along with the
+        'properties' and 'file_format' of that file. The view permission is checked by the views;
+        this checks the user is logged in and the file's status, and does no session lookup,
+        accounting or presigning. Raises HTTPNotFound if filename matches no file, HTTPForbidden if
+        its status has nothing to download and ValueError if it is not stored on S3.
+    """
+    check_user_is_logged_in(request)
+
+    # with extra_files the user may be trying to download the main file
+    # or one of the files in extra files, the following logic will
+    # search to find the "right" file
+    properties = context.upgrade_properties()
+    file_format = get_file_format(request, properties.get('file_format'))
+    resolved_filename = is_file_to_download(properties, file_format, filename)
+    if resolved_filename:
+        external = context.propsheets.get('external', {})
+    else:
+        for extra in properties.get('extra_files', []):
+            eformat = get_file_format(request, extra.get('file_format'))
+            resolved_filename = is_file_to_download(extra, eformat, filename)
+            if resolved_filename:
+                properties, file_format = extra, eformat
+                external = context.propsheets.get('external' + eformat.get('uuid'))
+                break
+        else:
+            raise HTTPNotFound(filename)
+
+    if properties.get('status') in UNDOWNLOADABLE_STATUSES:
+        raise HTTPForbidden(f'status "{properties["status"]}" has no file to download')
+    if not external:
+        external = context.build_external_location(request.registry, context.uuid, properties)
+    if external.get('service') != 's3':
+        raise ValueError(external.get('service'))
+    return {
+        'properties': properties,
+        'file_format': file_format,
+        'bucket': get_download_bucket(request.registry, external['bucket']),
+        'key': external['key'],
+        'filename': resolved_filename,
+    }
+
+
 @view_config(name='download', context=File, request_method='GET',
              permission='view', subpath_segments=[0, 1])
 def download(context, request):
     """ File download route. Generates a pre-signed S3 URL for the object that expires eventually. """
-    check_user_is_logged_in(request)
+    _filename = None
+    if request.subpath:
+        _filename, = request.subpath
+    target = resolve_download_target(context, request, _filename)
+    properties = target['properties']
+    filename = target['filename']
 
     # first check for restricted status
     try:
@@ -224,89 +651,32 @@ def download(context, request):
                        'request_path': request.path_info, 'request_headers': str(dict(request.headers))}
 
     # proxy triggers if we should use Axel-redirect, useful for s3 range byte queries
-    try:
-        use_download_proxy = request.client_addr not in request.registry['aws_ipset']
-    except TypeError:
-        # this fails in testing due to testapp not having ip
-        use_download_proxy = False
+    use_download_proxy = is_download_proxied(request)
 
-    # with extra_files the user may be trying to download the main file
-    # or one of the files in extra files, the following logic will
-    # search to find the "right" file and redirect to a download link for that one
-    properties = context.upgrade_properties()
-    file_format = get_item_or_none(request, properties.get('file_format'), 'file-formats')
-    _filename = None
-    if request.subpath:
-        _filename, = request.subpath
-    filename = is_file_to_download(properties, file_format, _filename)
-    if not filename:
-        found = False
-        for extra in properties.get('extra_files', []):
-            eformat = get_item_or_none(request, extra.get('file_format'), 'file-formats')
-            filename = is_file_to_download(extra, eformat, _filename)
-            if filename:
-                found = True
-                properties = extra
-                external = context.propsheets.get('external' + eformat.get('uuid'))
-                if eformat is not None:
-                    tracking_values['file_format'] = eformat.get('file_format')
-                break
-        if not found:
-            raise HTTPNotFound(_filename)
-    else:
-        external = context.propsheets.get('external', {})
-        if file_format is not None:
-            tracking_values['file_format'] = file_format.get('file_format')
+    if target['file_format'] is not None:
+        tracking_values['file_format'] = target['file_format'].get('file_format')
     tracking_values['filename'] = filename
 
     # Calculate bytes downloaded from Range header
     file_size_downloaded = properties.get('file_size', 0)
+    byte_ranges = parse_byte_ranges(request.headers.get('Range'))
     if request.range:
-        file_size_downloaded = 0
         # Assume range unit is bytes
-        if hasattr(request.range, "ranges"):
-            for (range_start, range_end) in request.range.ranges:
-                file_size_downloaded += (
-                    (range_end or properties.get('file_size', 0)) -
-                    (range_start or 0)
-                )
-        else:
-            file_size_downloaded = (
-                (request.range.end or properties.get('file_size', 0)) -
-                (request.range.start or 0)
-            )
-
-    if not external:
-        external = context.build_external_creds(request.registry, context.uuid, properties)
-    if external.get('service') == 's3':
-        external_bucket = external['bucket']
-        wfout_bucket = request.registry.settings['file_wfout_bucket']
-        files_bucket = request.registry.settings['file_upload_bucket']
-        if external_bucket not in [wfout_bucket, files_bucket]:
-            if 'wfout' not in external_bucket:
-                external_bucket = files_bucket
-            else:
-                external_bucket = wfout_bucket
-            log.error(f'Encountered s3 bucket mismatch - ignoring metadata value {external_bucket}'
-                      f' and using registry value {external_bucket}')
-        conn = make_s3_client()
-        param_get_object = {
-            'Bucket': external_bucket,
-            'Key': external['key'],
-            'ResponseContentDisposition': 'attachment; filename=' + filename
-        }
-        if 'Range' in request.headers:
-            tracking_values['range_query'] = True
-            param_get_object.update({'Range': request.headers.get('Range')})
-        else:
-            tracking_values['range_query'] = False
-        location = conn.generate_presigned_url(
-            ClientMethod='get_object',
-            Params=param_get_object,
-            ExpiresIn=36*60*60
-        )
+        file_size_downloaded = get_byte_ranges_length(
+            byte_ranges or [(request.range.start, request.range.end)], file_size_downloaded)
+
+    conn = get_s3_client(request.registry)
+    param_get_object = {
+        'Bucket': target['bucket'],
+        'Key': target['key'],
+        'ResponseContentDisposition': 'attachment; filename=' + filename
+    }
+    if 'Range' in request.headers:
+        tracking_values['range_query'] = True
+        param_get_object.update({'Range': request.headers.get('Range')})
     else:
-        raise ValueError(external.get('service'))
+        tracking_values['range_query'] = False
+    location = build_s3_presigned_get_url(params=param_get_object, registry=request.registry)
 
     # tracking_values['experiment_type'] = get_file_experiment_type(request, context, properties)
     # # create a tracking_item to track this download
@@ -338,6 +708,22 @@ def download(context, request):
         }
 
     if 'Range' in request.headers:
+        if byte_ranges and 1 < len(byte_ranges) <= MAX_MULTIPART_RANGES:
+            # S3 only serves one range per request, so fetch each in parallel and combine them
+            param_get_object.pop('Range')
+            # S3 fails a get_object for a range starting past the end of the object, so leave
+            # those out; only when none are left is the request unsatisfiable
+            file_size = get_object_size(conn, param_get_object, properties)
+            byte_ranges = get_satisfiable_byte_ranges(byte_ranges, file_size)
+            if not byte_ranges:
+                raise HTTPRequestRangeNotSatisfiable(headers={'Content-Range': 'bytes */%s' % file_size})
+            return build_multipart_range_response(request, conn, param_get_object, byte_ranges)
+        if asbool(request.registry.settings.get(DOWNLOAD_OFFLOAD_SETTING, False)):
+            # let the front-end proxy stream the bytes rather than tie up this worker
+            return build_offload_response(request.registry.settings, location)
+        if S3_RANGE_CACHE.cacheable(get_single_range_length(request)):
+            # small reads (index files, headers) are served from memory / coalesced
+            return Response(**S3_RANGE_CACHE.get(conn, param_get_object))
         try:
             response_body = conn.get_object(**param_get_object)
         except Exception as e:
@@ -347,7 +733,8 @@ def download(context, request):
             # Stream the S3 body instead of reading it fully into memory first -
             # these files can be many GB/TB, so buffering a ranged request's full
             # body here would let a single request exhaust app server memory.
-            'app_iter': _iter_and_close(body_stream),
+            'app_iter': iter_s3_body(body_stream, request.registry.settings,
+                                     content_length=response_body.get('ContentLength')),
             # status_code : 206 if partial, 200 if the range covers whole file
             'status_code': response_body.get('ResponseMetadata').get('HTTPStatusCode'),
             'accept_ranges': response_body.get('AcceptRanges'),
@@ -365,20 +752,238 @@ def download(context, request):
     raise HTTPTemporaryRedirect(location=location)
 
 
-def get_submitter_title(request, context, properties):
+# Upper bound on the number of files one @@bulk_download request may resolve
+MAX_BULK_DOWNLOAD_FILES = 10000
+
+
+def get_bulk_download_identifiers(request, body):
+    """ Returns the File identifiers named by a @@bulk_download request body, either as
+        'files' (uuids, accessions or @ids) or as 'search' (search params, e.g.
+        {"type": ["FileProcessed"], "status": ["released"]}, run as the requesting user)
+    """
+    if body.get('files') is not None:
+        identifiers = body['files']
+        if not isinstance(identifiers, list):
+            raise HTTPBadRequest('"files" must be a list of file identifiers')
+    elif body.get('search') is not None:
+        if not isinstance(body['search'], dict):
+            raise HTTPBadRequest('"search" must be an object of search parameters')
+        param_lists = {k: v if isinstance(v, list) else [v] for k, v in body['search'].items()}
+        param_lists.setdefault('type', ['File'])
+        param_lists['field'] = ['uuid']
+        identifiers = []
+        for result in get_iterable_search_results(request, param_lists=param_lists):
+            identifiers.append(result['uuid'])
+            if len(identifiers) > MAX_BULK_DOWNLOAD_FILES:
+                break
+    else:
+        raise HTTPBadRequest('Either "files" or "search" is required')
+    if len(identifiers) > MAX_BULK_DOWNLOAD_FILES:
+        raise HTTPBadRequest(f'At most {MAX_BULK_DOWNLOAD_FILES} files can be downloaded at once')
+    return identifiers
+
+
+def get_files_collection(request):
+    """ Returns the abstract /files/ collection, which resolves identifiers of every File type -
+        unlike a concrete collection such as /files-processed/, whose get only finds its own type
+    """
+    return request.registry[COLLECTIONS]['File']
+
+
+def resolve_bulk_download_file(collection, request, identifier):
+    """ Resolves one bulk download identifier to a dict of the File ('item'), its 'uuid',
+        'properties' and '@id', and the S3 'bucket', 'key' and 'filename' to download - or to a
+        dict with an 'error' if this user cannot download it. Everything but 'item' is a plain
+        value, so it can still be read once the request's transaction has ended.
+    """
+    name = str(identifier).strip('/').split('/')[-1]
+    item = collection.get(name) if name else None
+    if item is None:
+        return {'identifier': identifier, 'error': 'not found'}
+    if not request.has_permission('view', item):
+        return {'identifier': identifier, 'error': 'forbidden'}
+    try:
+        target = resolve_download_target(item, request)
+    except Exception as e:
+        log.error(f'Could not resolve bulk download of {identifier}: {e}')
+        return {'identifier': identifier, 'error': 'no downloadable file'}
+    return dict(target, identifier=identifier, item=item, uuid=str(item.uuid),
+                properties=copy.deepcopy(target['properties']), **{'@id': item.jsonld_id(request)})
+
+
+def build_bulk_download_entry(request, resolved, use_download_proxy=False):
+    """ Returns the @@bulk_download manifest entry, with a presigned URL, for a resolved file """
+    location = build_s3_presigned_get_url(params={
+        'Bucket': resolved['bucket'],
+        'Key': resolved['key'],
+        'ResponseContentDisposition': 'attachment; filename=' + resolved['filename']
+    }, registry=request.registry)
+    if use_download_proxy:
+        location = request.registry.settings.get('download_proxy', '') + str(location)
+    return {
+        'identifier': resolved['identifier'],
+        '@id': resolved['@id'],
+        'uuid': resolved['uuid'],
+        'filename': resolved['filename'],
+        'file_size': resolved['properties'].get('file_size'),
+        'md5sum': resolved['properties'].get('md5sum'),
+        'url': location,
+    }
+
+
+def submit_bulk_download_ga_events(context, request, resolved_files):
+    """ Records a GA download event for each resolved file, in one batch with one session lookup
+        and one lookup per distinct submitter or file not found in the index
+    """
+    ga_config = request.registry.settings.get('ga_config')
+    if not ga_config or not resolved_files:
+        return
+    try:
+        user_props = session_properties(context, request)
+    except Exception as e:
+        user_props = {'error': str(e)}
+    user_uuid = user_props.get('details', {}).get('uuid', None)
+    user_groups = user_props.get('details', {}).get('groups', None)
+    if user_groups:
+        user_groups.sort()
+    get_item = memoized_get_item_or_none()
+    events = []
+    for resolved in resolved_files:
+        item, properties = resolved['item'], resolved['properties']
+        events.append(build_download_ga_event(
+            item, request, resolved['filename'], properties.get('file_size', 0), resolved['@id'],
+            get_submitter_title(request, item, properties, get_item), user_uuid, user_groups,
+            get_experiment_or_assay_type(request, item, properties, get_item), properties.get('dataset'),
+            get_file_type(request, item, properties)))
+    submit_ga_events(request, ga_config, events, user_uuid)
+
+
+def _iter_manifest(request, resolved_files, use_download_proxy=False):
+    """ Yields the bulk download manifest as newline delimited JSON, presigning each file's URL
+        only as its line is written rather than all of them before the response starts.
+        This runs after the transaction has been committed, when the Files' models can no longer
+        be loaded, so resolved_files must not hold the Files themselves.
+    """
+    for resolved in resolved_files:
+        entry = resolved if 'error' in resolved else build_bulk_download_entry(request, resolved, use_download_proxy)
+        yield json.dumps(entry).encode('utf-8') + b'\n'
+
+
+def get_bulk_request_identifiers(request):
+    """ Checks the user is logged in and returns the identifiers from the JSON request body """
+    check_user_is_logged_in(request)
+    try:
+        body = request.json
+    except ValueError:
+        raise HTTPBadRequest('Request body must be JSON')
+    return get_bulk_download_identifiers(request, body)
+
+
+@view_config(name='bulk_download', context=File.AbstractCollection, request_method='POST', permission='list')
+@view_config(name='bulk_download', context=File.Collection, request_method='POST', permission='list')
+@debug_log
+def bulk_download(context, request):
+    """ Returns presigned download URLs for many files at once, as a streamed newline delimited
+        JSON manifest with one line (filename, file_size, md5sum and url, or an error) per file.
+
+        Takes {"files": [<uuid, accession or @id>, ...]} or {"search": {<search params>}}.
+        The session lookup, download proxy check, S3 client and GA batch are shared by every file
+        rather than paid per @@download request. Files of any type are resolved, whichever files
+        collection this is posted to.
+    """
+    identifiers = get_bulk_request_identifiers(request)
+    files = get_files_collection(request)
+    # the files are resolved (and permissions checked) while the request's transaction is open;
+    # their manifest entries are built as the response is streamed, from plain values only
+    resolved_files = [resolve_bulk_download_file(files, request, identifier) for identifier in identifiers]
+    submit_bulk_download_ga_events(context, request, [r for r in resolved_files if 'error' not in r])
+    manifest_files = [{k: v for k, v in r.items() if k != 'item'} for r in resolved_files]
+    return Response(app_iter=_iter_manifest(request, manifest_files, is_download_proxied(request)),
+                    content_type='application/x-ndjson')
+
+
+@view_config(name='bulk_download_cli', context=File.AbstractCollection, request_method='POST', permission='list')
+@view_config(name='bulk_download_cli', context=File.Collection, request_method='POST', permission='list')
+@debug_log
+def bulk_download_cli(context, request):
+    """ Bulk equivalent of @@download_cli: takes the same body as @@bulk_download and returns
+        scoped download credentials covering every file this user may download.
+
+        Rather than one STS session per file, each credential set's policy lists many keys; the
+        files are only split over several sets where one policy would exceed the STS size limit.
+        As with @@download_cli, no GA download events are recorded - this only issues credentials.
+    """
+    identifiers = get_bulk_request_identifiers(request)
+    files = get_files_collection(request)
+    errors, downloadable = [], []
+    for identifier in identifiers:
+        resolved = resolve_bulk_download_file(files, request, identifier)
+        (errors if 'error' in resolved else downloadable).append(resolved)
+    credential_sets, remaining = [], downloadable
+    for creds in external_creds_bulk([(r['bucket'], r['key']) for r in downloadable], name='DownloadCredentials'):
+        # external_creds_bulk keeps the order of the objects it is given
+        n_files = len(creds['objects'])
+        files, remaining = remaining[:n_files], remaining[n_files:]
+        credential_sets.append({
+            'files': [{'identifier': r['identifier'], '@id': r['@id'], 'filename': r['filename'],
+                       'bucket': r['bucket'], 'key': r['key']} for r in files],
+            'download_credentials': creds['download_credentials'],
+        })
+    return {
+        'credential_sets': credential_sets,
+        'errors': errors,
+    }
+
+
+def get_indexed_document(context):
+    """ Returns the indexed document the context was loaded from, or None if it was loaded
+        from the database. GETs (e.g. @@download) load items from Elasticsearch by default,
+        and that document already holds the rendered 'object' and 'embedded' frames, kept up
+        to date by indexing invalidation when the item or anything it links to changes.
+    """
+    source = getattr(getattr(context, 'model', None), 'source', None)
+    return source if isinstance(source, dict) else None
+
+
+def memoized_get_item_or_none():
+    """ Returns a get_item_or_none that looks each distinct item up only once, so a batch of
+        files sharing submitters (or listed more than once) does not repeat the lookups
+    """
+    items = {}
+
+    def get_item(request, value, itype=None):
+        if (value, itype) not in items:
+            items[(value, itype)] = get_item_or_none(request, value, itype)
+        return items[(value, itype)]
+
+    return get_item
+
+
+def get_submitter_title(request, context, properties, get_item=None):
+    get_item = get_item or get_item_or_none
     submitter = None
-    if properties.get('lab') is not None:
-        submitter = get_item_or_none(request, properties.get('lab'), 'labs')
-    elif properties.get('sequencing_center') is not None:
-        submitter = get_item_or_none(request, properties.get('sequencing_center'), 'submission-centers')
+    embedded = (get_indexed_document(context) or {}).get('embedded', {})
+    for field, collection in (('lab', 'labs'), ('sequencing_center', 'submission-centers')):
+        if properties.get(field) is not None:
+            # use the indexed embed of the submitter if there is one, rather than fetching it
+            if isinstance(embedded.get(field), dict) and 'display_title' in embedded[field]:
+                submitter = embedded[field]
+            else:
+                submitter = get_item(request, properties.get(field), collection)
+            break
     # elif properties.get('submission_centers') is not None and len(properties.get('submission_centers')) > 0:
     #     submitter = get_item_or_none(request, properties.get('submission_centers')[0], 'submission-centers')
 
     return submitter and submitter.get('display_title')
 
 
-def get_experiment_or_assay_type(request, context, properties):
-    file_item = get_item_or_none(request, context.uuid)
+def get_experiment_or_assay_type(request, context, properties, get_item=None):
+    get_item = get_item or get_item_or_none
+    document = get_indexed_document(context)
+    if document is not None and 'object' in document:
+        file_item = document['object']
+    else:
+        file_item = get_item(request, context.uuid)
     if file_item is None:
         return None
     # SMaHT
@@ -401,12 +1006,9 @@ def get_file_type(request, context, properties):
     return properties.get('file_type') or 'other'
 
 
-def update_google_analytics(context, request, ga_config, filename, file_size_downloaded,
-                            file_at_id, submitter_title, user_uuid, user_groups, exp_or_assay_type, dataset, file_type='other'):
-    """ Helper for @@download that updates GA in response to a download.
-    """
-    registry = request.registry
-    ga4_secret = registry.settings.get('ga4.secret')
+def get_ga_collect_url_and_client_id(request, ga_config):
+    """ Returns the GA4 Measurement Protocol URL for this host and the GA client id of the caller """
+    ga4_secret = request.registry.settings.get('ga4.secret')
     if not ga4_secret:
         raise Exception("No valid GA4 api secret found")
 
@@ -425,59 +1027,73 @@ def update_google_analytics(context, request, ga_config, filename, file_size_dow
     if ga_tid is None:
         raise Exception("No valid tracker id found in ga_config.json > hostnameTrackerIDMapping")
 
+    return GA4_COLLECT_URL.format(m_tid=ga_tid, api_secret=ga4_secret), ga_cid
+
+
+def build_download_ga_event(context, request, filename, file_size_downloaded, file_at_id, submitter_title,
+                            user_uuid, user_groups, exp_or_assay_type, dataset, file_type='other'):
+    """ Returns the GA4 'purchase' event recording a download of filename """
     file_extension =  os.path.splitext(filename)[1][1:]
     item_types = [ty for ty in reversed(context.jsonld_type()[:-1])]
 
+    event = {
+        "name": "purchase",
+        "params": {
+            #"debug_mode": 1,
+            "name": filename,
+            "source": "Serverside File Download",
+            "action": "Range Query" if request.range else "File Download",
+            "file_name": filename,
+            "file_extension": file_extension,
+            "link_url": request.url,
+            "file_size": file_size_downloaded,
+            "downloads": 0 if request.range else 1,
+            "experiment_type": exp_or_assay_type or "None",
+            "dataset": dataset or "None",
+            "lab": submitter_title or "None",
+            # Product Category from @type, e.g. "File/FileProcessed"
+            "file_classification": "/".join(item_types),
+            "file_type": file_type,
+            "items": [
+                {
+                    "item_id": file_at_id,
+                    "item_name": filename,
+                    "item_category": item_types[0] if len(item_types) >= 1 else "Unknown",
+                    "item_category2": item_types[1] if len(item_types) >= 2 else "Unknown",
+                    "item_category3": item_types[2] if len(item_types) >= 3 else "Unknown",
+                    "item_category4": exp_or_assay_type or "None",
+                    "item_category5": dataset or "None",
+                    "item_brand": submitter_title or "None",
+                    "item_variant": file_type,
+                    "quantity": 1
+                }
+            ]
+        }
+    }
+
+    if user_uuid:
+        event['params']['user_uuid'] = user_uuid
+
+    if user_groups:
+        groups_json = json.dumps(user_groups, separators=(',', ':'))  # Compcact JSON; aligns w. what's passed from JS.
+        event['params']['user_groups'] = groups_json
+
+    return event
+
+
+def submit_ga_events(request, ga_config, events, user_uuid):
+    """ Queues download events (all from this request's user) as one GA4 payload """
+    ga_url, ga_cid = get_ga_collect_url_and_client_id(request, ga_config)
     ga_payload = {
         "client_id": ga_cid,
         "timestamp_micros": str(int(datetime.datetime.now().timestamp() * 1000000)),
         "non_personalized_ads": False,
-        "events": [
-            {
-                "name": "purchase",
-                "params": {
-                    #"debug_mode": 1,
-                    "name": filename,
-                    "source": "Serverside File Download",
-                    "action": "Range Query" if request.range else "File Download",
-                    "file_name": filename,
-                    "file_extension": file_extension,
-                    "link_url": request.url,
-                    "file_size": file_size_downloaded,
-                    "downloads": 0 if request.range else 1,
-                    "experiment_type": exp_or_assay_type or "None",
-                    "dataset": dataset or "None",
-                    "lab": submitter_title or "None",
-                    # Product Category from @type, e.g. "File/FileProcessed"
-                    "file_classification": "/".join(item_types),
-                    "file_type": file_type,
-                    "items": [
-                        {
-                            "item_id": file_at_id,
-                            "item_name": filename,
-                            "item_category": item_types[0] if len(item_types) >= 1 else "Unknown",
-                            "item_category2": item_types[1] if len(item_types) >= 2 else "Unknown",
-                            "item_category3": item_types[2] if len(item_types) >= 3 else "Unknown",
-                            "item_category4": exp_or_assay_type or "None",
-                            "item_category5": dataset or "None",
-                            "item_brand": submitter_title or "None",
-                            "item_variant": file_type,
-                            "quantity": 1
-                        }
-                    ]
-                }
-            }
-        ]
+        "events": events,
     }
 
     if user_uuid:
-        ga_payload['events'][0]['params']['user_uuid'] = user_uuid
         ga_payload['user_id'] = user_uuid
 
-    if user_groups:
-        groups_json = json.dumps(user_groups, separators=(',', ':'))  # Compcact JSON; aligns w. what's passed from JS.
-        ga_payload['events'][0]['params']['user_groups'] = groups_json
-
     # Catch error here
     try:
         def remove_none_fields(obj):
@@ -488,12 +1104,20 @@ def update_google_analytics(context, request, ga_config, filename, file_size_dow
             else:
                 return obj
 
-        _ = requests.post(
-            url="https://www.google-analytics.com/mp/collect?measurement_id={m_tid}&api_secret={api_secret}".format(m_tid=ga_tid, api_secret=ga4_secret),
-            data=json.dumps(remove_none_fields(ga_payload)),
-            verify=True)
+        # sent (batched with other downloads) by a background thread, so GA never delays the download
+        if not GA4_EVENT_DISPATCHER.submit(ga_url, remove_none_fields(ga_payload)):
+            log.warning('GA event queue is full - dropped %s download event(s)' % len(events))
     except Exception as e:
-        log.error('Exception encountered posting to GA: %s' % e)
+        log.error('Exception encountered queueing GA event: %s' % e)
+
+
+def update_google_analytics(context, request, ga_config, filename, file_size_downloaded,
+                            file_at_id, submitter_title, user_uuid, user_groups, exp_or_assay_type, dataset, file_type='other'):
+    """ Helper for @@download that updates GA in response to a download.
+    """
+    event = build_download_ga_event(context, request, filename, file_size_downloaded, file_at_id, submitter_title,
+                                    user_uuid, user_groups, exp_or_assay_type, dataset, file_type)
+    submit_ga_events(request, ga_config, [event], user_uuid)
 
 
 def validate_file_format_validity_for_file_type(context, request):
@@ -501,7 +1125,7 @@ def validate_file_format_validity_for_file_type(context, request):
     """
     data = request.json
     if 'file_format' in data:
-        file_format_item = get_item_or_none(request, data['file_format'], 'file-formats')
+        file_format_item = get_file_format(request, data['file_format'])
         if not file_format_item:
             # item level validation will take care of generating the error
             return
@@ -529,7 +1153,7 @@ def validate_file_filename(context, request):
     ff = data.get('file_format')
     if not ff:
         ff = context.properties.get('file_format')
-    file_format_item = get_item_or_none(request, ff, 'file-formats')
+    file_format_item = get_file_format(request, ff)
     if not file_format_item:
         msg = 'Problem getting file_format for %s' % filename
         request.errors.add('body', 'File: no format', msg)
@@ -634,7 +1258,7 @@ def validate_extra_file_format(context, request):
     ff = data.get('file_format')
     if not ff:
         ff = context.properties.get('file_format')
-    file_format_item = get_item_or_none(request, ff, 'file-formats')
+    file_format_item = get_file_format(request, ff)
     if not file_format_item or 'standard_file_extension' not in file_format_item:
         request.errors.add('body', 'File: no extra_file format', "Can't find parent file format for extra_files")
         return
@@ -649,7 +1273,7 @@ def validate_extra_file_format(context, request):
     else:
         valid_ext_formats = []
         for ok_format in allowed_extra_file_formats:
-            ok_format_item = get_item_or_none(request, ok_format, 'file-formats')
+            ok_format_item = get_file_format(request, ok_format)
             try:
                 off_uuid = ok_format_item.get('uuid')
             except AttributeError:
@@ -662,7 +1286,7 @@ def validate_extra_file_format(context, request):
         eformat = ef.get('file_format')
         if eformat is None:
             return  # will fail the required extra_file.file_format
-        eformat_item = get_item_or_none(request, eformat, 'file-formats')
+        eformat_item = get_file_format(request, eformat)
         try:
             ef_uuid = eformat_item.get('uuid')
         except AttributeError:
@@ -739,6 +1363,185 @@ def build_drs_object_from_props(drs_object_base, props):
     return drs_object_base
 
 
+# WorkflowRun links from a run to the files it read and wrote
+WORKFLOW_RUN_INPUT_REL = 'input_files.value'
+WORKFLOW_RUN_OUTPUT_REL = 'output_files.value'
+# how the file-run graph is followed from a file: (rel to a run from the file, rel from that run)
+PROVENANCE_DIRECTIONS = {
+    'upstream': (WORKFLOW_RUN_OUTPUT_REL, WORKFLOW_RUN_INPUT_REL),
+    'downstream': (WORKFLOW_RUN_INPUT_REL, WORKFLOW_RUN_OUTPUT_REL),
+}
+DEFAULT_PROVENANCE_DEPTH = 3
+MAX_PROVENANCE_DEPTH = 20
+DEFAULT_PROVENANCE_MAX_NODES = 1000
+MAX_PROVENANCE_NODES = 10000
+
+
+def provenance_node(request, item, direction, depth):
+    """ Compact description of a file or workflow run in a provenance graph """
+    properties = item.properties
+    node = {
+        'uuid': str(item.uuid),
+        '@id': request.resource_path(item),
+        'item_type': item.item_type,
+        'status': properties.get('status'),
+        'direction': direction,
+        'depth': depth,
+    }
+    for field in ('accession', 'workflow'):
+        if field in properties:
+            node[field] = properties[field]
+    return node
+
+
+class ProvenanceGraph(object):
+    """ Walks the bipartite graph of files and the workflow runs that read (input_files) and
+        wrote (output_files) them, starting from one file.
+
+        Each level reads the links from the files to their runs, then from the runs to their other
+        files, loading each item once - instead of rendering every file and run on the way. Items
+        are visited once, so cycles end; items the user cannot view, and files and runs with a
+        status in FILTERED_REV_STATUSES (deleted or replaced), are left out and not walked through.
+        The walk stops after max_depth runs in each direction, or once max_nodes items are in the
+        graph - 'truncated' is only set if a viewable item was left out for lack of room.
+    """
+
+    def __init__(self, request, root, max_depth=DEFAULT_PROVENANCE_DEPTH, max_nodes=DEFAULT_PROVENANCE_MAX_NODES):
+        self.request = request
+        self.root_uuid = str(root.uuid)
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+        self.nodes = OrderedDict([(self.root_uuid, provenance_node(request, root, 'root', 0))])
+        self.edges = []
+        self._edges_seen = set()
+        self.truncated = False
+
+    def _visible(self, item):
+        return (item.properties.get('status') not in FILTERED_REV_STATUSES
+                and self.request.has_permission('view', item))
+
+    def _add_nodes(self, uuids, direction, depth):
+        """ Adds the viewable items among uuids not in the graph yet, while there is room,
+            returning their uuids
+        """
+        new = [rid for rid in dict.fromkeys(uuids) if rid not in self.nodes]
+        added = []
+        for rid, item in iter_items(self.request, new):
+            if not self._visible(item):
+                continue
+            if len(self.nodes) >= self.max_nodes:
+                self.truncated = True
+                break
+            self.nodes[rid] = provenance_node(self.request, item, direction, depth)
+            added.append(rid)
+        return added
+
+    def _add_edge(self, run, rel, file_uuid):
+        # edges follow the data: input file -> run -> output file
+        if rel == WORKFLOW_RUN_INPUT_REL:
+            edge = (file_uuid, run, 'input')
+        else:
+            edge = (run, file_uuid, 'output')
+        if edge not in self._edges_seen:
+            self._edges_seen.add(edge)
+            self.edges.append(edge)
+
+    def walk(self, direction):
+        to_run, from_run = PROVENANCE_DIRECTIONS[direction]
+        files = [self.root_uuid]
+        for depth in range(1, self.max_depth + 1):
+            if not files or self.truncated:
+                return
+            links = get_links(self.request, files, [to_run], reverse=True)
+            runs = self._add_nodes([run for run, _, _ in links], direction, depth)
+            for run, rel, file_uuid in links:
+                self._add_edge(run, rel, file_uuid)
+            links = get_links(self.request, runs, [from_run])
+            files = self._add_nodes([file_uuid for _, _, file_uuid in links], direction, depth)
+            for run, rel, file_uuid in links:
+                self._add_edge(run, rel, file_uuid)
+
+    def as_dict(self):
+        return {
+            'nodes': list(self.nodes.values()),
+            # only between items in the graph - links to items left out are dropped
+            'edges': [{'source': source, 'target': target, 'relationship': relationship}
+                      for source, target, relationship in self.edges
+                      if source in self.nodes and target in self.nodes],
+            'truncated': self.truncated,
+        }
+
+
+def get_int_param_in_range(request, name, default, maximum):
+    """ Reads the integer query parameter name (default if absent), which must be from 1 to maximum """
+    try:
+        value = int(request.params.get(name, default))
+    except ValueError:
+        raise HTTPBadRequest(f'{name} must be an integer')
+    if not 0 < value <= maximum:
+        raise HTTPBadRequest(f'{name} must be between 1 and {maximum}')
+    return value
+
+
+@view_config(name='provenance', context=File, request_method='GET', permission='view')
+@debug_log
+def provenance(context, request):
+    """ Returns the lineage of the file as a graph of files and workflow runs: ?direction=upstream
+        for what it was produced from, downstream for what was produced from it, or both (default).
+        ?depth= limits the number of runs followed in each direction and ?max_nodes= the graph size;
+        'truncated' is true if the latter cut the walk short.
+    """
+    direction = request.params.get('direction', 'both')
+    if direction not in ('both', *PROVENANCE_DIRECTIONS):
+        raise HTTPBadRequest('direction must be one of upstream, downstream or both')
+    graph = ProvenanceGraph(
+        request, context,
+        max_depth=get_int_param_in_range(request, 'depth', DEFAULT_PROVENANCE_DEPTH, MAX_PROVENANCE_DEPTH),
+        max_nodes=get_int_param_in_range(request, 'max_nodes', DEFAULT_PROVENANCE_MAX_NODES, MAX_PROVENANCE_NODES))
+    for walk_direction in PROVENANCE_DIRECTIONS:
+        if direction in ('both', walk_direction):
+            graph.walk(walk_direction)
+    return dict(graph.as_dict(), **{'@id': request.resource_path(context), 'direction': direction})
+
+
+DEFAULT_WORKFLOW_RUNS_PAGE_SIZE = 100
+MAX_WORKFLOW_RUNS_PAGE_SIZE = 1000
+
+
+@view_config(name='workflow_runs', context=File, request_method='GET', permission='view')
+@debug_log
+def workflow_runs(context, request):
+    """ Pages through every workflow run that takes the file as input (?rel=inputs, the default)
+        or produced it (?rel=outputs) - the full lists behind the capped workflow_run_inputs and
+        workflow_run_outputs properties. Use ?from= and ?limit= to page; 'next' links the next page.
+    """
+    rel = request.params.get('rel', 'inputs')
+    rev_name = 'workflow_run_' + rel
+    if rel not in ('inputs', 'outputs') or rev_name not in context.rev:
+        raise HTTPBadRequest(f'{context.item_type} has no workflow runs for rel={rel}')
+    try:
+        offset = int(request.params.get('from', 0))
+    except ValueError:
+        raise HTTPBadRequest('from must be an integer')
+    if offset < 0:
+        raise HTTPBadRequest('from must not be negative')
+    limit = get_int_param_in_range(request, 'limit', DEFAULT_WORKFLOW_RUNS_PAGE_SIZE, MAX_WORKFLOW_RUNS_PAGE_SIZE)
+    rev_uuids = context.filtered_rev_link_uuids(request, rev_name)
+    conn = request.registry[CONNECTION]
+    at_id = request.resource_path(context)
+    result = {
+        '@id': at_id,
+        'rel': rel,
+        'total': len(rev_uuids),
+        'from': offset,
+        'limit': limit,
+        '@graph': [request.resource_path(conn[rev_id]) for rev_id in rev_uuids[offset:offset + limit]],
+    }
+    if offset + limit < len(rev_uuids):
+        result['next'] = f'{at_id}@@workflow_runs?rel={rel}&from={offset + limit}&limit={limit}'
+    return result
+
+
 @view_config(name='drs', context=File, request_method='GET',
              permission='view', subpath_segments=[0, 1])
 def drs(context, request):
@@ -782,9 +1585,22 @@ def drs(context, request):
              request_param=['validate=false'])
 @debug_log
 def file_add(context, request, render=None):
+    prefetch_file_add_creds(context, request)
     return collection_add(context, request, render)
 
 
+def prefetch_file_add_creds(context, request):
+    """ Mints the upload credentials of the file (and its extra files) being added concurrently,
+        before collection_add makes any writes - as @@upload_credentials does for many files.
+        The uuid is chosen here, rather than by create_item, so their keys are known.
+    """
+    if asbool(request.params.get('check_only', False)):
+        return
+    properties = request.validated
+    properties.setdefault('uuid', str(uuid.uuid4()))
+    prefetch_upload_creds(request.registry, [(context.type_info.factory, properties['uuid'], properties)])
+
+
 @view_config(context=File, permission='edit', request_method='PUT',
              validators=[validate_item_content_put,
                          validate_file_filename,
@@ -8,7 +8,7 @@ from pyramid.httpexceptions import (
     HTTPTemporaryRedirect,
     HTTPNotFound,
 )
-from snovault.util import build_s3_presigned_get_url
+from .s3_utils import build_s3_presigned_get_url
 from .types.quality_metric import QualityMetric
 
 
@@ -72,7 +72,7 @@ def download(context, request):
         'Bucket': bucket,
         'Key': key
     }
-    location = build_s3_presigned_get_url(params=params_to_get_obj)
+    location = build_s3_presigned_get_url(params=params_to_get_obj, registry=request.registry)
 
     if asbool(request.params.get('soft')):
         expires = int(parse_qs(urlparse(location).query)['Expires'][0])
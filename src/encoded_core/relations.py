@@ -0,0 +1,160 @@
+import datetime
+import structlog
+import transaction
+from collections import OrderedDict
+from copy import deepcopy
+from pyramid.threadlocal import get_current_request
+from snovault.elasticsearch.interfaces import ELASTIC_SEARCH, INDEXER_QUEUE, INDEXER_QUEUE_MIRROR
+from snovault.schema_utils import validate
+from snovault.validation import ValidationFailure
+
+
+log = structlog.getLogger(__name__)
+
+
+def queue_for_indexing(success, registry, items, skip_indexing=False):
+    """ Batched equivalent of snovault.invalidation.add_to_indexing_queue, for use as an
+        after-commit hook: queues items (dicts with uuid and sid) to be reindexed as edits
+        in one send_messages call, instead of one hook and one call per item
+    """
+    if not success:
+        log.error('DB transaction not successful! %s not queued for indexing'
+                  % [item['uuid'] for item in items])
+        return
+    if skip_indexing or not items:
+        return
+    timestamp = datetime.datetime.utcnow().isoformat()
+    items = [dict(item, strict=False, method='PATCH', timestamp=timestamp) for item in items]
+    try:
+        indexer_queue = registry.get(INDEXER_QUEUE)
+        if indexer_queue:
+            indexer_queue.send_messages(items, target_queue='primary')
+            indexer_queue_mirror = registry.get(INDEXER_QUEUE_MIRROR)
+            if indexer_queue_mirror:
+                indexer_queue_mirror.send_messages(items, target_queue='primary')
+        elif registry.get(ELASTIC_SEARCH):
+            # if the indexer queue is not configured but ES is, log an error
+            raise Exception('Indexer queue not configured!')
+    except Exception as e:
+        log.error('___Error queueing %s for indexing. Error: %r' % (items, e))
+
+
+class ReciprocalRelations(object):
+    """ Keeps a two-way relation field (e.g. File related_files) symmetric: for each relation
+        an item is saved with, the target item gets the reverse relation pointing back.
+
+        Reverse relations are collected for the whole transaction instead of being written as
+        each item is saved. Each target is checked as the relations are collected, while the
+        request can still fail with a 422: it must exist, and must still validate with its
+        missing reverse relations added. Just before the transaction commits, each target is
+        written once with all of them, and only if any are missing. Writing a target only
+        records its own reverse relations in turn, so there is no recursion and cycles end as
+        soon as every relation has its reverse. The targets written are queued for reindexing
+        in one batch after the commit, and never if it aborts.
+    """
+
+    def __init__(self, collection_name, field, link, reverse_types):
+        self.collection_name = collection_name
+        self.field = field
+        self.link = link
+        self.reverse_types = reverse_types
+
+    def _pending(self, registry):
+        """ Returns the reverse relations collected in the current transaction, registering
+            the hook that writes them on first use
+        """
+        txn = transaction.get()
+        try:
+            return txn.data(self)
+        except KeyError:
+            request = get_current_request()
+            pending = {
+                'registry': registry,
+                'skip_indexing': bool(request is not None and request.params.get('skip_indexing')),
+                'targets': OrderedDict(),
+                'written': OrderedDict(),
+            }
+            txn.set_data(self, pending)
+            txn.addBeforeCommitHook(self.apply, args=(pending,))
+            return pending
+
+    def add(self, item, relations):
+        """ Records the reverse of each of relations (item's value for field) to be written
+            to its target when the transaction commits.
+            Raises ValidationFailure if a target is missing or would not validate with them.
+        """
+        pending = self._pending(item.registry)
+        collection = item.registry['collections'][self.collection_name]
+        source = str(item.uuid)
+        for relation in relations:
+            try:
+                reverse_type = self.reverse_types[relation['relationship_type']]
+                target = str(relation[self.link])
+            except (KeyError, TypeError):
+                log.error('Error updating %s on %s _update. %s' % (self.field, source, relation))
+                continue
+            entry = {'relationship_type': reverse_type, self.link: source}
+            entries = pending['targets'].get(target, [])
+            if entry in entries:
+                continue
+            target_item = collection.get(target)
+            if target_item is None:
+                raise ValidationFailure('body', [self.field], 'Cannot add reverse %s to missing item %s'
+                                        % (self.field, target))
+            self.validate_target(target_item, entries + [entry])
+            pending['targets'][target] = entries + [entry]
+
+    def has_relation(self, relations, entry):
+        """ Whether relations already has entry: a relation back to the same item, of the same type """
+        for relation in relations:
+            if (relation.get(self.link) == entry[self.link]
+                    and relation.get('relationship_type') == entry['relationship_type']):
+                return True
+        return False
+
+    def with_missing(self, properties, entries):
+        """ Returns properties with those of entries it has no relation for added to field,
+            or None if none are missing
+        """
+        current = properties.get(self.field, [])
+        missing = [entry for entry in entries if not self.has_relation(current, entry)]
+        if not missing:
+            return None
+        return dict(properties, **{self.field: current + missing})
+
+    def validate_target(self, item, entries):
+        """ Raises ValidationFailure if item would not validate with entries added to field """
+        current = item.upgrade_properties()
+        properties = self.with_missing(current, entries)
+        if properties is None:
+            return
+        _, errors = validate(item.type_info.schema, properties, current=current)
+        if errors:
+            raise ValidationFailure('body', [self.field], 'Cannot add reverse %s to %s: %s' % (
+                self.field, item.uuid, '; '.join(error.message for error in errors)))
+
+    def apply(self, pending):
+        """ Before-commit hook: writes each target once with all of its missing reverse relations.
+            The targets were validated as the relations were added, in the request.
+        """
+        collection = pending['registry']['collections'][self.collection_name]
+        targets = pending['targets']
+        while targets:
+            target, entries = targets.popitem(last=False)
+            item = collection.get(target)
+            if item is None:
+                log.error('Cannot add reverse %s to missing item %s: %s' % (self.field, target, entries))
+                continue
+            # checked by add() - all that is left is the write
+            properties = self.with_missing(deepcopy(item.upgrade_properties()), entries)
+            if properties is None:
+                continue
+            # may record further reverse relations (from the target's own field) for this loop
+            item.update(properties)
+            pending['written'][str(item.uuid)] = item.sid
+        if pending['written']:
+            to_queue = [{'uuid': uuid, 'sid': sid, 'info': 'queued from reverse %s' % self.field}
+                        for uuid, sid in pending['written'].items()]
+            pending['written'] = OrderedDict()
+            transaction.get().addAfterCommitHook(
+                queue_for_indexing, args=(pending['registry'], to_queue, pending['skip_indexing']))
@@ -0,0 +1,571 @@
+import atexit
+import boto3
+import os
+import structlog
+import threading
+import time
+import transaction
+from botocore.client import Config
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dcicutils.ecs_utils import ECSUtils
+from dcicutils.secrets_utils import assume_identity
+from pyramid.settings import asbool
+from .background import BackgroundQueue
+
+
+log = structlog.getLogger(__name__)
+
+
+# Registry settings controlling the shared S3 client
+S3_MAX_POOL_CONNECTIONS_SETTING = 's3.max_pool_connections'
+S3_TCP_KEEPALIVE_SETTING = 's3.tcp_keepalive'
+S3_CLIENT_TTL_SETTING = 's3.client_ttl'
+DEFAULT_S3_MAX_POOL_CONNECTIONS = 50
+# The shared client is rebuilt this often (seconds), so rotated IDENTITY keys are picked up
+DEFAULT_S3_CLIENT_TTL = 60 * 60
+
+PRESIGNED_URL_EXPIRATION = 36 * 60 * 60
+# A cached presigned URL is only handed out again while it has at least this long left
+PRESIGNED_URL_MIN_REMAINING_LIFETIME = 24 * 60 * 60
+PRESIGNED_URL_CACHE_SIZE = 10000
+
+# Ranged GETs of at most RANGE_CACHE_MAX_ITEM_BYTES (index files, BAM headers) are cached
+RANGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RANGE_CACHE_MAX_ITEM_BYTES = 1024 * 1024
+RANGE_CACHE_MAX_AGE = 5 * 60
+
+# Multi-range downloads fetch their parts concurrently on a shared, bounded pool
+S3_RANGE_FETCH_WORKERS_SETTING = 's3.range_fetch_workers'
+DEFAULT_S3_RANGE_FETCH_WORKERS = 8
+
+
+def get_credentials_lifetime(credentials, maximum, resolution=60):
+    """ Returns for how many more seconds botocore credentials stay valid, capped at maximum and
+        rounded down to resolution - using only their public refresh_needed(). Static keys do not
+        expire, so last maximum; missing credentials last 0.
+    """
+    if credentials is None:
+        return 0
+    refresh_needed = getattr(credentials, 'refresh_needed', None)
+    if refresh_needed is None or not refresh_needed(maximum):
+        return maximum
+    low, high = 0, maximum  # valid for at least low seconds, but not for high
+    while high - low > resolution:
+        middle = (low + high) // 2
+        if refresh_needed(middle):
+            high = middle
+        else:
+            low = middle
+    return low
+
+
+class S3ClientPool(object):
+    """ Holds one S3 client per process, shared by all request threads.
+
+        boto3 clients are thread-safe, so instead of building a new client (endpoint data,
+        credential chain and connection pool) per request, every caller shares this one and
+        its pool of up to max_pool_connections keep-alive connections. A forked worker
+        process builds its own client on first use rather than inheriting the parent's sockets.
+        The client is rebuilt, with freshly read credentials, once it is older than the
+        s3.client_ttl setting or its credentials have expired.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._credentials = None
+        self._pid = None
+        self._built_at = None
+        self.ttl = DEFAULT_S3_CLIENT_TTL
+        self.constructions = 0
+        self.reuses = 0
+
+    @staticmethod
+    def make_client(max_pool_connections=DEFAULT_S3_MAX_POOL_CONNECTIONS, tcp_keepalive=True):
+        """ Equivalent of snovault.util.make_s3_client, with connection pool configuration.
+            Returns the client and the (botocore) credentials it signs with.
+        """
+        session_args = {}
+        config_args = {'max_pool_connections': max_pool_connections, 'tcp_keepalive': tcp_keepalive}
+        if 'IDENTITY' in os.environ:
+            identity = assume_identity()
+            session_args['aws_access_key_id'] = identity.get('S3_AWS_ACCESS_KEY_ID')
+            session_args['aws_secret_access_key'] = identity.get('S3_AWS_SECRET_ACCESS_KEY')
+            session_args['region_name'] = ECSUtils.REGION
+            if 'ENCODED_S3_ENCRYPT_KEY_ID' in identity:
+                # This setting is required when testing locally and encrypted buckets need to be accessed.
+                config_args['signature_version'] = 's3v4'
+        session = boto3.session.Session(**session_args)
+        return session.client('s3', config=Config(**config_args)), session.get_credentials()
+
+    def _stale(self):
+        if time.time() - self._built_at >= self.ttl:
+            return True
+        # without credentials (e.g. public buckets) there is nothing to expire
+        return self._credentials is not None and get_credentials_lifetime(self._credentials, 1, resolution=1) == 0
+
+    def get_client(self, registry=None):
+        """ Returns the shared S3 client, building it on first use in this process and again
+            whenever it is stale. Pool settings are read from registry settings when it is built.
+        """
+        pid = os.getpid()
+        with self._lock:
+            if self._client is not None and self._pid == pid and not self._stale():
+                self.reuses += 1
+                return self._client
+            settings = registry.settings if registry is not None else {}
+            self._client, self._credentials = self.make_client(
+                max_pool_connections=int(settings.get(S3_MAX_POOL_CONNECTIONS_SETTING,
+                                                      DEFAULT_S3_MAX_POOL_CONNECTIONS)),
+                tcp_keepalive=asbool(settings.get(S3_TCP_KEEPALIVE_SETTING, True)),
+            )
+            self.ttl = int(settings.get(S3_CLIENT_TTL_SETTING, DEFAULT_S3_CLIENT_TTL))
+            self._pid = pid
+            self._built_at = time.time()
+            self.constructions += 1
+            log.info('Built shared S3 client', pid=pid, constructions=self.constructions)
+            return self._client
+
+    def signing_lifetime(self, maximum):
+        """ Returns for how many more seconds (at most maximum) the credentials the shared client
+            signs with stay valid - and so any URL it presigns now - or None if it has none.
+            A presigned URL stops working when those credentials expire, whatever its ExpiresIn.
+        """
+        with self._lock:
+            credentials = self._credentials
+        if credentials is None:
+            return None
+        return get_credentials_lifetime(credentials, maximum)
+
+    def clear(self):
+        with self._lock:
+            self._client = None
+            self._credentials = None
+            self._pid = None
+            self._built_at = None
+            self.constructions = self.reuses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'constructions': self.constructions,
+                'reuses': self.reuses,
+            }
+
+
+S3_CLIENT_POOL = S3ClientPool()
+
+
+class PresignedUrlCache(object):
+    """ LRU cache of presigned S3 GET URLs, keyed by bucket, key, content disposition and Range.
+
+        Genome browsers and soft redirect polling download the same objects over and over;
+        signing is cheap but not free, and reusing the URL also lets clients and proxies
+        reuse whatever they cached for it. A URL is reused only while it has at least
+        min_remaining_lifetime seconds left, so clients always get a usable link.
+    """
+
+    def __init__(self, max_size=PRESIGNED_URL_CACHE_SIZE, min_remaining_lifetime=PRESIGNED_URL_MIN_REMAINING_LIFETIME):
+        self.max_size = max_size
+        self.min_remaining_lifetime = min_remaining_lifetime
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(params):
+        return (params.get('Bucket'), params.get('Key'),
+                params.get('ResponseContentDisposition'), params.get('Range'))
+
+    def get(self, params):
+        cache_key = self.make_key(params)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and entry[0] - time.time() >= self.min_remaining_lifetime:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[cache_key]
+            self.misses += 1
+            return None
+
+    def put(self, params, url, expires_at):
+        cache_key = self.make_key(params)
+        with self._lock:
+            self._entries[cache_key] = (expires_at, url)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
+
+
+PRESIGNED_URL_CACHE = PresignedUrlCache()
+
+
+def get_s3_client(registry=None):
+    """ Returns the process-wide shared S3 client - use instead of snovault.util.make_s3_client """
+    return S3_CLIENT_POOL.get_client(registry)
+
+
+def build_s3_presigned_get_url(*, params, registry=None):
+    """ Equivalent of snovault.util.build_s3_presigned_get_url, using the shared S3 client
+        and reusing a previously signed URL for the same params from PRESIGNED_URL_CACHE
+    """
+    location = PRESIGNED_URL_CACHE.get(params)
+    if location is None:
+        client = get_s3_client(registry)
+        location = client.generate_presigned_url(
+            ClientMethod='get_object',
+            Params=params,
+            ExpiresIn=PRESIGNED_URL_EXPIRATION
+        )
+        lifetime = S3_CLIENT_POOL.signing_lifetime(PRESIGNED_URL_EXPIRATION)
+        if lifetime is not None:  # without credentials, we cannot tell how long it will work
+            PRESIGNED_URL_CACHE.put(params, location, time.time() + lifetime)
+    return location
+
+
+class _InFlightFetch(object):
+    """ A fetch in progress that other threads asking for the same range can wait on """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class S3RangeCache(object):
+    """ Serves small ranged S3 GETs (e.g. IGV/HiGlass reads of .bai/.tbi/.crai files and BAM
+        headers) from memory.
+
+        Concurrent requests for the same (bucket, key, range) share a single S3 fetch, and
+        results of at most max_item_bytes are kept in an LRU bounded by max_bytes in total.
+        Entries expire after max_age seconds so a re-uploaded object is picked up.
+    """
+
+    def __init__(self, max_bytes=RANGE_CACHE_MAX_BYTES, max_item_bytes=RANGE_CACHE_MAX_ITEM_BYTES,
+                 max_age=RANGE_CACHE_MAX_AGE):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def cacheable(self, length):
+        """ Whether a range of the given length (None if unknown) should go through the cache """
+        return length is not None and 0 < length <= self.max_item_bytes
+
+    @staticmethod
+    def make_key(params):
+        return params['Bucket'], params['Key'], params.get('Range')
+
+    @staticmethod
+    def fetch(client, params):
+        response = client.get_object(**params)
+        body = response['Body']
+        try:
+            data = body.read()
+        finally:
+            body.close()
+        return {
+            'body': data,
+            'status_code': response['ResponseMetadata']['HTTPStatusCode'],
+            'accept_ranges': response.get('AcceptRanges'),
+            'content_length': len(data),
+            'content_range': response.get('ContentRange'),
+        }
+
+    def _store(self, cache_key, result):
+        n_bytes = len(result['body'])
+        if n_bytes > self.max_item_bytes:
+            return
+        old = self._entries.pop(cache_key, None)
+        if old is not None:
+            self.size -= len(old[1]['body'])
+        self._entries[cache_key] = (time.time(), result)
+        self.size += n_bytes
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted['body'])
+            self.evictions += 1
+
+    def get(self, client, params):
+        """ Returns the get_object result for params as a dict of body bytes and response
+            metadata, from the cache, from a concurrent identical fetch, or from S3
+        """
+        cache_key = self.make_key(params)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and time.time() - entry[0] < self.max_age:
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[1]
+            in_flight = self._in_flight.get(cache_key)
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight[cache_key] = _InFlightFetch()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+        try:
+            in_flight.result = self.fetch(client, params)
+            return in_flight.result
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[cache_key]
+                if in_flight.result is not None:
+                    self._store(cache_key, in_flight.result)
+            in_flight.done.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = self.hits = self.misses = self.coalesced = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.size,
+            }
+
+
+S3_RANGE_CACHE = S3RangeCache()
+
+
+_range_fetch_executor = None
+_range_fetch_executor_pid = None
+_range_fetch_executor_lock = threading.Lock()
+
+
+def get_range_fetch_executor(registry=None):
+    """ Returns the process-wide thread pool used to open the parts of multi-range downloads """
+    global _range_fetch_executor, _range_fetch_executor_pid
+    pid = os.getpid()
+    with _range_fetch_executor_lock:
+        if _range_fetch_executor is None or _range_fetch_executor_pid != pid:
+            settings = registry.settings if registry is not None else {}
+            _range_fetch_executor = ThreadPoolExecutor(
+                max_workers=int(settings.get(S3_RANGE_FETCH_WORKERS_SETTING, DEFAULT_S3_RANGE_FETCH_WORKERS)),
+                thread_name_prefix='s3-range-fetch')
+            _range_fetch_executor_pid = pid
+        return _range_fetch_executor
+
+
+def open_s3_ranges(client, params, range_headers, registry=None):
+    """ Issues one get_object per Range header concurrently and returns the responses in the
+        same order. Bodies are left unread so the caller can stream them one after another;
+        if any request fails, the bodies that were opened are closed and the error re-raised.
+    """
+    executor = get_range_fetch_executor(registry)
+    futures = [executor.submit(client.get_object, **dict(params, Range=range_header))
+               for range_header in range_headers]
+    responses, error = [], None
+    for future in futures:
+        try:
+            responses.append(future.result())
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        for response in responses:
+            response['Body'].close()
+        raise error
+    return responses
+
+
+# S3 multipart upload limits (every part but the last must be at least the minimum size)
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+MULTIPART_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MULTIPART_MAX_PARTS = 10000
+MULTIPART_PART_URL_EXPIRATION = 24 * 60 * 60
+
+
+def plan_multipart_upload(file_size, part_size):
+    """ Returns the number of parts needed to upload file_size bytes in parts of part_size,
+        raising ValueError if that breaks S3's multipart limits
+    """
+    if not isinstance(file_size, int) or file_size <= 0:
+        raise ValueError('file_size must be a positive integer')
+    if not isinstance(part_size, int) or not MULTIPART_MIN_PART_SIZE <= part_size <= MULTIPART_MAX_PART_SIZE:
+        raise ValueError(f'part_size must be between {MULTIPART_MIN_PART_SIZE} and {MULTIPART_MAX_PART_SIZE} bytes')
+    n_parts = -(-file_size // part_size)
+    if n_parts > MULTIPART_MAX_PARTS:
+        raise ValueError(f'part_size too small - {file_size} bytes would take more than {MULTIPART_MAX_PARTS} parts')
+    return n_parts
+
+
+def presign_upload_parts(client, bucket, key, upload_id, part_numbers, expires_in=None):
+    """ Returns a presigned PUT URL for each of the given part numbers of a multipart upload.
+        Unless expires_in is given, the URLs last MULTIPART_PART_URL_EXPIRATION seconds, or only
+        as long as the credentials of the shared client stay valid if they expire sooner.
+    """
+    if expires_in is None:
+        lifetime = S3_CLIENT_POOL.signing_lifetime(MULTIPART_PART_URL_EXPIRATION)
+        expires_in = MULTIPART_PART_URL_EXPIRATION if lifetime is None else max(lifetime, 1)
+    return [{
+        'part_number': part_number,
+        'url': client.generate_presigned_url(
+            ClientMethod='upload_part',
+            Params={'Bucket': bucket, 'Key': key, 'UploadId': upload_id, 'PartNumber': part_number},
+            ExpiresIn=expires_in
+        ),
+    } for part_number in part_numbers]
+
+
+def list_uploaded_parts(client, bucket, key, upload_id):
+    """ Returns the parts S3 has received for a multipart upload, as dicts of part_number, etag and size """
+    parts = []
+    for page in client.get_paginator('list_parts').paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+        parts.extend({'part_number': part['PartNumber'], 'etag': part['ETag'], 'size': part['Size']}
+                     for part in page.get('Parts', []))
+    return parts
+
+
+# delete_objects takes at most 1000 keys per request
+S3_DELETE_OBJECTS_MAX_KEYS = 1000
+
+
+class S3DeletionQueue(BackgroundQueue):
+    """ Deletes S3 objects superseded by committed edits (e.g. the old key of a File whose
+        format changed) from a background thread, so PATCH requests never wait on S3.
+
+        delete_after_commit() only queues a key once the current transaction commits - a
+        rolled back edit still points at its object, so nothing is deleted for it. The worker
+        takes whatever is queued and deletes it per bucket in delete_objects requests of up to
+        1000 keys. Keys that fail are retried up to max_attempts times with exponential backoff,
+        then logged and kept (bounded) on .failed_keys.
+        * The queue is bounded (see BackgroundQueue): when it is full, keys are dropped, leaving
+          the objects in place rather than blocking the commit.
+        * Queued keys are deleted when the process exits.
+    """
+
+    worker_name = 's3-deletion-queue'
+
+    def __init__(self, max_queue_size=100000, max_attempts=4, backoff=0.5, shutdown_timeout=30,
+                 max_failed_keys=1000):
+        super(S3DeletionQueue, self).__init__(max_queue_size, shutdown_timeout)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.failed_keys = deque(maxlen=max_failed_keys)
+        self.queued = 0
+        self.deleted = 0
+        self.failed = 0
+        self.retries = 0
+        self.requests = 0
+
+    def delete_after_commit(self, registry, bucket, key):
+        """ Deletes bucket/key in the background if, and once, the current transaction commits """
+        transaction.get().addAfterCommitHook(self._after_commit, args=(registry, bucket, key))
+
+    def _after_commit(self, status, registry, bucket, key):
+        if status:
+            self.submit(registry, bucket, key)
+
+    def submit(self, registry, bucket, key):
+        """ Queues bucket/key for deletion now. Returns False if it was dropped. """
+        if not self._put((registry, bucket, key)):
+            log.error('S3 deletion queue full, not deleting s3://%s/%s' % (bucket, key))
+            return False
+        with self._lock:
+            self.queued += 1
+        return True
+
+    def _dispatch(self, batch):
+        by_bucket = OrderedDict()
+        for registry, bucket, key in batch:
+            registry_and_keys = by_bucket.setdefault(bucket, (registry, []))
+            if key not in registry_and_keys[1]:
+                registry_and_keys[1].append(key)
+        for bucket, (registry, keys) in by_bucket.items():
+            self.delete_keys(get_s3_client(registry), bucket, keys)
+
+    def delete_keys(self, client, bucket, keys):
+        """ Deletes keys from bucket in as few delete_objects requests as possible, retrying
+            the keys that fail. Returns {key: error} for those still failing after max_attempts.
+        """
+        pending, errors = list(keys), {}
+        for attempt in range(self.max_attempts):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                with self._lock:
+                    self.retries += len(pending)
+            errors = {}
+            for i in range(0, len(pending), S3_DELETE_OBJECTS_MAX_KEYS):
+                chunk = pending[i:i + S3_DELETE_OBJECTS_MAX_KEYS]
+                try:
+                    response = client.delete_objects(Bucket=bucket, Delete={
+                        'Objects': [{'Key': key} for key in chunk], 'Quiet': True})
+                except Exception as e:
+                    errors.update((key, str(e)) for key in chunk)
+                    chunk_errors = len(chunk)
+                else:
+                    chunk_errors = 0
+                    for error in response.get('Errors', []):
+                        errors[error['Key']] = '%s: %s' % (error.get('Code'), error.get('Message'))
+                        chunk_errors += 1
+                with self._lock:
+                    self.requests += 1
+                    self.deleted += len(chunk) - chunk_errors
+            pending = list(errors)
+            if not pending:
+                break
+        for key, error in errors.items():
+            log.error('Could not delete superseded object s3://%s/%s: %s' % (bucket, key, error))
+        with self._lock:
+            self.failed += len(errors)
+            self.failed_keys.extend((bucket, key, error) for key, error in errors.items())
+        return errors
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self.queued,
+                'deleted': self.deleted,
+                'failed': self.failed,
+                'retries': self.retries,
+                'requests': self.requests,
+                'dropped_queue_full': self.dropped_queue_full,
+                'pending': self.qsize(),
+            }
+
+
+S3_DELETION_QUEUE = S3DeletionQueue()
+atexit.register(S3_DELETION_QUEUE.shutdown)
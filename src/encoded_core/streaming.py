@@ -0,0 +1,245 @@
+import queue
+import structlog
+import threading
+import time
+import tracemalloc
+
+
+log = structlog.getLogger(__name__)
+
+
+# Registry settings for streaming proxied S3 bodies (see file_views.iter_s3_body)
+READ_AHEAD_SETTING = 'download.read_ahead'
+READ_AHEAD_DEPTH_SETTING = 'download.read_ahead_depth'
+READ_AHEAD_CHUNK_SIZE_SETTING = 'download.read_ahead_chunk_size'
+ZERO_COPY_SETTING = 'download.zero_copy'
+DEFAULT_STREAM_CHUNK_SIZE = 1024 * 1024
+DEFAULT_READ_AHEAD_DEPTH = 4
+
+
+def readinto_or_read(stream, buffer):
+    """ Fills buffer from stream, in place if the stream supports readinto.
+        Returns the number of bytes read (0 at end of stream).
+    """
+    readinto = getattr(stream, 'readinto', None)
+    if readinto is not None:
+        return readinto(buffer) or 0
+    chunk = stream.read(len(buffer))
+    buffer[:len(chunk)] = chunk
+    return len(chunk)
+
+
+class StreamMetrics(object):
+    """ Process-wide totals over all read-ahead streams, for monitoring """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.streams = 0
+            self.bytes = 0
+            self.seconds = 0.0
+            self.reader_stalls = 0
+            self.reader_stall_seconds = 0.0
+            self.writer_stalls = 0
+            self.writer_stall_seconds = 0.0
+
+    def record(self, stream_stats):
+        with self._lock:
+            self.streams += 1
+            self.bytes += stream_stats['bytes']
+            self.seconds += stream_stats['seconds']
+            self.reader_stalls += stream_stats['reader_stalls']
+            self.reader_stall_seconds += stream_stats['reader_stall_seconds']
+            self.writer_stalls += stream_stats['writer_stalls']
+            self.writer_stall_seconds += stream_stats['writer_stall_seconds']
+
+    def stats(self):
+        with self._lock:
+            return {
+                'streams': self.streams,
+                'bytes': self.bytes,
+                'bytes_per_second': self.bytes / self.seconds if self.seconds else 0.0,
+                'reader_stalls': self.reader_stalls,
+                'reader_stall_seconds': self.reader_stall_seconds,
+                'writer_stalls': self.writer_stalls,
+                'writer_stall_seconds': self.writer_stall_seconds,
+            }
+
+
+READ_AHEAD_METRICS = StreamMetrics()
+
+
+class ReadAheadStream(object):
+    """ WSGI app_iter that reads an S3 body stream on a background thread while the previous
+        chunks are written to the client, instead of alternating between the two.
+
+        The reader fills a ring of `depth` preallocated buffers of `chunk_size` bytes, which are
+        recycled as the client consumes them, so at most depth * chunk_size bytes are held per
+        stream. With copy=False the buffers themselves are yielded as memoryviews (see
+        ZeroCopyStream for when that is safe). Per-stream stats are kept on .stats and added to READ_AHEAD_METRICS when done:
+            * reader stalls - the reader had to wait for a free buffer (client is the bottleneck)
+            * writer stalls - the client side had to wait for data (S3 is the bottleneck)
+    """
+
+    def __init__(self, stream, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, depth=DEFAULT_READ_AHEAD_DEPTH, copy=True):
+        self.stream = stream
+        self.copy = copy
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for _ in range(max(depth, 1)):
+            self._free.put(bytearray(chunk_size))
+        self._closed = False
+        self._started = time.time()
+        self.stats = {
+            'bytes': 0,
+            'seconds': 0.0,
+            'reader_stalls': 0,
+            'reader_stall_seconds': 0.0,
+            'writer_stalls': 0,
+            'writer_stall_seconds': 0.0,
+        }
+        self._reader = threading.Thread(target=self._read, name='s3-read-ahead', daemon=True)
+        self._reader.start()
+
+    @staticmethod
+    def _timed_get(q, stall_key, stats):
+        try:
+            return q.get_nowait()
+        except queue.Empty:
+            started = time.time()
+            item = q.get()
+            stats[stall_key + 's'] += 1
+            stats[stall_key + '_seconds'] += time.time() - started
+            return item
+
+    def _read(self):
+        try:
+            while True:
+                buffer = self._timed_get(self._free, 'reader_stall', self.stats)
+                if buffer is None or self._closed:
+                    return
+                n_read = readinto_or_read(self.stream, buffer)
+                if not n_read:
+                    self._filled.put(None)
+                    return
+                self._filled.put((buffer, n_read))
+        except Exception as e:
+            self._filled.put(e)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self._timed_get(self._filled, 'writer_stall', self.stats)
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                buffer, n_read = item
+                self.stats['bytes'] += n_read
+                view = memoryview(buffer)[:n_read]
+                # unless zero copy, copy out - the buffer goes back to the reader once yielded
+                yield bytes(view) if self.copy else view
+                self._free.put(buffer)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._free.put(None)  # wake the reader if it is waiting for a buffer
+        try:
+            self.stream.close()
+        finally:
+            self.stats['seconds'] = time.time() - self._started
+            READ_AHEAD_METRICS.record(self.stats)
+            log.info('Finished read-ahead stream', **self.stats)
+
+
+class ZeroCopyStream(object):
+    """ WSGI app_iter that reads an S3 body stream into one preallocated buffer and yields
+        memoryviews of it, instead of allocating a new bytes object per chunk.
+
+        The buffer is refilled when the next chunk is requested, which is safe because a
+        WSGI server is done with a block before it asks for the next one - waitress copies
+        it into its output buffer and gunicorn sends it. wsgi.file_wrapper would not help
+        here: both servers fall back to file.read(block_size) for anything that is not a
+        real file, allocating per chunk anyway. Only enable this (download.zero_copy) where
+        the server and any middleware accept bytes-like blocks and do not keep them.
+
+        content_length is the response's Content-Length. Without one the server falls back to
+        chunked transfer encoding, which concatenates each block with bytes (waitress does
+        data + b"\r\n") and so cannot take a memoryview - then each chunk is copied to bytes.
+    """
+
+    def __init__(self, stream, content_length, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+        self.stream = stream
+        self.content_length = content_length
+        self.chunk_size = chunk_size
+        self._closed = False
+
+    def __iter__(self):
+        view = memoryview(bytearray(self.chunk_size))
+        try:
+            while True:
+                n_read = readinto_or_read(self.stream, view)
+                if not n_read:
+                    return
+                if self.content_length is None:
+                    yield bytes(view[:n_read])
+                else:
+                    yield view[:n_read]
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.stream.close()
+
+
+def benchmark_app_iter(make_app_iter, make_stream, rounds=3):
+    """ Measures an app_iter factory (e.g. file_views._iter_and_close or ZeroCopyStream)
+        over streams from make_stream, consuming blocks the way a WSGI server would.
+
+        Returns throughput over `rounds` untraced runs, plus a separate traced run counting
+        the bytes allocated while producing each block and the peak traced memory.
+    """
+    total_bytes, seconds = 0, 0.0
+    for _ in range(rounds):
+        app_iter = make_app_iter(make_stream())
+        started = time.perf_counter()
+        for block in app_iter:
+            total_bytes += len(block)
+        seconds += time.perf_counter() - started
+    tracemalloc.start()
+    try:
+        allocated_bytes, blocks, peak_bytes = 0, 0, 0
+        iterator = iter(make_app_iter(make_stream()))
+        while True:
+            # the producer may free its previous block only after allocating the next, so
+            # count the rise to the peak while producing rather than the net difference
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            try:
+                block = next(iterator)
+            except StopIteration:
+                break
+            peak = tracemalloc.get_traced_memory()[1]
+            allocated_bytes += max(peak - before, 0)
+            peak_bytes = max(peak_bytes, peak)
+            blocks += 1
+            del block
+    finally:
+        tracemalloc.stop()
+    return {
+        'bytes_per_second': total_bytes / seconds if seconds else 0.0,
+        'blocks': blocks,
+        'allocated_bytes': allocated_bytes,
+        'allocated_bytes_per_block': allocated_bytes / blocks if blocks else 0.0,
+        'peak_bytes': peak_bytes,
+    }
@@ -0,0 +1,86 @@
+import json
+import pytest
+import threading
+import time
+
+from unittest import mock
+from .. import analytics
+from ..analytics import GA4EventDispatcher
+
+
+def _payload(client_id='client', n_events=1):
+    return {
+        'client_id': client_id,
+        'timestamp_micros': '1',
+        'events': [{'name': 'purchase', 'params': {'file_name': 'f%s' % i}} for i in range(n_events)],
+    }
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = GA4EventDispatcher(failure_threshold=2, reset_timeout=60)
+    with mock.patch.object(analytics.requests, 'Session') as mock_session:
+        mock_session.return_value.post.return_value = mock.Mock(status_code=204)
+        yield dispatcher
+        dispatcher.shutdown()
+
+
+def test_ga4_dispatcher_merge_batches_by_client():
+    """ Events for the same client are merged into requests of at most 25 events """
+    batch = [('url', _payload()) for _ in range(30)] + [('url', _payload(client_id='other'))]
+    merged = list(GA4EventDispatcher.merge(batch))
+    assert [(p['client_id'], len(p['events'])) for _, p in merged] == [('client', 25), ('client', 5), ('other', 1)]
+    assert all(p['timestamp_micros'] == '1' for _, p in merged)
+
+
+def test_ga4_dispatcher_sends_in_background(dispatcher):
+    for _ in range(3):
+        assert dispatcher.submit('url', _payload())
+    assert dispatcher.flush(timeout=5)
+    session = dispatcher._session
+    sent = [json.loads(call[1]['data']) for call in session.post.call_args_list]
+    assert sum(len(p['events']) for p in sent) == 3
+    assert all(call[1]['timeout'] == dispatcher.timeout for call in session.post.call_args_list)
+    assert dispatcher.stats()['sent'] == 3
+
+
+def test_ga4_dispatcher_drops_when_queue_is_full(dispatcher):
+    release = threading.Event()
+    dispatcher.max_queue_size = 1
+    dispatcher._ensure_worker()
+    dispatcher._session.post.side_effect = lambda **kwargs: release.wait(5) and mock.Mock(status_code=204)
+    assert dispatcher.submit('url', _payload())
+    # wait until the worker has taken the first event and is blocked sending it
+    while dispatcher._queue.qsize():
+        time.sleep(0.01)
+    assert dispatcher.submit('url', _payload())
+    assert not dispatcher.submit('url', _payload())
+    release.set()
+    assert dispatcher.flush(timeout=5)
+    assert dispatcher.stats()['dropped_queue_full'] == 1
+
+
+def test_ga4_dispatcher_circuit_breaker(dispatcher):
+    """ After failure_threshold failures, events are dropped instead of sent until reset_timeout passes """
+    dispatcher._ensure_worker()
+    dispatcher._session.post.side_effect = Exception('GA is down')
+    for _ in range(3):
+        dispatcher.submit('url', _payload(client_id=str(_)))
+        dispatcher.flush(timeout=5)
+    stats = dispatcher.stats()
+    assert stats['failures'] == 2
+    assert stats['dropped_circuit_open'] == 1
+    assert stats['circuit_open']
+    dispatcher.reset_timeout = 0
+    dispatcher._session.post.side_effect = None
+    dispatcher.submit('url', _payload())
+    dispatcher.flush(timeout=5)
+    assert not dispatcher.stats()['circuit_open']
+    assert dispatcher.stats()['sent'] == 1
+
+
+def test_ga4_dispatcher_shutdown_flushes_queue(dispatcher):
+    for _ in range(5):
+        dispatcher.submit('url', _payload())
+    dispatcher.shutdown()
+    assert dispatcher.stats()['sent'] == 5
@@ -0,0 +1,64 @@
+import threading
+
+from ..background import BackgroundQueue
+
+
+class RecordingQueue(BackgroundQueue):
+    """ Records each batch it is given, optionally waiting on gate first """
+
+    worker_name = 'recording-queue'
+
+    def __init__(self, max_queue_size=10, gate=None):
+        super(RecordingQueue, self).__init__(max_queue_size, shutdown_timeout=5)
+        self.gate = gate
+        self.batches = []
+        self.starts = 0
+
+    def _start(self):
+        self.starts += 1
+
+    def _dispatch(self, batch):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.batches.append(batch)
+
+
+def test_background_queue_batches_and_shuts_down():
+    gate = threading.Event()
+    background = RecordingQueue(gate=gate)
+    assert background.flush(timeout=1)  # nothing started yet
+    assert background._put(1)
+    while background.qsize():  # the worker has taken the first item and is waiting on the gate
+        pass
+    assert background._put(2) and background._put(3)
+    assert not background.flush(timeout=0.05)
+    gate.set()
+    assert background.flush(timeout=5)
+    assert background.batches == [[1], [2, 3]]
+    assert background._put(4)
+    background.shutdown()
+    assert background.batches[-1] == [4]
+    assert background.starts == 1 and background._worker is None
+
+
+def test_background_queue_drops_when_full():
+    gate = threading.Event()
+    background = RecordingQueue(max_queue_size=1, gate=gate)
+    assert background._put(1)
+    while background.qsize():
+        pass
+    assert background._put(2)
+    assert not background._put(3)
+    assert background.dropped_queue_full == 1
+    gate.set()
+    background.shutdown()
+    assert background.batches == [[1], [2]]
+
+
+def test_background_queue_survives_dispatch_errors():
+    background = RecordingQueue()
+    background._dispatch = lambda batch: 1 / 0
+    assert background._put(1)
+    assert background.flush(timeout=5)
+    assert background._worker.is_alive()
+    background.shutdown()
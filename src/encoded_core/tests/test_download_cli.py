@@ -1,5 +1,4 @@
 import pytest
-from ..file_views import extract_bucket_and_key
 
 
 @pytest.fixture
@@ -14,23 +13,6 @@ def test_processed_file(testapp, file_formats):
     testapp.post_json('/FileProcessed', data, status=201)
 
 
-@pytest.mark.parametrize('url, expected', [
-    ('https://test-bucket.s3.com/file.bam',
-     ('test-bucket', 'file.bam')),
-    ('http://test-bucket.s3.amazonaws.com/file.bam',
-     ('test-bucket', 'file.bam')),
-    ('https://test-bucket.s3.amazonaws.com/file.bam',
-     ('test-bucket', 'file.bam')),
-    ('https://smaht-unit-testing-wfout.s3.amazonaws.com/cca15caa-bc11-4a6a-8998-ea0c69df8b9d/TSTFI0211073.bam',
-     ('smaht-unit-testing-wfout', 'cca15caa-bc11-4a6a-8998-ea0c69df8b9d/TSTFI0211073.bam'))
-])
-def test_extract_bucket_and_key(url, expected):
-    """ Tests the helper function for pulling bucket/key information from a URL """
-    bucket, key = extract_bucket_and_key(url)
-    assert bucket == expected[0]
-    assert key == expected[1]
-
-
 def _test_uri_get(testapp, uri):
     """ Helper functions that tests that we can get back download creds via GET """
     if '@@download_cli' not in uri:
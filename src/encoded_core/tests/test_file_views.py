@@ -0,0 +1,664 @@
+import datetime
+import io
+import json
+import pytest
+
+from botocore.exceptions import ClientError
+from pyramid.httpexceptions import HTTPBadRequest, HTTPForbidden, HTTPNotFound
+from pyramid.request import Request
+from unittest import mock
+from .. import file_views
+from ..file_views import (
+    build_multipart_range_response,
+    build_offload_response,
+    bulk_upload_credentials,
+    complete_multipart_upload,
+    format_byte_range,
+    get_bulk_download_identifiers,
+    get_experiment_or_assay_type,
+    get_single_range_length,
+    get_submitter_title,
+    build_bulk_download_entry,
+    bulk_download_cli,
+    parse_byte_ranges,
+    resolve_bulk_download_file,
+    resolve_download_target,
+    start_multipart_upload,
+    submit_ga_events,
+)
+from ..types.file import EXTERNAL_CREDS_CACHE
+
+
+INDEXED_FILE = {
+    'object': {'data_generation_summary': {'assays': ['WGS']}},
+    'embedded': {'sequencing_center': {'display_title': 'Test Center'}},
+}
+
+
+def _context(source=None):
+    model = mock.Mock(spec=['source']) if source is not None else mock.Mock(spec=[])
+    if source is not None:
+        model.source = source
+    return mock.Mock(uuid='some-uuid', model=model)
+
+
+def test_download_analytics_read_from_indexed_document():
+    """ A File loaded from Elasticsearch already carries the dimensions GA needs - no lookups """
+    with mock.patch.object(file_views, 'get_item_or_none') as mock_get:
+        context = _context(INDEXED_FILE)
+        assert get_experiment_or_assay_type(None, context, {}) == 'WGS'
+        assert get_submitter_title(None, context, {'sequencing_center': 'test-center'}) == 'Test Center'
+        assert get_submitter_title(None, context, {}) is None
+    mock_get.assert_not_called()
+
+
+@pytest.mark.parametrize('properties, collection', [
+    ({'lab': 'test-lab'}, 'labs'),
+    ({'sequencing_center': 'test-center'}, 'submission-centers'),
+])
+def test_download_analytics_fall_back_to_lookups(properties, collection):
+    """ Files loaded from the database (or not yet indexed) are looked up as before """
+    with mock.patch.object(file_views, 'get_item_or_none') as mock_get:
+        mock_get.return_value = {'display_title': 'Submitter', 'track_and_facet_info': {'experiment_type': 'Hi-C'}}
+        context = _context()
+        assert get_submitter_title(None, context, properties) == 'Submitter'
+        mock_get.assert_called_once_with(None, list(properties.values())[0], collection)
+        assert get_experiment_or_assay_type(None, context, properties) == 'Hi-C'
+        mock_get.assert_called_with(None, 'some-uuid')
+
+
+def test_bulk_download_ga_events_look_up_each_item_once():
+    """ Files sharing a submitter, or listed twice, do not repeat the same lookups """
+    items = {uuid: mock.Mock(uuid=uuid, model=mock.Mock(spec=[])) for uuid in ('u1', 'u2')}
+    resolved = [{'item': items[uuid], 'properties': {'lab': 'test-lab'}, 'filename': 'f.bam', '@id': f'/{uuid}/'}
+                for uuid in ('u1', 'u2', 'u1')]
+    request = mock.Mock(registry=mock.Mock(settings={'ga_config': {'hostnameTrackerIDMapping': {}}}))
+    with mock.patch.object(file_views, 'get_item_or_none', return_value={'display_title': 'Lab'}) as mock_get:
+        with mock.patch.object(file_views, 'session_properties', return_value={}):
+            with mock.patch.object(file_views, 'build_download_ga_event', return_value={}) as mock_event:
+                with mock.patch.object(file_views, 'submit_ga_events') as mock_submit:
+                    file_views.submit_bulk_download_ga_events(None, request, resolved)
+    assert mock_get.call_args_list == [mock.call(request, 'test-lab', 'labs'), mock.call(request, 'u1', None),
+                                       mock.call(request, 'u2', None)]
+    assert mock_event.call_count == 3
+    assert len(mock_submit.call_args[0][2]) == 3
+
+
+@pytest.mark.parametrize('range_header, expected', [
+    ('bytes=0-99', 100),
+    ('bytes=100-199', 100),
+    ('bytes=100-', None),
+    ('bytes=-500', None),
+    ('bytes=0-1,5-9', None),
+    (None, None),
+])
+def test_get_single_range_length(range_header, expected):
+    request = Request.blank('/', headers={'Range': range_header} if range_header else {})
+    assert get_single_range_length(request) == expected
+
+
+@pytest.mark.parametrize('range_header, expected', [
+    ('bytes=0-99', [(0, 100)]),
+    ('bytes=0-99, 200-299,-50,1000-', [(0, 100), (200, 300), (-50, None), (1000, None)]),
+    ('bytes=99-0', None),
+    ('bytes=a-b', None),
+    ('bytes=-', None),
+    ('items=0-99', None),
+    (None, None),
+])
+def test_parse_byte_ranges(range_header, expected):
+    byte_ranges = parse_byte_ranges(range_header)
+    assert byte_ranges == expected
+    if byte_ranges:
+        assert [parse_byte_ranges(format_byte_range(r))[0] for r in byte_ranges] == byte_ranges
+
+
+@pytest.mark.parametrize('range_header, expected', [
+    ('bytes=0-99', 100),
+    ('bytes=-50', 50),
+    ('bytes=900-', 100),
+    ('bytes=0-9,-50,990-2000', 70),
+    ('bytes=-5000', 1000),
+])
+def test_get_byte_ranges_length(range_header, expected):
+    """ Bytes counted for GA, for a 1000 byte file """
+    assert file_views.get_byte_ranges_length(parse_byte_ranges(range_header), 1000) == expected
+
+
+def test_build_multipart_range_response():
+    """ Each range is fetched from S3 separately and streamed back as one multipart/byteranges body """
+    content = bytes(range(256)) * 4
+    ranges = [(0, 10), (100, 105), (-3, None)]
+
+    def get_object(Bucket, Key, Range):
+        start, end = parse_byte_ranges(Range)[0]
+        start = start if start >= 0 else len(content) + start
+        end = end or len(content)
+        return {
+            'Body': io.BytesIO(content[start:end]),
+            'ContentLength': end - start,
+            'ContentRange': 'bytes %s-%s/%s' % (start, end - 1, len(content)),
+            'ContentType': 'application/octet-stream',
+        }
+
+    conn = mock.Mock()
+    conn.get_object.side_effect = get_object
+    request = mock.Mock(registry=mock.Mock(settings={}))
+    response = build_multipart_range_response(request, conn, {'Bucket': 'b', 'Key': 'k'}, ranges)
+    assert conn.get_object.call_count == 3
+    assert response.status_code == 206
+    body = b''.join(response.app_iter)
+    assert len(body) == response.content_length
+    boundary = response.content_type_params['boundary'].encode()
+    parts = body.split(b'--' + boundary)
+    assert parts[0] == b'' and parts[-1] == b'--\r\n'
+    for part, expected in zip(parts[1:-1], [content[0:10], content[100:105], content[-3:]]):
+        headers, data = part.split(b'\r\n\r\n', 1)
+        assert b'Content-Range: bytes ' in headers
+        assert data == expected + b'\r\n'
+
+
+@pytest.mark.parametrize('range_header, file_size, expected', [
+    ('bytes=0-9,2000-2999', 1000, [(0, 10)]),
+    ('bytes=990-2000,-50,1000-', 1000, [(990, 2001), (-50, None)]),
+    ('bytes=1000-,2000-2999', 1000, []),
+    ('bytes=-50,0-9', 0, []),
+])
+def test_get_satisfiable_byte_ranges(range_header, file_size, expected):
+    assert file_views.get_satisfiable_byte_ranges(parse_byte_ranges(range_header), file_size) == expected
+
+
+def test_download_multiple_ranges_past_the_end(testapp, file_formats):
+    """ Ranges past the end of the file are left out of a multipart response, and only when
+        every range is past the end is the request refused as unsatisfiable
+    """
+    content = bytes(range(100)) * 10
+    item = testapp.post_json('/files-processed', {
+        'file_format': file_formats['bam']['uuid'], 'filename': 'my.bam', 'status': 'uploaded',
+        'file_size': len(content),
+    }, status=201).json['@graph'][0]
+
+    def get_object(Bucket, Key, Range, **kwargs):
+        start, end = parse_byte_ranges(Range)[0]
+        if start >= len(content):
+            raise ClientError({'Error': {'Code': 'InvalidRange'}}, 'GetObject')
+        return {'Body': io.BytesIO(content[start:end]), 'ContentLength': end - start,
+                'ContentRange': 'bytes %s-%s/%s' % (start, end - 1, len(content))}
+
+    with mock.patch.object(file_views, 'get_s3_client') as get_client:
+        get_client.return_value.get_object.side_effect = get_object
+        with mock.patch.object(file_views, 'build_s3_presigned_get_url', return_value='https://signed'):
+            res = testapp.get(item['@id'] + '@@download', headers={'Range': 'bytes=0-9,2000-2999'}, status=206)
+            assert get_client.return_value.get_object.call_count == 1
+            assert res.content_type == 'multipart/byteranges'
+            assert b'Content-Range: bytes 0-9/1000' in res.body
+            res = testapp.get(item['@id'] + '@@download', headers={'Range': 'bytes=1000-,2000-2999'}, status=416)
+            assert res.headers['Content-Range'] == 'bytes */1000'
+            assert get_client.return_value.get_object.call_count == 1
+
+
+@pytest.mark.parametrize('settings, expected', [
+    ({}, '/_s3_proxy/https/bucket.s3.amazonaws.com/some/key.bam?X-Amz-Signature=abc&Expires=1'),
+    ({'download.offload_prefix': '/internal/'},
+     '/internal/https/bucket.s3.amazonaws.com/some/key.bam?X-Amz-Signature=abc&Expires=1'),
+])
+def test_build_offload_response(settings, expected):
+    location = 'https://bucket.s3.amazonaws.com/some/key.bam?X-Amz-Signature=abc&Expires=1'
+    response = build_offload_response(settings, location)
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == expected
+    assert response.body == b''
+
+
+def test_get_bulk_download_identifiers():
+    assert get_bulk_download_identifiers(None, {'files': ['a', 'b']}) == ['a', 'b']
+    for body in [{}, {'files': 'a'}, {'search': 'type=File'}]:
+        with pytest.raises(HTTPBadRequest):
+            get_bulk_download_identifiers(None, body)
+    with mock.patch.object(file_views, 'get_iterable_search_results') as mock_search:
+        mock_search.return_value = iter([{'uuid': 'u1'}, {'uuid': 'u2'}])
+        assert get_bulk_download_identifiers(None, {'search': {'status': 'released'}}) == ['u1', 'u2']
+        mock_search.assert_called_once_with(None, param_lists={'status': ['released'], 'type': ['File'],
+                                                               'field': ['uuid']})
+    with mock.patch.object(file_views, 'MAX_BULK_DOWNLOAD_FILES', 1):
+        with pytest.raises(HTTPBadRequest):
+            get_bulk_download_identifiers(None, {'files': ['a', 'b']})
+
+
+def _bulk_file(uuid, accession, file_format='bam'):
+    item = mock.Mock(uuid=uuid, propsheets={'external': {'service': 's3', 'bucket': 'files-bucket',
+                                                         'key': f'{uuid}/{accession}.bam'}})
+    item.upgrade_properties.return_value = {'accession': accession, 'file_format': file_format,
+                                            'file_size': 10, 'md5sum': 'abc'}
+    item.jsonld_id.return_value = f'/files-processed/{accession}/'
+    return item
+
+
+def _bulk_collection_and_request():
+    files = {'TSTFI001': _bulk_file('u1', 'TSTFI001'), 'TSTFI002': _bulk_file('u2', 'TSTFI002'),
+             'TSTFI003': _bulk_file('u3', 'TSTFI003')}
+    collection = mock.Mock()
+    collection.get.side_effect = files.get
+    registry = mock.MagicMock(settings={'file_upload_bucket': 'files-bucket', 'file_wfout_bucket': 'wfout-bucket'})
+    registry.__getitem__.side_effect = lambda name: {file_views.COLLECTIONS: {'File': collection}}[name]
+    request = mock.Mock(registry=registry, effective_principals=['userid.abc'])
+    request.has_permission.side_effect = lambda permission, item: item is not files['TSTFI002']
+    return files, collection, request
+
+
+def test_resolve_bulk_download_file():
+    files, collection, request = _bulk_collection_and_request()
+    with mock.patch.object(file_views, 'get_file_format', return_value={'standard_file_extension': 'bam'}):
+        resolved = resolve_bulk_download_file(collection, request, '/files-processed/TSTFI001/')
+        assert resolved['item'] is files['TSTFI001'] and resolved['properties']['accession'] == 'TSTFI001'
+        assert (resolved['bucket'], resolved['key'], resolved['filename']) == (
+            'files-bucket', 'u1/TSTFI001.bam', 'TSTFI001.bam')
+        assert resolve_bulk_download_file(collection, request, 'TSTFI002')['error'] == 'forbidden'
+        assert resolve_bulk_download_file(collection, request, 'TSTFI009')['error'] == 'not found'
+        with mock.patch.object(file_views, 'build_s3_presigned_get_url', return_value='https://signed') as presign:
+            entry = build_bulk_download_entry(request, resolved)
+    assert entry == {'identifier': '/files-processed/TSTFI001/', '@id': '/files-processed/TSTFI001/',
+                     'uuid': 'u1', 'filename': 'TSTFI001.bam', 'file_size': 10, 'md5sum': 'abc',
+                     'url': 'https://signed'}
+    presign.assert_called_once_with(params={
+        'Bucket': 'files-bucket', 'Key': 'u1/TSTFI001.bam',
+        'ResponseContentDisposition': 'attachment; filename=TSTFI001.bam'}, registry=request.registry)
+
+
+def test_bulk_download_presigns_as_the_manifest_streams():
+    files, collection, request = _bulk_collection_and_request()
+    request.json = {'files': ['TSTFI001', 'TSTFI002', 'TSTFI003']}
+    request.registry.settings['ga_config'] = None
+    with mock.patch.object(file_views, 'get_file_format', return_value={'standard_file_extension': 'bam'}):
+        with mock.patch.object(file_views, 'is_download_proxied', return_value=False):
+            with mock.patch.object(file_views, 'build_s3_presigned_get_url', return_value='https://signed') as presign:
+                lines = iter(file_views.bulk_download(collection, request).app_iter)
+                presign.assert_not_called()
+                for item in files.values():
+                    # once the view returns the transaction is over - the Files are detached
+                    type(item).uuid = mock.PropertyMock(side_effect=AssertionError('detached'))
+                    item.upgrade_properties.return_value['md5sum'] = 'expired'
+                assert json.loads(next(lines))['@id'] == '/files-processed/TSTFI001/'
+                assert presign.call_count == 1
+                assert [json.loads(line) for line in lines] == [
+                    {'identifier': 'TSTFI002', 'error': 'forbidden'},
+                    {'identifier': 'TSTFI003', '@id': '/files-processed/TSTFI003/', 'uuid': 'u3',
+                     'filename': 'TSTFI003.bam', 'file_size': 10, 'md5sum': 'abc', 'url': 'https://signed'}]
+    assert presign.call_count == 2
+
+
+@pytest.fixture
+def bulk_files(testapp, file_formats):
+    """ Two files of different types, which only the abstract /files/ collection holds both of """
+    processed = testapp.post_json('/files-processed', {
+        'file_format': file_formats['bam']['uuid'], 'filename': 'my.bam', 'status': 'uploaded',
+    }, status=201).json['@graph'][0]
+    reference = testapp.post_json('/files-reference', {
+        'file_format': file_formats['chromsizes']['uuid'], 'filename': 'my.chrom.sizes', 'status': 'uploaded',
+    }, status=201).json['@graph'][0]
+    return [processed, reference]
+
+
+@pytest.mark.parametrize('collection', ['/files/', '/files-processed/'])
+def test_bulk_download_route(testapp, bulk_files, collection):
+    """ @@bulk_download is served by /files/ and resolves files of every type wherever it is posted """
+    identifiers = [bulk_files[0]['accession'], bulk_files[1]['@id']]
+    with mock.patch.object(file_views, 'build_s3_presigned_get_url', return_value='https://signed'):
+        res = testapp.post_json(collection + '@@bulk_download', {'files': identifiers}, status=200)
+    entries = [json.loads(line) for line in res.body.splitlines()]
+    assert [entry['@id'] for entry in entries] == [item['@id'] for item in bulk_files]
+    assert all(entry['url'] == 'https://signed' for entry in entries)
+
+
+def test_bulk_download_cli_groups_files_by_credential_set():
+    files, collection, request = _bulk_collection_and_request()
+    request.json = {'files': ['TSTFI001', 'TSTFI002', 'TSTFI003']}
+    request.registry.settings['ga_config'] = {'hostname': 'data.example.org'}
+
+    def creds_bulk(objects, name):
+        # one object per credential set, as if each policy only had room for one key
+        return [{'service': 's3', 'objects': [{'bucket': b, 'key': k}], 'download_credentials': {'n': i}}
+                for i, (b, k) in enumerate(objects)]
+
+    with mock.patch.object(file_views, 'get_file_format', return_value={'standard_file_extension': 'bam'}):
+        with mock.patch.object(file_views, 'external_creds_bulk', side_effect=creds_bulk):
+            with mock.patch.object(file_views, 'submit_ga_events') as submit:
+                result = bulk_download_cli(collection, request)
+    submit.assert_not_called()  # credential-issuing CLI endpoints record no GA events
+    assert result['errors'] == [{'identifier': 'TSTFI002', 'error': 'forbidden'}]
+    assert [s['download_credentials']['n'] for s in result['credential_sets']] == [0, 1]
+    assert [s['files'][0]['key'] for s in result['credential_sets']] == ['u1/TSTFI001.bam', 'u3/TSTFI003.bam']
+
+
+@pytest.mark.parametrize('collection', ['/files/', '/files-reference/'])
+def test_bulk_download_cli_route(testapp, bulk_files, collection):
+    """ @@bulk_download_cli is served by /files/ and covers files of every type in its credentials """
+    identifiers = [item['uuid'] for item in bulk_files]
+
+    def creds_bulk(objects, name):
+        return [{'service': 's3', 'objects': [{'bucket': b, 'key': k} for b, k in objects],
+                 'download_credentials': {'AccessKeyId': 'key'}}]
+
+    with mock.patch.object(file_views, 'external_creds_bulk', side_effect=creds_bulk):
+        res = testapp.post_json(collection + '@@bulk_download_cli', {'files': identifiers}, status=200)
+    assert res.json['errors'] == []
+    [credential_set] = res.json['credential_sets']
+    assert [f['@id'] for f in credential_set['files']] == [item['@id'] for item in bulk_files]
+
+
+def test_submit_ga_events_sends_one_payload():
+    request = Request.blank('/files/@@bulk_download', headers={'Host': 'data.example.org'})
+    request.registry = mock.Mock(settings={'ga4.secret': 'secret'})
+    ga_config = {'hostnameTrackerIDMapping': {'default': ['UA-1', 'G-1']}}
+    with mock.patch.object(file_views, 'GA4_EVENT_DISPATCHER') as dispatcher:
+        submit_ga_events(request, ga_config, [{'name': 'purchase'}] * 3, 'user-uuid')
+    dispatcher.submit.assert_called_once()
+    url, payload = dispatcher.submit.call_args[0]
+    assert 'measurement_id=G-1' in url
+    assert payload['user_id'] == 'user-uuid' and payload['client_id'] == 'programmatic'
+    assert len(payload['events']) == 3
+
+
+def test_resolve_download_target_extra_files():
+    """ download and download_cli resolve the main file or a named extra file without presigning """
+    item = _bulk_file('u1', 'TSTFI001')
+    item.propsheets['externalbai-uuid'] = {'service': 's3', 'bucket': 'wfout-bucket', 'key': 'u1/TSTFI001.bam.bai'}
+    item.upgrade_properties.return_value['extra_files'] = [{'file_format': 'bai', 'accession': 'TSTFI001'}]
+    formats = {'bam': {'standard_file_extension': 'bam'},
+               'bai': {'standard_file_extension': 'bam.bai', 'uuid': 'bai-uuid', 'file_format': 'bai'}}
+    _, _, request = _bulk_collection_and_request()
+    with mock.patch.object(file_views, 'get_file_format', side_effect=lambda request, value: formats[value]):
+        with mock.patch.object(file_views, 'build_s3_presigned_get_url') as presign:
+            target = resolve_download_target(item, request)
+            assert (target['bucket'], target['key'], target['filename']) == (
+                'files-bucket', 'u1/TSTFI001.bam', 'TSTFI001.bam')
+            target = resolve_download_target(item, request, 'TSTFI001.bam.bai')
+            assert (target['bucket'], target['key'], target['filename']) == (
+                'wfout-bucket', 'u1/TSTFI001.bam.bai', 'TSTFI001.bam.bai')
+            assert target['file_format'] is formats['bai']
+            with pytest.raises(HTTPNotFound):
+                resolve_download_target(item, request, 'TSTFI001.cram')
+            request.effective_principals = ['system.Everyone']
+            with pytest.raises(HTTPForbidden):
+                resolve_download_target(item, request)
+    presign.assert_not_called()
+
+
+@pytest.mark.parametrize('status', file_views.UNDOWNLOADABLE_STATUSES)
+def test_resolve_download_target_status(status):
+    """ Files, or extra files, that have not been uploaded have nothing to download """
+    item = _bulk_file('u1', 'TSTFI001')
+    item.upgrade_properties.return_value['extra_files'] = [
+        {'file_format': 'bai', 'accession': 'TSTFI001', 'status': status}]
+    formats = {'bam': {'standard_file_extension': 'bam'},
+               'bai': {'standard_file_extension': 'bam.bai', 'uuid': 'bai-uuid'}}
+    _, _, request = _bulk_collection_and_request()
+    with mock.patch.object(file_views, 'get_file_format', side_effect=lambda request, value: formats[value]):
+        assert resolve_download_target(item, request)['key'] == 'u1/TSTFI001.bam'
+        with pytest.raises(HTTPForbidden):
+            resolve_download_target(item, request, 'TSTFI001.bam.bai')
+        item.upgrade_properties.return_value['status'] = status
+        with pytest.raises(HTTPForbidden):
+            resolve_download_target(item, request)
+
+
+def test_download_cli_errors():
+    """ HTTP errors from resolving the download pass through; files not on S3 are a 400 """
+    request = mock.Mock(subpath=[])
+    with mock.patch.object(file_views, 'resolve_download_target', side_effect=HTTPForbidden()):
+        with pytest.raises(HTTPForbidden):
+            file_views.download_cli(None, request)
+    with mock.patch.object(file_views, 'resolve_download_target', side_effect=ValueError('external')):
+        assert file_views.download_cli(None, request).status_code == 400
+
+
+def _uploading_file(status='uploading'):
+    context = mock.Mock(uuid='u1', propsheets={'external': {'service': 's3', 'bucket': 'upload-bucket',
+                                                            'key': 'u1/TSTFI001.bam'}})
+    context.upgrade_properties.return_value = {'status': status, 'accession': 'TSTFI001'}
+    request = mock.Mock(registry=mock.Mock(settings={}), method='POST', params={})
+    request.resource_path.return_value = '/files-processed/TSTFI001/'
+    return context, request
+
+
+def test_start_multipart_upload():
+    context, request = _uploading_file()
+    request.json_body = {'file_size': 25 * 1024 * 1024, 'part_size': 10 * 1024 * 1024}
+    with mock.patch.object(file_views, 'get_s3_client') as get_client:
+        client = get_client.return_value
+        client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        client.generate_presigned_url.side_effect = lambda ClientMethod, Params, ExpiresIn: str(Params['PartNumber'])
+        result = start_multipart_upload(context, request)['@graph'][0]
+    client.create_multipart_upload.assert_called_once_with(Bucket='upload-bucket', Key='u1/TSTFI001.bam')
+    assert result['upload_id'] == 'upload-1'
+    assert result['parts'] == [{'part_number': n, 'url': str(n)} for n in (1, 2, 3)]
+    context.update.assert_not_called()
+
+    request.json_body = {'file_size': 25 * 1024 * 1024, 'part_size': 1024}
+    with pytest.raises(HTTPBadRequest):
+        start_multipart_upload(context, request)
+    context, request = _uploading_file(status='uploaded')
+    with pytest.raises(HTTPForbidden):
+        start_multipart_upload(context, request)
+
+
+def test_complete_multipart_upload_orders_parts():
+    context, request = _uploading_file()
+    request.json_body = {'upload_id': 'upload-1', 'parts': [{'part_number': 2, 'etag': '"b"'},
+                                                            {'part_number': 1, 'etag': '"a"'}]}
+    with mock.patch.object(file_views, 'get_s3_client') as get_client:
+        get_client.return_value.complete_multipart_upload.return_value = {'ETag': '"ab-2"'}
+        result = complete_multipart_upload(context, request)['@graph'][0]
+    get_client.return_value.complete_multipart_upload.assert_called_once_with(
+        Bucket='upload-bucket', Key='u1/TSTFI001.bam', UploadId='upload-1',
+        MultipartUpload={'Parts': [{'PartNumber': 1, 'ETag': '"a"'}, {'PartNumber': 2, 'ETag': '"b"'}]})
+    assert result['etag'] == '"ab-2"'
+    request.json_body = {'upload_id': 'upload-1', 'parts': [{'etag': '"a"'}]}
+    with pytest.raises(HTTPBadRequest):
+        complete_multipart_upload(context, request)
+
+
+def test_bulk_upload_credentials_prefetches_before_updating():
+    uploading, _ = _uploading_file()
+    uploaded, _ = _uploading_file(status='uploaded')
+    collection = mock.Mock()
+    collection.get.side_effect = {'TSTFI001': uploading, 'TSTFI002': uploaded}.get
+    registry = mock.MagicMock(settings={})
+    registry.__getitem__.side_effect = lambda name: {file_views.COLLECTIONS: {'File': collection}}[name]
+    request = mock.Mock(registry=registry, json={'files': ['TSTFI001', 'TSTFI002', 'TSTFI003']},
+                        effective_principals=['userid.abc'])
+    calls = []
+    with mock.patch.object(file_views, 'prefetch_upload_creds', side_effect=lambda *args: calls.append('prefetch')):
+        with mock.patch.object(file_views, 'update_upload_credentials', side_effect=lambda *args: calls.append('update')):
+            result = bulk_upload_credentials(collection, request)
+    assert calls == ['prefetch', 'update']
+    assert [entry['identifier'] for entry in result['@graph']] == ['TSTFI001']
+    assert [error['identifier'] for error in result['errors']] == ['TSTFI002', 'TSTFI003']
+
+
+@pytest.fixture
+def mock_sts(monkeypatch):
+    """ Answers assume_role with credentials for the object its policy names """
+    monkeypatch.delenv('IDENTITY', raising=False)
+
+    def assume_role(**kwargs):
+        return {
+            'Credentials': {
+                'AccessKeyId': json.loads(kwargs['Policy'])['Statement'][0]['Resource'][0],
+                'SecretAccessKey': 'FAKESECRETKEY',
+                'SessionToken': 'FAKESESSIONTOKEN',
+                'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+            },
+            'AssumedRoleUser': {'Arn': 'arn', 'AssumedRoleId': 'id'},
+            'ResponseMetadata': {'RequestId': 'request-id'},
+        }
+
+    sts = mock.Mock()
+    sts.assume_role.side_effect = assume_role
+    monkeypatch.setattr(EXTERNAL_CREDS_CACHE, 'sts_client', lambda: sts)
+    EXTERNAL_CREDS_CACHE.clear()
+    yield sts
+    EXTERNAL_CREDS_CACHE.clear()
+
+
+def test_file_add_prefetches_upload_credentials():
+    """ A collection POST mints its credentials up front, for the uuid create_item will use """
+    context = mock.Mock()
+    request = mock.Mock(params={}, validated={'filename': 'my.bam', 'status': 'uploading'})
+    calls = []
+    with mock.patch.object(file_views, 'prefetch_upload_creds',
+                           side_effect=lambda registry, files: calls.append(('prefetch', files))):
+        with mock.patch.object(file_views, 'collection_add', side_effect=lambda *args: calls.append('add')):
+            file_views.file_add(context, request)
+            request.params = {'check_only': 'true'}
+            file_views.file_add(context, request)
+    uuid = request.validated['uuid']
+    assert calls == [('prefetch', [(context.type_info.factory, uuid, request.validated)]), 'add', 'add']
+
+
+def test_file_add_mints_file_and_extra_file_credentials_before_writing(testapp, file_formats, mock_sts):
+    """ Each object gets its own session, minted before the file is created, which then finds it cached """
+    res = testapp.post_json('/files-processed', {
+        'file_format': file_formats['bam']['uuid'], 'filename': 'up.bam', 'status': 'uploading',
+        'extra_files': [{'file_format': file_formats['bai']['uuid']}],
+    }, status=201).json['@graph'][0]
+    assert mock_sts.assume_role.call_count == 2
+    assert EXTERNAL_CREDS_CACHE.stats()['hits'] >= 2
+    assert res['upload_credentials']['AccessKeyId'].endswith(res['upload_key'])
+
+
+def test_bulk_upload_credentials_route(testapp, file_formats, mock_sts):
+    """ @@upload_credentials is served by /files/ and issues credentials for files of every type """
+    uploading = [
+        testapp.post_json('/files-processed', {
+            'file_format': file_formats['bam']['uuid'], 'filename': 'up.bam', 'status': 'uploading',
+        }, status=201).json['@graph'][0],
+        testapp.post_json('/files-reference', {
+            'file_format': file_formats['chromsizes']['uuid'], 'filename': 'up.chrom.sizes', 'status': 'uploading',
+        }, status=201).json['@graph'][0],
+    ]
+    res = testapp.post_json('/files/@@upload_credentials', {'files': [item['@id'] for item in uploading]},
+                            status=200)
+    assert res.json['errors'] == []
+    assert [entry['@id'] for entry in res.json['@graph']] == [item['@id'] for item in uploading]
+    for entry in res.json['@graph']:
+        credentials = entry['upload_credentials']
+        assert credentials['AccessKeyId'] == 'arn:aws:s3:::' + credentials['upload_url'][len('s3://'):]
+
+
+# (run, rel, file) links of a small lineage: A -> R1 -> B -> R2 -> C, with C -> R4 -> B closing a
+# cycle, and a deleted run R3 taking B to D
+PROVENANCE_LINKS = [
+    ('R1', 'input_files.value', 'A'), ('R1', 'output_files.value', 'B'),
+    ('R2', 'input_files.value', 'B'), ('R2', 'output_files.value', 'C'),
+    ('R3', 'input_files.value', 'B'), ('R3', 'output_files.value', 'D'),
+    ('R4', 'input_files.value', 'C'), ('R4', 'output_files.value', 'B'),
+]
+
+
+def _provenance_request():
+    items = {}
+    for name in ('A', 'B', 'C', 'D', 'R1', 'R2', 'R3', 'R4'):
+        items[name] = mock.Mock(uuid=name, item_type='workflow_run' if name.startswith('R') else 'file_processed',
+                                properties={'status': 'deleted' if name == 'R3' else 'released'})
+    request = mock.Mock(params={})
+    request.resource_path.side_effect = lambda item: f'/{item.uuid}/'
+    request.has_permission.return_value = True
+    link_queries = []
+
+    def get_links(request, uuids, rels, reverse=False):
+        link_queries.append((sorted(uuids), rels, reverse))
+        return [(run, rel, file_uuid) for run, rel, file_uuid in PROVENANCE_LINKS
+                if (file_uuid if reverse else run) in uuids and rel in rels]
+
+    patches = [mock.patch.object(file_views, 'get_links', side_effect=get_links),
+               mock.patch.object(file_views, 'iter_items',
+                                 side_effect=lambda request, uuids: ((u, items[u]) for u in uuids))]
+    return items, request, patches, link_queries
+
+
+def test_provenance_upstream_one_level():
+    items, request, patches, link_queries = _provenance_request()
+    request.params = {'direction': 'upstream', 'depth': '1'}
+    with patches[0], patches[1]:
+        graph = file_views.provenance(items['B'], request)
+    assert [(node['uuid'], node['direction'], node['depth']) for node in graph['nodes']] == [
+        ('B', 'root', 0), ('R1', 'upstream', 1), ('R4', 'upstream', 1), ('A', 'upstream', 1), ('C', 'upstream', 1)]
+    assert {(e['source'], e['target'], e['relationship']) for e in graph['edges']} == {
+        ('R1', 'B', 'output'), ('R4', 'B', 'output'), ('A', 'R1', 'input'), ('C', 'R4', 'input')}
+    # one query from the files to their runs and one from the runs to their files
+    assert link_queries == [(['B'], ['output_files.value'], True), (['R1', 'R4'], ['input_files.value'], False)]
+    assert not graph['truncated']
+
+
+def test_provenance_both_directions_cycle_and_limits():
+    items, request, patches, link_queries = _provenance_request()
+    with patches[0], patches[1]:
+        graph = file_views.provenance(items['B'], request)
+        nodes = {node['uuid'] for node in graph['nodes']}
+        # the cycle through C ends, and the deleted run (and so D) is left out
+        assert nodes == {'A', 'B', 'C', 'R1', 'R2', 'R4'}
+        assert ('B', 'R2', 'input') in {(e['source'], e['target'], e['relationship']) for e in graph['edges']}
+        assert all(e['source'] in nodes and e['target'] in nodes for e in graph['edges'])
+        request.params = {'max_nodes': '3'}
+        graph = file_views.provenance(items['B'], request)
+        assert len(graph['nodes']) == 3 and graph['truncated']
+        for params in ({'depth': '0'}, {'depth': 'x'}, {'direction': 'sideways'}):
+            request.params = params
+            with pytest.raises(HTTPBadRequest):
+                file_views.provenance(items['B'], request)
+
+
+def test_provenance_max_nodes_counts_only_viewable_items():
+    """ Items the user cannot view neither use up max_nodes nor mark the graph truncated """
+    items, request, patches, _ = _provenance_request()
+    request.has_permission.side_effect = lambda permission, item: item.uuid not in ('R1', 'C')
+    request.params = {'direction': 'upstream', 'depth': '1', 'max_nodes': '2'}
+    with patches[0], patches[1]:
+        graph = file_views.provenance(items['B'], request)
+        assert [node['uuid'] for node in graph['nodes']] == ['B', 'R4'] and not graph['truncated']
+        request.has_permission.side_effect = None
+        graph = file_views.provenance(items['B'], request)
+        assert [node['uuid'] for node in graph['nodes']] == ['B', 'R1'] and graph['truncated']
+
+
+def test_provenance_leaves_out_deleted_workflow_runs(testapp, file_formats, workflows):
+    """ Real WorkflowRuns with a filtered status are not in the graph, nor the files past them """
+    def post_file():
+        return testapp.post_json('/files-processed', {
+            'file_format': file_formats['bam']['uuid'], 'filename': 'my.bam', 'status': 'uploaded',
+        }, status=201).json['@graph'][0]
+
+    source = post_file()
+    runs, outputs = [], []
+    for status in ('in review', 'deleted'):
+        outputs.append(post_file())
+        runs.append(testapp.post_json('/WorkflowRunAwsem', {
+            'workflow': 'fcdad1d6-80b7-4acd-bac8-d954540883c4',
+            'run_status': 'complete',
+            'status': status,
+            'input_files': [{'value': source['uuid'], 'ordinal': 1, 'workflow_argument_name': 'input_bam'}],
+            'output_files': [{'value': outputs[-1]['uuid'], 'workflow_argument_name': 'output_bam'}],
+        }, status=201).json['@graph'][0])
+    graph = testapp.get(source['@id'] + '@@provenance?direction=downstream', status=200).json
+    assert [node['uuid'] for node in graph['nodes']] == [source['uuid'], runs[0]['uuid'], outputs[0]['uuid']]
+    assert not graph['truncated']
+
+
+def test_workflow_runs_pages():
+    context = mock.Mock(item_type='file_reference', rev={'workflow_run_inputs': ('WorkflowRun', 'input_files.value')})
+    context.filtered_rev_link_uuids.return_value = ['r%s' % i for i in range(5)]
+    request = mock.Mock(params={'from': '2', 'limit': '2'})
+    request.registry = {file_views.CONNECTION: {'r%s' % i: 'r%s' % i for i in range(5)}}
+    request.resource_path.side_effect = lambda item: '/files-reference/F1/' if item is context else f'/{item}/'
+    page = file_views.workflow_runs(context, request)
+    assert page == {
+        '@id': '/files-reference/F1/', 'rel': 'inputs', 'total': 5, 'from': 2, 'limit': 2, '@graph': ['/r2/', '/r3/'],
+        'next': '/files-reference/F1/@@workflow_runs?rel=inputs&from=4&limit=2',
+    }
+    request.params = {'from': '4'}
+    assert 'next' not in file_views.workflow_runs(context, request)
+    for params in ({'rel': 'outputs'}, {'from': '-1'}, {'limit': '0'}):
+        request.params = params
+        with pytest.raises(HTTPBadRequest):
+            file_views.workflow_runs(context, request)
@@ -0,0 +1,144 @@
+import pytest
+import transaction
+
+from unittest import mock
+from snovault.elasticsearch.interfaces import INDEXER_QUEUE
+from snovault.validation import ValidationFailure
+from ..relations import ReciprocalRelations, queue_for_indexing
+
+
+RELATIONS = ReciprocalRelations('File', 'related_files', 'file', {
+    'derived from': 'parent of',
+    'parent of': 'derived from',
+    'paired with': 'paired with',
+})
+
+
+# as file.json, but a file may have at most two related files
+SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'related_files': {
+            'type': 'array',
+            'maxItems': 2,
+            'items': {
+                'type': 'object',
+                'properties': {
+                    'relationship_type': {'type': 'string', 'enum': ['derived from', 'parent of', 'paired with']},
+                    'file': {'type': 'string'},
+                },
+            },
+        },
+    },
+}
+
+
+class FakeItem(object):
+    """ Stands in for a File: saving it records its related_files, as File._update does """
+
+    type_info = mock.Mock(schema=SCHEMA)
+
+    def __init__(self, registry, uuid, related_files=None):
+        self.registry = registry
+        self.uuid = uuid
+        self.sid = 1
+        self.properties = {'related_files': related_files} if related_files is not None else {}
+        self.updates = 0
+
+    def upgrade_properties(self):
+        return self.properties.copy()
+
+    def update(self, properties):
+        self.properties = properties
+        self.sid += 1
+        self.updates += 1
+        if 'related_files' in properties:
+            RELATIONS.add(self, properties['related_files'])
+
+
+@pytest.fixture
+def registry():
+    items = {}
+    collection = mock.Mock()
+    collection.get.side_effect = items.get
+    registry = {'collections': {'File': collection}, INDEXER_QUEUE: mock.Mock()}
+    for uuid in ('a', 'b', 'target'):
+        items[uuid] = FakeItem(registry, uuid)
+    registry['items'] = items
+    transaction.begin()
+    yield registry
+    transaction.abort()
+
+
+def test_reverse_relations_written_once_per_target_at_commit(registry):
+    items = registry['items']
+    items['a'].update({'related_files': [{'relationship_type': 'derived from', 'file': 'target'},
+                                         {'relationship_type': 'derived from', 'file': 'target'}]})
+    items['b'].update({'related_files': [{'relationship_type': 'paired with', 'file': 'target'}]})
+    assert items['target'].updates == 0
+    transaction.commit()
+    assert items['target'].updates == 1
+    assert items['target'].properties['related_files'] == [
+        {'relationship_type': 'parent of', 'file': 'a'}, {'relationship_type': 'paired with', 'file': 'b'}]
+    # the target's own reverse relations already exist, so the cascade stops there
+    assert (items['a'].updates, items['b'].updates) == (1, 1)
+    indexer_queue = registry[INDEXER_QUEUE]
+    indexer_queue.send_messages.assert_called_once()
+    queued = indexer_queue.send_messages.call_args[0][0]
+    assert [(item['uuid'], item['sid'], item['method']) for item in queued] == [('target', 2, 'PATCH')]
+
+
+def test_reverse_relations_not_written_when_present_or_aborted(registry):
+    items = registry['items']
+    items['target'].properties = {'related_files': [{'relationship_type': 'parent of', 'file': 'a'}]}
+    items['a'].update({'related_files': [{'relationship_type': 'derived from', 'file': 'target'},
+                                         {'relationship_type': 'unknown', 'file': 'target'}]})
+    transaction.commit()
+    assert items['target'].updates == 0
+    registry[INDEXER_QUEUE].send_messages.assert_not_called()
+
+    transaction.begin()
+    items['b'].update({'related_files': [{'relationship_type': 'paired with', 'file': 'target'}]})
+    transaction.abort()
+    assert items['target'].updates == 0
+
+
+def test_reverse_relation_of_another_type_is_still_added(registry):
+    items = registry['items']
+    items['target'].properties = {'related_files': [{'relationship_type': 'paired with', 'file': 'a'}]}
+    items['a'].update({'related_files': [{'relationship_type': 'derived from', 'file': 'target'}]})
+    transaction.commit()
+    assert items['target'].properties['related_files'] == [
+        {'relationship_type': 'paired with', 'file': 'a'}, {'relationship_type': 'parent of', 'file': 'a'}]
+
+
+def test_invalid_reverse_relations_fail_the_request_before_commit(registry):
+    """ A target that is missing, or would not validate with its reverse relations, fails the
+        save that names it - in the request, not in the before-commit hook
+    """
+    items = registry['items']
+    items['target'].properties = {'related_files': [{'relationship_type': 'parent of', 'file': 'x'},
+                                                   {'relationship_type': 'parent of', 'file': 'y'}]}
+    with pytest.raises(ValidationFailure) as excinfo:
+        items['a'].update({'related_files': [{'relationship_type': 'derived from', 'file': 'target'}]})
+    assert excinfo.value.detail['name'] == ['related_files']
+    with pytest.raises(ValidationFailure):
+        items['b'].update({'related_files': [{'relationship_type': 'paired with', 'file': 'missing'}]})
+    transaction.abort()
+    assert items['target'].updates == 0
+    registry[INDEXER_QUEUE].send_messages.assert_not_called()
+
+    # the checks count every reverse relation the transaction adds to a target, not one at a time
+    transaction.begin()
+    items['target'].properties = {}
+    items['a'].update({'related_files': [{'relationship_type': 'derived from', 'file': 'target'}]})
+    items['b'].update({'related_files': [{'relationship_type': 'derived from', 'file': 'target'}]})
+    with pytest.raises(ValidationFailure):
+        items['a'].update({'related_files': [{'relationship_type': 'paired with', 'file': 'target'}]})
+
+
+def test_queue_for_indexing_skips():
+    registry = {INDEXER_QUEUE: mock.Mock()}
+    queue_for_indexing(False, registry, [{'uuid': 'a', 'sid': 1}])
+    queue_for_indexing(True, registry, [{'uuid': 'a', 'sid': 1}], skip_indexing=True)
+    registry[INDEXER_QUEUE].send_messages.assert_not_called()
@@ -0,0 +1,344 @@
+import io
+import pytest
+import threading
+import time
+import transaction
+
+from unittest import mock
+from .. import s3_utils
+from ..s3_utils import (
+    PresignedUrlCache,
+    S3ClientPool,
+    S3DeletionQueue,
+    S3RangeCache,
+    build_s3_presigned_get_url,
+    list_uploaded_parts,
+    plan_multipart_upload,
+    presign_upload_parts,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_s3_caches():
+    s3_utils.S3_CLIENT_POOL.clear()
+    s3_utils.PRESIGNED_URL_CACHE.clear()
+    yield
+    s3_utils.S3_CLIENT_POOL.clear()
+    s3_utils.PRESIGNED_URL_CACHE.clear()
+
+
+STATIC_KEYS = mock.Mock(spec=[])  # botocore Credentials without refresh_needed() never expire
+
+
+@pytest.fixture
+def mock_boto3(monkeypatch):
+    """ Patches boto3 so every session builds the same mock S3 client, signing with static keys """
+    monkeypatch.delenv('IDENTITY', raising=False)
+    with mock.patch.object(s3_utils, 'boto3') as mock_boto3:
+        mock_boto3.session.Session.return_value.get_credentials.return_value = STATIC_KEYS
+        yield mock_boto3
+
+
+def _s3_client(mock_boto3):
+    return mock_boto3.session.Session.return_value.client
+
+
+def test_s3_client_pool_reuses_client(mock_boto3):
+    """ One client is built per process and then shared """
+    pool = S3ClientPool()
+    registry = mock.Mock(settings={'s3.max_pool_connections': '7', 's3.tcp_keepalive': 'false'})
+    client = pool.get_client(registry)
+    assert pool.get_client(registry) is client
+    assert pool.get_client() is client
+    _s3_client(mock_boto3).assert_called_once()
+    config = _s3_client(mock_boto3).call_args[1]['config']
+    assert config.max_pool_connections == 7
+    assert config.tcp_keepalive is False
+    assert pool.stats() == {'constructions': 1, 'reuses': 2}
+
+
+def test_s3_client_pool_rebuilds_after_fork(mock_boto3):
+    pool = S3ClientPool()
+    _s3_client(mock_boto3).side_effect = lambda *args, **kwargs: mock.Mock()
+    parent_client = pool.get_client()
+    with mock.patch.object(s3_utils.os, 'getpid', return_value=-1):
+        assert pool.get_client() is not parent_client
+    assert pool.stats()['constructions'] == 2
+
+
+def test_s3_client_pool_rebuilds_after_ttl_or_expiry(mock_boto3):
+    """ Rotated IDENTITY keys and expired credentials are picked up by building a new client """
+    pool = S3ClientPool()
+    _s3_client(mock_boto3).side_effect = lambda *args, **kwargs: mock.Mock()
+    client = pool.get_client(mock.Mock(settings={'s3.client_ttl': '600'}))
+    assert pool.ttl == 600
+    with mock.patch.object(s3_utils.time, 'time', return_value=time.time() + 599):
+        assert pool.get_client() is client
+    with mock.patch.object(s3_utils.time, 'time', return_value=time.time() + 600):
+        client = pool.get_client()
+    assert pool.stats()['constructions'] == 2
+    expired = mock.Mock(spec=['refresh_needed'])
+    expired.refresh_needed.return_value = True
+    mock_boto3.session.Session.return_value.get_credentials.return_value = expired
+    pool.clear()
+    client = pool.get_client()
+    assert pool.get_client() is not client
+
+
+def test_get_credentials_lifetime():
+    """ The remaining lifetime is found through botocore's public refresh_needed() alone """
+    expires_at = time.time() + 3600
+    temporary = mock.Mock(spec=['refresh_needed'])
+    temporary.refresh_needed.side_effect = lambda refresh_in: time.time() + refresh_in > expires_at
+    assert 3600 - 60 <= s3_utils.get_credentials_lifetime(temporary, 36 * 3600) <= 3600
+    assert s3_utils.get_credentials_lifetime(temporary, 600) == 600
+    assert s3_utils.get_credentials_lifetime(STATIC_KEYS, 600) == 600
+    assert s3_utils.get_credentials_lifetime(None, 600) == 0
+
+
+def test_build_s3_presigned_get_url_uses_shared_client(mock_boto3):
+    params = {'Bucket': 'test-bucket', 'Key': 'test-key'}
+    _s3_client(mock_boto3).return_value.generate_presigned_url.return_value = 'https://signed'
+    assert build_s3_presigned_get_url(params=params) == 'https://signed'
+    assert build_s3_presigned_get_url(params=params) == 'https://signed'
+    _s3_client(mock_boto3).assert_called_once()
+    _s3_client(mock_boto3).return_value.generate_presigned_url.assert_called_with(
+        ClientMethod='get_object', Params=params, ExpiresIn=s3_utils.PRESIGNED_URL_EXPIRATION)
+
+
+def _temporary_credentials(expires_in):
+    expires_at = time.time() + expires_in
+    credentials = mock.Mock(spec=['refresh_needed'])
+    credentials.refresh_needed.side_effect = lambda refresh_in: time.time() + refresh_in > expires_at
+    return credentials
+
+
+@pytest.mark.parametrize('credentials, cached', [
+    (STATIC_KEYS, True),
+    (_temporary_credentials(3600), False),  # expire before the URL's minimum remaining lifetime
+    (_temporary_credentials(48 * 3600), True),
+    (None, False),  # no credentials to tell how long the URL will work
+])
+def test_build_s3_presigned_get_url_bounded_by_signing_credentials(mock_boto3, credentials, cached):
+    """ A URL is only reused while the credentials it was signed with are known to be valid """
+    params = {'Bucket': 'test-bucket', 'Key': 'test-key'}
+    mock_boto3.session.Session.return_value.get_credentials.return_value = credentials
+    build_s3_presigned_get_url(params=params)
+    build_s3_presigned_get_url(params=params)
+    assert _s3_client(mock_boto3).return_value.generate_presigned_url.call_count == (1 if cached else 2)
+
+
+def test_build_s3_presigned_get_url_reuses_cached_url(mock_boto3):
+    """ The same object/disposition/range is signed once; anything different is signed separately """
+    params = {'Bucket': 'test-bucket', 'Key': 'test-key', 'ResponseContentDisposition': 'attachment; filename=a.bam'}
+    mock_sign = _s3_client(mock_boto3).return_value.generate_presigned_url
+    mock_sign.side_effect = lambda **kwargs: 'https://signed/%s' % mock_sign.call_count
+    first = build_s3_presigned_get_url(params=params)
+    assert build_s3_presigned_get_url(params=dict(params)) == first
+    ranged = build_s3_presigned_get_url(params=dict(params, Range='bytes=0-99'))
+    assert ranged != first
+    assert mock_sign.call_count == 2
+    stats = s3_utils.PRESIGNED_URL_CACHE.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['hit_ratio'] == pytest.approx(1 / 3)
+
+
+def test_presigned_url_cache_requires_remaining_lifetime():
+    cache = PresignedUrlCache(min_remaining_lifetime=60)
+    params = {'Bucket': 'test-bucket', 'Key': 'test-key'}
+    cache.put(params, 'https://almost-expired', s3_utils.time.time() + 30)
+    assert cache.get(params) is None
+    cache.put(params, 'https://fresh', s3_utils.time.time() + 3600)
+    assert cache.get(params) == 'https://fresh'
+
+
+def test_presigned_url_cache_evicts_least_recently_used():
+    cache = PresignedUrlCache(max_size=2)
+    expires_at = s3_utils.time.time() + s3_utils.PRESIGNED_URL_EXPIRATION
+    for key in ('a', 'b'):
+        cache.put({'Key': key}, key, expires_at)
+    assert cache.get({'Key': 'a'}) == 'a'
+    cache.put({'Key': 'c'}, 'c', expires_at)
+    assert cache.get({'Key': 'b'}) is None
+    assert cache.stats()['evictions'] == 1
+
+
+class _SlowS3Client(object):
+    """ get_object stand-in that blocks until released, to hold a fetch in flight """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def get_object(self, **params):
+        self.calls += 1
+        self.release.wait(5)
+        body = b'x' * (int(params['Range'].split('-')[1]) + 1)
+        return {
+            'Body': io.BytesIO(body),
+            'ResponseMetadata': {'HTTPStatusCode': 206},
+            'AcceptRanges': 'bytes',
+            'ContentRange': 'bytes 0-%s/1000' % (len(body) - 1),
+        }
+
+
+def test_s3_range_cache_coalesces_concurrent_fetches():
+    """ Identical concurrent range reads share one S3 call, and later reads are served from memory """
+    cache = S3RangeCache()
+    client = _SlowS3Client()
+    params = {'Bucket': 'test-bucket', 'Key': 'test.bam.bai', 'Range': 'bytes=0-9'}
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(client, params))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while cache.stats()['coalesced'] < 4:
+        time.sleep(0.01)
+    client.release.set()
+    for thread in threads:
+        thread.join()
+    assert client.calls == 1
+    assert all(result['body'] == b'x' * 10 for result in results)
+    assert results[0]['status_code'] == 206
+    assert cache.get(client, params)['content_range'] == 'bytes 0-9/1000'
+    assert client.calls == 1
+    assert cache.stats()['hits'] == 1
+
+
+def test_s3_range_cache_is_bounded_by_bytes():
+    cache = S3RangeCache(max_bytes=25, max_item_bytes=20)
+    client = _SlowS3Client()
+    client.release.set()
+    for end in (9, 9, 19):
+        cache.get(client, {'Bucket': 'b', 'Key': 'k%s' % client.calls, 'Range': 'bytes=0-%s' % end})
+    stats = cache.stats()
+    assert stats['bytes'] == 20
+    assert stats['entries'] == 1
+    assert stats['evictions'] == 2
+    assert not cache.cacheable(None)
+    assert not cache.cacheable(21)
+    assert cache.cacheable(20)
+
+
+def test_s3_range_cache_propagates_errors_to_waiters():
+    cache = S3RangeCache()
+    client = mock.Mock()
+    client.get_object.side_effect = Exception('S3 is down')
+    with pytest.raises(Exception, match='S3 is down'):
+        cache.get(client, {'Bucket': 'b', 'Key': 'k', 'Range': 'bytes=0-9'})
+    assert cache.stats()['entries'] == 0
+
+
+def test_open_s3_ranges_closes_bodies_on_error():
+    bodies = []
+
+    def get_object(Bucket, Key, Range):
+        if Range == 'bytes=10-19':
+            raise Exception('InvalidRange')
+        bodies.append(mock.Mock())
+        return {'Body': bodies[-1]}
+
+    client = mock.Mock()
+    client.get_object.side_effect = get_object
+    with pytest.raises(Exception, match='InvalidRange'):
+        s3_utils.open_s3_ranges(client, {'Bucket': 'b', 'Key': 'k'}, ['bytes=0-9', 'bytes=10-19', 'bytes=20-29'])
+    assert len(bodies) == 2
+    assert all(body.close.called for body in bodies)
+
+
+MiB = 1024 * 1024
+
+
+@pytest.mark.parametrize('file_size, part_size, expected', [
+    (100 * MiB, 10 * MiB, 10),
+    (100 * MiB + 1, 10 * MiB, 11),
+    (1, 5 * MiB, 1),
+    (100 * MiB, 4 * MiB, ValueError),  # below S3's minimum part size
+    (60000 * MiB, 5 * MiB, ValueError),  # more than 10000 parts
+    (0, 5 * MiB, ValueError),
+    (None, 5 * MiB, ValueError),
+])
+def test_plan_multipart_upload(file_size, part_size, expected):
+    if expected is ValueError:
+        with pytest.raises(ValueError):
+            plan_multipart_upload(file_size, part_size)
+    else:
+        assert plan_multipart_upload(file_size, part_size) == expected
+
+
+def test_presign_upload_parts_and_list_uploaded_parts():
+    client = mock.Mock()
+    client.generate_presigned_url.side_effect = lambda ClientMethod, Params, ExpiresIn: (
+        f"https://signed/{ClientMethod}/{Params['PartNumber']}")
+    assert presign_upload_parts(client, 'b', 'k', 'upload-1', [1, 2]) == [
+        {'part_number': 1, 'url': 'https://signed/upload_part/1'},
+        {'part_number': 2, 'url': 'https://signed/upload_part/2'},
+    ]
+    client.get_paginator.return_value.paginate.return_value = [
+        {'Parts': [{'PartNumber': 1, 'ETag': '"a"', 'Size': 5}]},
+        {'Parts': [{'PartNumber': 2, 'ETag': '"b"', 'Size': 3}]},
+    ]
+    assert list_uploaded_parts(client, 'b', 'k', 'upload-1') == [
+        {'part_number': 1, 'etag': '"a"', 'size': 5},
+        {'part_number': 2, 'etag': '"b"', 'size': 3},
+    ]
+    client.get_paginator.return_value.paginate.assert_called_once_with(Bucket='b', Key='k', UploadId='upload-1')
+
+
+@pytest.mark.parametrize('credentials, max_expires_in', [
+    (None, s3_utils.MULTIPART_PART_URL_EXPIRATION),
+    (STATIC_KEYS, s3_utils.MULTIPART_PART_URL_EXPIRATION),
+    (_temporary_credentials(48 * 3600), s3_utils.MULTIPART_PART_URL_EXPIRATION),
+    (_temporary_credentials(3600), 3600),
+])
+def test_presign_upload_parts_capped_at_signing_credentials(mock_boto3, credentials, max_expires_in):
+    """ Part URLs do not claim to last longer than the credentials they are signed with """
+    mock_boto3.session.Session.return_value.get_credentials.return_value = credentials
+    client = s3_utils.get_s3_client()
+    presign_upload_parts(client, 'b', 'k', 'upload-1', [1])
+    expires_in = client.generate_presigned_url.call_args[1]['ExpiresIn']
+    assert max_expires_in - 120 <= expires_in <= max_expires_in
+
+
+def test_s3_deletion_queue_batches_and_retries():
+    """ Keys are deleted 1000 per request, and keys S3 reports as failed are retried """
+    deletions = S3DeletionQueue(max_attempts=3, backoff=0)
+    client = mock.Mock()
+    responses = iter([{}, {'Errors': [{'Key': 'k3', 'Code': 'InternalError', 'Message': 'retry'}]}, {}])
+    client.delete_objects.side_effect = lambda **kwargs: next(responses)
+    keys = ['k%s' % i for i in range(1500)]
+    assert deletions.delete_keys(client, 'b', keys) == {}
+    assert [len(call[1]['Delete']['Objects']) for call in client.delete_objects.call_args_list] == [1000, 500, 1]
+    assert client.delete_objects.call_args_list[-1][1]['Delete']['Objects'] == [{'Key': 'k3'}]
+    stats = deletions.stats()
+    assert (stats['deleted'], stats['retries'], stats['requests'], stats['failed']) == (1500, 1, 3, 0)
+
+    client.delete_objects.side_effect = Exception('unavailable')
+    assert deletions.delete_keys(client, 'b', ['gone']) == {'gone': 'unavailable'}
+    assert client.delete_objects.call_count == 6
+    assert list(deletions.failed_keys) == [('b', 'gone', 'unavailable')]
+
+
+def test_s3_deletion_queue_only_deletes_after_commit():
+    deletions = S3DeletionQueue()
+    client = mock.Mock()
+    client.delete_objects.return_value = {}
+    with mock.patch.object(s3_utils, 'get_s3_client', return_value=client):
+        try:
+            transaction.begin()
+            deletions.delete_after_commit('registry', 'b', 'aborted-key')
+            transaction.abort()
+            transaction.begin()
+            deletions.delete_after_commit('registry', 'b', 'k1')
+            deletions.delete_after_commit('registry', 'b', 'k2')
+            deletions.delete_after_commit('registry', 'other', 'k1')
+            client.delete_objects.assert_not_called()
+            transaction.commit()
+            assert deletions.flush(timeout=5)
+        finally:
+            deletions.shutdown()
+    deleted = sorted((call[1]['Bucket'], [o['Key'] for o in call[1]['Delete']['Objects']])
+                     for call in client.delete_objects.call_args_list)
+    assert deleted[-1] == ('other', ['k1'])
+    assert sorted(key for bucket, keys in deleted if bucket == 'b' for key in keys) == ['k1', 'k2']
+    assert deletions.stats()['queued'] == 3
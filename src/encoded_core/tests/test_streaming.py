@@ -0,0 +1,158 @@
+import io
+import pytest
+import threading
+
+from .. import streaming
+from ..file_views import _iter_and_close, iter_s3_body
+from ..streaming import ReadAheadStream, ZeroCopyStream, benchmark_app_iter
+
+
+class _TrackingStream(io.BytesIO):
+    """ BytesIO that records whether it was closed, readable after close for assertions """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.was_closed = threading.Event()
+
+    def close(self):
+        self.was_closed.set()
+        super().close()
+
+
+class _FailingStream(object):
+    def __init__(self):
+        self.reads = 0
+
+    def readinto(self, buffer):
+        self.reads += 1
+        if self.reads > 1:
+            raise IOError('connection reset')
+        buffer[:3] = b'abc'
+        return 3
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def clear_read_ahead_metrics():
+    streaming.READ_AHEAD_METRICS.clear()
+    yield
+    streaming.READ_AHEAD_METRICS.clear()
+
+
+@pytest.mark.parametrize('chunk_size, depth', [(7, 1), (64, 3), (4096, 2)])
+def test_read_ahead_stream_yields_whole_body(chunk_size, depth):
+    content = bytes(range(256)) * 40
+    stream = _TrackingStream(content)
+    read_ahead = ReadAheadStream(stream, chunk_size=chunk_size, depth=depth)
+    chunks = list(read_ahead)
+    assert b''.join(chunks) == content
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+    assert stream.was_closed.is_set()
+    assert read_ahead.stats['bytes'] == len(content)
+    metrics = streaming.READ_AHEAD_METRICS.stats()
+    assert metrics['streams'] == 1
+    assert metrics['bytes'] == len(content)
+
+
+def test_read_ahead_stream_closes_when_client_stops_early():
+    stream = _TrackingStream(b'x' * 1000)
+    read_ahead = ReadAheadStream(stream, chunk_size=10, depth=2)
+    iterator = iter(read_ahead)
+    assert next(iterator) == b'x' * 10
+    iterator.close()
+    assert stream.was_closed.wait(5)
+
+
+def test_read_ahead_stream_close_before_iterating():
+    """ WSGI servers call close() on the app_iter even if they never iterate it """
+    stream = _TrackingStream(b'x' * 1000)
+    ReadAheadStream(stream, chunk_size=10, depth=2).close()
+    assert stream.was_closed.is_set()
+
+
+def test_read_ahead_stream_propagates_read_errors():
+    read_ahead = ReadAheadStream(_FailingStream(), chunk_size=10, depth=2)
+    iterator = iter(read_ahead)
+    assert next(iterator) == b'abc'
+    with pytest.raises(IOError, match='connection reset'):
+        next(iterator)
+
+
+def test_iter_s3_body_read_ahead_setting():
+    assert isinstance(iter_s3_body(io.BytesIO(b'abc'), {'download.read_ahead': 'true'}), ReadAheadStream)
+    body = iter_s3_body(io.BytesIO(b'abc'), {})
+    assert b''.join(body) == b'abc'
+    assert body.gi_code is _iter_and_close.__code__
+
+
+@pytest.mark.parametrize('chunk_size', [7, 64, 4096])
+def test_zero_copy_stream_reuses_one_buffer(chunk_size):
+    content = bytes(range(256)) * 40
+    stream = _TrackingStream(content)
+    blocks = []
+    for block in ZeroCopyStream(stream, len(content), chunk_size=chunk_size):
+        assert isinstance(block, memoryview)
+        assert len(block) <= chunk_size
+        blocks.append((block.obj, bytes(block)))  # copy, as a WSGI server would before the next block
+    assert b''.join(data for _, data in blocks) == content
+    assert len({id(buffer) for buffer, _ in blocks}) == 1
+    assert stream.was_closed.is_set()
+
+
+def test_zero_copy_stream_closes_when_client_stops_early():
+    stream = _TrackingStream(b'x' * 1000)
+    iterator = iter(ZeroCopyStream(stream, 1000, chunk_size=10))
+    assert bytes(next(iterator)) == b'x' * 10
+    iterator.close()
+    assert stream.was_closed.is_set()
+
+
+def test_zero_copy_stream_without_content_length_yields_bytes():
+    """ Chunked responses (no Content-Length) need blocks that can be concatenated with bytes """
+    blocks = list(ZeroCopyStream(io.BytesIO(b'x' * 25), None, chunk_size=10))
+    assert all(type(block) is bytes for block in blocks)
+    assert [block + b'\r\n' for block in blocks] == [b'x' * 10 + b'\r\n'] * 2 + [b'x' * 5 + b'\r\n']
+
+
+def test_read_ahead_stream_without_copy():
+    content = bytes(range(256)) * 40
+    received = b''
+    for block in ReadAheadStream(_TrackingStream(content), chunk_size=64, depth=2, copy=False):
+        assert isinstance(block, memoryview)
+        received += block
+    assert received == content
+
+
+def test_iter_s3_body_zero_copy_setting():
+    body = iter_s3_body(io.BytesIO(b'abc'), {'download.zero_copy': 'true'}, content_length=3)
+    assert isinstance(body, ZeroCopyStream)
+    assert b''.join(body) == b'abc'
+    body = iter_s3_body(io.BytesIO(b'abc'), {'download.zero_copy': 'true', 'download.read_ahead': 'true'},
+                        content_length=3)
+    assert isinstance(body, ReadAheadStream) and not body.copy
+    assert b''.join(body) == b'abc'
+
+
+def test_iter_s3_body_zero_copy_needs_content_length():
+    body = iter_s3_body(io.BytesIO(b'abc'), {'download.zero_copy': 'true'})
+    assert not isinstance(body, ZeroCopyStream)
+    assert list(body) == [b'abc']
+    body = iter_s3_body(io.BytesIO(b'abc'), {'download.zero_copy': 'true', 'download.read_ahead': 'true'})
+    assert isinstance(body, ReadAheadStream) and body.copy
+    assert b''.join(body) == b'abc'
+
+
+def test_benchmark_zero_copy_against_generator():
+    """ Zero copy should allocate its one buffer, the generator a whole block per block """
+    content = b'x' * (8 * 1024 * 1024)
+    chunk_size = 1024 * 1024
+    generator = benchmark_app_iter(lambda stream: _iter_and_close(stream, chunk_size=chunk_size),
+                                   lambda: io.BytesIO(content), rounds=1)
+    zero_copy = benchmark_app_iter(lambda stream: ZeroCopyStream(stream, len(content), chunk_size=chunk_size),
+                                   lambda: io.BytesIO(content), rounds=1)
+    assert generator['blocks'] == zero_copy['blocks'] == 8
+    assert generator['allocated_bytes'] >= 8 * chunk_size
+    assert zero_copy['allocated_bytes'] < 2 * chunk_size
+    assert zero_copy['bytes_per_second'] > 0
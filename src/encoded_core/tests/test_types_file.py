@@ -1,8 +1,25 @@
+import datetime
+import json
 import pytest
 
 from unittest import mock
 from ..types import file as tf
-from ..types.file import external_creds
+from ..types.file_processed import FileProcessed
+from ..types.file import (
+    ExternalCredsCache,
+    build_scoped_policies,
+    external_creds,
+    external_creds_bulk,
+    prefetch_upload_creds,
+)
+
+
+@pytest.fixture(autouse=True)
+def clear_external_creds_cache():
+    """ external_creds caches credentials and the STS client process-wide, so reset between tests """
+    tf.EXTERNAL_CREDS_CACHE.clear()
+    yield
+    tf.EXTERNAL_CREDS_CACHE.clear()
 
 
 @pytest.fixture
@@ -67,6 +84,363 @@ def test_external_creds_assume_role(monkeypatch):
     assert creds['request_id'] == 'fake-request-id'
 
 
+def _make_assume_role_response(expires_in):
+    return {
+        'Credentials': {
+            'AccessKeyId': 'FAKEACCESSKEY',
+            'SecretAccessKey': 'FAKESECRETKEY',
+            'SessionToken': 'FAKESESSIONTOKEN',
+            'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires_in),
+        },
+        'AssumedRoleUser': {
+            'Arn': 'arn:aws:sts::123456789012:assumed-role/test-upload-role/name',
+            'AssumedRoleId': 'AROAEXAMPLE123:name',
+        },
+        'ResponseMetadata': {'RequestId': 'fake-request-id'},
+    }
+
+
+def test_external_creds_reuses_unexpired_credentials(monkeypatch):
+    """ Repeated calls for the same bucket/key/direction share one assume_role call and one STS client """
+    monkeypatch.delenv('IDENTITY', raising=False)
+    mock_sts_client = mock.Mock()
+    mock_sts_client.assume_role.side_effect = lambda **kwargs: _make_assume_role_response(3600)
+
+    with mock.patch.object(tf, 'boto3') as mock_boto3:
+        mock_boto3.client.return_value = mock_sts_client
+        first = external_creds('test-bucket', 'test-key', 'name')
+        second = external_creds('test-bucket', 'test-key', 'other-name')
+        assert first == second
+        assert mock_sts_client.assume_role.call_count == 1
+        # different direction or key must not share credentials
+        download = external_creds('test-bucket', 'test-key', 'name', upload=False)
+        assert 'download_credentials' in download
+        external_creds('test-bucket', 'other-key', 'name')
+        assert mock_sts_client.assume_role.call_count == 3
+        # no name means no credentials, and nothing to cache
+        assert external_creds('test-bucket', 'test-key')['upload_credentials'] == {}
+
+    mock_boto3.client.assert_called_once_with('sts')
+    stats = tf.EXTERNAL_CREDS_CACHE.stats()
+    assert stats['hits'] == 1
+    assert stats['minted'] == 3
+
+
+def test_external_creds_remints_within_expiry_margin(monkeypatch):
+    monkeypatch.delenv('IDENTITY', raising=False)
+    monkeypatch.setattr(tf.EXTERNAL_CREDS_CACHE, 'expiry_margin', 600)
+    mock_sts_client = mock.Mock()
+    mock_sts_client.assume_role.side_effect = lambda **kwargs: _make_assume_role_response(300)
+
+    with mock.patch.object(tf, 'boto3') as mock_boto3:
+        mock_boto3.client.return_value = mock_sts_client
+        external_creds('test-bucket', 'test-key', 'name')
+        external_creds('test-bucket', 'test-key', 'name')
+
+    assert mock_sts_client.assume_role.call_count == 2
+    assert tf.EXTERNAL_CREDS_CACHE.stats()['expired'] == 1
+
+
+def test_external_creds_cache_evicts_least_recently_used():
+    cache = ExternalCredsCache(expiry_margin=0, max_size=2)
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+    for key in ('a', 'b'):
+        cache.put(key, {'key': key}, expiration)
+    assert cache.get('a') == {'key': 'a'}
+    cache.put('c', {'key': 'c'}, expiration)
+    assert cache.get('b') is None
+    assert cache.get('a') == {'key': 'a'}
+    assert cache.stats()['evictions'] == 1
+
+
+def test_build_scoped_policies_splits_at_size_limit():
+    objects = [('test-bucket', f'{i:036d}/TSTFI{i:07d}.bam') for i in range(100)]
+    policies = list(build_scoped_policies(objects, max_size=2048))
+    assert len(policies) > 1
+    assert [obj for _, covered in policies for obj in covered] == objects
+    for policy, covered in policies:
+        assert len(json.dumps(policy, separators=(',', ':'))) <= 2048
+        assert policy['Statement'][0]['Resource'] == [f'arn:aws:s3:::{b}/{k}' for b, k in covered]
+    assert len(list(build_scoped_policies(objects[:3]))) == 1
+    with pytest.raises(ValueError):
+        list(build_scoped_policies([('test-bucket', 'x' * 3000)]))
+
+
+def test_external_creds_bulk_one_session_per_policy(monkeypatch):
+    monkeypatch.delenv('IDENTITY', raising=False)
+    mock_sts_client = mock.Mock()
+    mock_sts_client.assume_role.side_effect = lambda **kwargs: _make_assume_role_response(3600)
+    objects = [('test-bucket', f'{i:036d}/TSTFI{i:07d}.bam') for i in range(100)]
+
+    with mock.patch.object(tf, 'boto3') as mock_boto3:
+        mock_boto3.client.return_value = mock_sts_client
+        results = external_creds_bulk(objects, name='DownloadCredentials')
+        assert external_creds_bulk([], name='DownloadCredentials') == []
+
+    assert mock_sts_client.assume_role.call_count == len(results) < len(objects)
+    assert [(o['bucket'], o['key']) for r in results for o in r['objects']] == objects
+    for result in results:
+        assert 'AccessKeyId' in result['download_credentials']
+        assert isinstance(result['download_credentials']['Expiration'], str)
+
+
+def test_build_scoped_policies_for_upload():
+    """ Upload policies also allow PutObject, and ListBucket on each key as a prefix """
+    objects = [('test-bucket', f'{i:036d}/TSTFI{i:07d}.bam') for i in range(100)]
+    policies = list(build_scoped_policies(objects, upload=True))
+    assert [obj for _, covered in policies for obj in covered] == objects
+    for policy, covered in policies:
+        assert len(json.dumps(policy, separators=(',', ':'))) <= 2048
+        assert policy['Statement'][0]['Action'] == ['s3:GetObject', 's3:PutObject']
+        list_bucket = policy['Statement'][1]
+        assert list_bucket['Resource'] == ['arn:aws:s3:::test-bucket']
+        assert list_bucket['Condition']['StringLike']['s3:prefix'] == [k for _, k in covered]
+
+
+def _policy_resources(**kwargs):
+    """ An assume_role response whose access key records the S3 objects its policy allows """
+    response = _make_assume_role_response(3600)
+    response['Credentials']['AccessKeyId'] = json.dumps(json.loads(kwargs['Policy'])['Statement'][0]['Resource'])
+    return response
+
+
+def test_external_creds_bulk_not_cached_per_object(monkeypatch):
+    """ Credentials covering many objects are reused for the same set, never for one of its objects """
+    monkeypatch.delenv('IDENTITY', raising=False)
+    mock_sts_client = mock.Mock()
+    mock_sts_client.assume_role.side_effect = _policy_resources
+    objects = [('test-bucket', f'{i:036d}/TSTFI{i:07d}.bam') for i in range(40)]
+
+    with mock.patch.object(tf, 'boto3') as mock_boto3:
+        mock_boto3.client.return_value = mock_sts_client
+        results = external_creds_bulk(objects, name='UploadCredentials', profile_name='p', upload=True)
+        n_sessions = mock_sts_client.assume_role.call_count
+        assert n_sessions == len(results) > 1
+        assert external_creds_bulk(objects, name='UploadCredentials', profile_name='p', upload=True) == results
+        assert mock_sts_client.assume_role.call_count == n_sessions
+        for bucket, key in objects:
+            creds = external_creds(bucket, key, 'name', profile_name='p')['upload_credentials']
+            assert creds['upload_url'] == f's3://{bucket}/{key}' and creds['key'] == key
+            assert json.loads(creds['AccessKeyId']) == [f'arn:aws:s3:::{bucket}/{key}']
+        assert mock_sts_client.assume_role.call_count == n_sessions + len(objects)
+    assert tf.EXTERNAL_CREDS_CACHE.stats()['minted'] == n_sessions + len(objects)
+
+
+def test_prefetch_upload_creds_covers_file_and_extra_files(monkeypatch):
+    monkeypatch.delenv('IDENTITY', raising=False)
+    registry = mock.Mock(settings={'file_upload_bucket': 'test-bucket'})
+    properties = {'status': 'uploading', 'filename': 'my.bam', 'file_format': 'bam', 'accession': 'TSTFI001',
+                  'extra_files': [{'file_format': 'bai'}, {'file_format': None}]}
+    formats = {'bam': {'standard_file_extension': 'bam'}, 'bai': {'standard_file_extension': 'bam.bai'}}
+    mock_sts_client = mock.Mock()
+    mock_sts_client.assume_role.side_effect = _policy_resources
+    with mock.patch.object(tf, 'get_file_format_properties', side_effect=lambda registry, value: formats[value]):
+        assert tf.File.build_upload_objects(registry, 'u1', properties) == [
+            ('test-bucket', 'u1/TSTFI001.bam', 'my.bam'), ('test-bucket', 'u1/TSTFI001.bam.bai', 'TSTFI001.bam.bai')]
+        assert tf.File.build_upload_objects(registry, 'u1', dict(properties, status='uploaded')) == [
+            ('test-bucket', 'u1/TSTFI001.bam.bai', 'TSTFI001.bam.bai')]
+        with mock.patch.object(tf, 'boto3') as mock_boto3:
+            mock_boto3.client.return_value = mock_sts_client
+            minted = prefetch_upload_creds(registry, [(tf.File, 'u1', properties), (tf.File, 'u1', properties)])
+            assert prefetch_upload_creds(registry, [(tf.File, 'u1', properties)]) == []
+    # one session per object, each scoped to that object alone, and the next call hits the cache
+    assert [creds['key'] for creds in minted] == ['u1/TSTFI001.bam', 'u1/TSTFI001.bam.bai']
+    assert [json.loads(creds['upload_credentials']['AccessKeyId']) for creds in minted] == [
+        ['arn:aws:s3:::test-bucket/u1/TSTFI001.bam'], ['arn:aws:s3:::test-bucket/u1/TSTFI001.bam.bai']]
+    assert mock_sts_client.assume_role.call_count == 2
+    # each session is named after its file, as when File.create mints it
+    assert sorted(call[1]['RoleSessionName'] for call in mock_sts_client.assume_role.call_args_list) == [
+        'TSTFI001.bam.bai', 'my.bam']
+
+
+def test_external_creds_reusable(monkeypatch):
+    """ Saved credentials are kept only for the same object and while outside the expiry margin """
+    monkeypatch.setattr(tf.EXTERNAL_CREDS_CACHE, 'expiry_margin', 600)
+
+    def saved(expires_in):
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires_in)
+        return {'bucket': 'test-bucket', 'key': 'u1/TSTFI001.bam.bai',
+                'upload_credentials': {'Expiration': str(expiration)}}
+
+    assert tf.external_creds_reusable(saved(3600), 'test-bucket', 'u1/TSTFI001.bam.bai')
+    assert not tf.external_creds_reusable(saved(300), 'test-bucket', 'u1/TSTFI001.bam.bai')
+    assert not tf.external_creds_reusable(saved(3600), 'test-bucket', 'u1/TSTFI001.bai')
+    assert not tf.external_creds_reusable(saved(3600), 'test-bucket', 'u1/TSTFI001.bam.bai', upload=False)
+    assert not tf.external_creds_reusable(dict(saved(3600), upload_credentials={}),
+                                          'test-bucket', 'u1/TSTFI001.bam.bai')
+    assert not tf.external_creds_reusable(None, 'test-bucket', 'u1/TSTFI001.bam.bai')
+
+
+def test_file_update_keeps_valid_upload_credentials(monkeypatch):
+    """ Editing a file that is still uploading reuses its saved credentials until the key changes """
+    monkeypatch.setattr(tf.EXTERNAL_CREDS_CACHE, 'expiry_margin', 600)
+    expiration = str(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1))
+    saved = {'service': 's3', 'bucket': 'test-bucket', 'key': 'u1/TSTFI001.bam',
+             'upload_credentials': {'Expiration': expiration}}
+    registry = mock.Mock(settings={'file_upload_bucket': 'test-bucket'})
+    item = tf.File(registry, mock.Mock(uuid='u1', propsheets={'external': saved}))
+    properties = {'status': 'uploading', 'filename': 'my.bam', 'file_format': 'bam', 'accession': 'TSTFI001',
+                  'description': 'edited'}
+    formats = {'bam': {'standard_file_extension': 'bam'}, 'fastq': {'standard_file_extension': 'fastq'}}
+    with mock.patch.object(tf, 'get_file_format_properties', side_effect=lambda registry, value: formats[value]):
+        with mock.patch.object(tf.Item, '_update') as mock_update:
+            with mock.patch.object(tf.File, 'build_external_creds', return_value={'key': 'new'}) as mock_build:
+                item._update(properties)
+                mock_build.assert_not_called()
+                assert mock_update.call_args[0][1]['external'] is saved
+                item._update(dict(properties, file_format='fastq'))
+                mock_build.assert_called_once()
+                assert mock_update.call_args[0][1]['external'] == {'key': 'new'}
+
+
+def test_file_update_mints_extra_file_credentials_concurrently(monkeypatch):
+    monkeypatch.delenv('IDENTITY', raising=False)
+    registry = mock.Mock(settings={'file_upload_bucket': 'test-bucket'})
+    item = tf.File(registry, mock.Mock(uuid='u1', propsheets={}))
+    properties = {'status': 'uploaded', 'file_format': 'bam', 'accession': 'TSTFI001',
+                  'extra_files': [{'file_format': 'bai'}, {'file_format': 'txt', 'filename': 'path/to/notes.txt'}]}
+    formats = {'bai': {'uuid': 'bai', 'standard_file_extension': 'bam.bai'},
+               'txt': {'uuid': 'txt', 'standard_file_extension': 'txt'}}
+    mock_sts_client = mock.Mock()
+    mock_sts_client.assume_role.side_effect = _policy_resources
+    with mock.patch.object(tf, 'get_file_format_properties', side_effect=lambda registry, value: formats[value]):
+        with mock.patch.object(tf.Item, '_update') as mock_update:
+            with mock.patch.object(tf, 'boto3') as mock_boto3:
+                mock_boto3.client.return_value = mock_sts_client
+                with mock.patch.object(tf, 'mint_external_creds', wraps=tf.mint_external_creds) as mock_mint:
+                    item._update(properties)
+    mock_mint.assert_called_once()
+    assert mock_sts_client.assume_role.call_count == 2
+    # each extra file's session is named after it, not one shared name
+    assert sorted(call[1]['RoleSessionName'] for call in mock_sts_client.assume_role.call_args_list) == [
+        'TSTFI001.bam.bai', 'notes.txt']
+    sheets = mock_update.call_args[0][1]
+    assert sheets['externalbai']['key'] == 'u1/TSTFI001.bam.bai'
+    assert sheets['externaltxt']['upload_credentials']['key'] == 'u1/TSTFI001.txt'
+    assert json.loads(sheets['externaltxt']['upload_credentials']['AccessKeyId']) == [
+        'arn:aws:s3:::test-bucket/u1/TSTFI001.txt']
+
+
+def _closure_graph(graph):
+    """ Patches get_property_values to read from graph, recording each frontier fetched """
+    fetches = []
+
+    def get_property_values(request, uuids, propname):
+        fetches.append(list(uuids))
+        return {uuid: graph[uuid] for uuid in uuids if uuid in graph}
+
+    return mock.patch.object(tf, 'get_property_values', side_effect=get_property_values), fetches
+
+
+def test_property_closure_fetches_once_per_level():
+    graph = {'a': ['b', 'c'], 'b': ['d', 'a'], 'c': ['d'], 'd': ['e'], 'e': ['a']}
+    patch, fetches = _closure_graph(graph)
+    with patch:
+        assert tf.property_closure(None, 'produced_from', 'a') == {'a', 'b', 'c', 'd', 'e'}
+    assert fetches == [['a'], ['b', 'c'], ['d'], ['e']]
+
+
+def test_iter_property_closure_limits():
+    graph = {'a': ['b', 'c'], 'b': ['d'], 'c': ['e', 'f'], 'd': ['g']}
+    patch, fetches = _closure_graph(graph)
+    with patch:
+        assert list(tf.iter_property_closure(None, 'produced_from', 'a')) == [
+            ('a', 0), ('b', 1), ('c', 1), ('d', 2), ('e', 2), ('f', 2), ('g', 3)]
+        assert tf.property_closure(None, 'produced_from', 'a', max_depth=1) == {'a', 'b', 'c'}
+        assert list(tf.iter_property_closure(None, 'produced_from', 'a', max_size=4)) == [
+            ('a', 0), ('b', 1), ('c', 1), ('d', 2)]
+        del fetches[:]
+        # stopping early fetches nothing beyond the levels consumed
+        closure = tf.iter_property_closure(None, 'produced_from', 'a')
+        assert [next(closure) for _ in range(2)] == [('a', 0), ('b', 1)]
+    assert fetches == [['a']]
+
+
+def test_filtered_rev_links_counted_and_capped():
+    """ Rev link statuses are read once per request; rendered links are capped but counts are not """
+    item = mock.Mock(uuid='f1', filtered_rev_statuses=FileProcessed.filtered_rev_statuses)
+    item.get_rev_links.return_value = ['r3', 'r1', 'r4', 'r2']
+    item.filtered_rev_link_uuids.side_effect = lambda request, name: tf.File.filtered_rev_link_uuids(
+        item, request, name)
+    request = mock.Mock(_indexing_view=True, _rev_linked_uuids_by_item={}, _filtered_rev_link_uuids=None)
+    request.registry = {tf.CONNECTION: {uuid: '/workflow-runs/%s/' % uuid for uuid in ('r1', 'r2', 'r3', 'r4')}}
+    request.resource_path.side_effect = lambda path: path
+    statuses = {'r1': 'released', 'r2': 'deleted', 'r3': 'in review', 'r4': 'released'}
+    with mock.patch.object(tf, 'get_property_values', return_value=statuses) as mock_get_values:
+        assert tf.File.filtered_rev_link_uuids(item, request, 'workflow_run_inputs') == ['r1', 'r3', 'r4']
+        assert FileProcessed.workflow_run_inputs_count(item, request) == 3
+        assert FileProcessed.workflow_run_inputs_count(item, request, disable_wfr_inputs=True) == 0
+        assert tf.File.capped_rev_link_atids(item, request, 'workflow_run_inputs', limit=2) == [
+            '/workflow-runs/r1/', '/workflow-runs/r3/']
+        # the links and statuses were read once for the request, not once per property
+        mock_get_values.assert_called_once_with(request, ['r1', 'r2', 'r3', 'r4'], 'status')
+        item.get_rev_links.assert_called_once_with(request, 'workflow_run_inputs')
+        request._filtered_rev_link_uuids = None
+        assert FileProcessed.workflow_run_inputs_count(item, request) == 3
+        assert mock_get_values.call_count == 2
+    # the indexer is told about every run, not just those rendered
+    assert request._rev_linked_uuids_by_item == {'f1': {'workflow_run_inputs': ['r1', 'r3', 'r4']}}
+
+
+def test_workflow_run_rev_links_leave_out_deleted_runs(testapp, file_formats, workflows):
+    """ Deleted and replaced runs of a real file are neither rendered nor counted """
+    source = testapp.post_json('/files-processed', {
+        'file_format': file_formats['bam']['uuid'], 'filename': 'my.bam', 'status': 'uploaded',
+    }, status=201).json['@graph'][0]
+    runs = {}
+    for status in ('in review', 'deleted', 'in review'):
+        run = testapp.post_json('/WorkflowRunAwsem', {
+            'workflow': 'fcdad1d6-80b7-4acd-bac8-d954540883c4',
+            'status': status,
+            'input_files': [{'value': source['uuid'], 'ordinal': 1, 'workflow_argument_name': 'input_bam'}],
+        }, status=201).json['@graph'][0]
+        runs[run['uuid']] = run
+    live = sorted(uuid for uuid, run in runs.items() if run['status'] != 'deleted')
+    res = testapp.get(source['@id'] + '?frame=object', status=200).json
+    assert res['workflow_run_inputs_count'] == 2
+    assert res['workflow_run_inputs'] == [runs[uuid]['@id'] for uuid in live]
+    page = testapp.get(source['@id'] + '@@workflow_runs?rel=inputs', status=200).json
+    assert page['total'] == 2 and page['@graph'] == res['workflow_run_inputs']
+
+
+def test_property_closure_reads_items_through_the_connection(testapp, file_formats, threadlocals):
+    """ Walks produced_from of real files, read through the connection with their upgraded properties """
+    uuids = []
+    for produced_from in ([], [0], [1, 0]):
+        item = {'file_format': file_formats['bam']['uuid'], 'filename': 'my.bam', 'status': 'uploaded'}
+        if produced_from:
+            item['produced_from'] = [uuids[i] for i in produced_from]
+        uuids.append(testapp.post_json('/files-processed', item, status=201).json['@graph'][0]['uuid'])
+    assert list(tf.iter_property_closure(threadlocals, 'produced_from', uuids[2])) == [
+        (uuids[2], 0), (uuids[1], 1), (uuids[0], 1)]
+    assert tf.get_links(threadlocals, uuids[1:], ['produced_from']) == [
+        (uuids[1], 'produced_from', uuids[0]),
+        *sorted((uuids[2], 'produced_from', uuid) for uuid in uuids[:2])]
+    assert sorted(tf.get_links(threadlocals, [uuids[0]], ['produced_from'], reverse=True)) == sorted(
+        (uuid, 'produced_from', uuids[0]) for uuid in uuids[1:])
+
+
+def test_build_upload_key_does_not_mint_credentials():
+    """ The S3 key is derived from uuid, accession and FileFormat extension alone """
+    registry = {'collections': {'FileFormat': mock.Mock()}}
+    with mock.patch.object(tf, 'get_file_format_properties', return_value={'standard_file_extension': 'bam'}):
+        with mock.patch.object(tf, 'external_creds') as mock_external_creds:
+            key = tf.File.build_upload_key(registry, 'some-uuid', {'file_format': 'bam', 'accession': 'ENCFI123'})
+            # a file without an 'external' propsheet (e.g. while indexing) derives its key the same way
+            item = mock.Mock(propsheets={}, registry=registry, uuid='some-uuid',
+                             properties={'file_format': 'bam', 'accession': 'ENCFI123'},
+                             build_upload_key=tf.File.build_upload_key)
+            assert tf.File.upload_key(item, request=None) == key
+    assert key == 'some-uuid/ENCFI123.bam'
+    mock_external_creds.assert_not_called()
+
+
+def test_build_upload_key_unknown_format():
+    with mock.patch.object(tf, 'get_file_format_properties', return_value=None):
+        with pytest.raises(Exception, match='File format not in list of supported file types'):
+            tf.File.build_upload_key({}, 'some-uuid', {'file_format': 'waldo', 'accession': 'ENCFI123'})
+
+
 @pytest.fixture
 def processed_file_data(file_formats):
     return {
@@ -128,6 +502,18 @@ def test_validate_filename_invalid_filename_patch(testapp, processed_file_data):
     assert "Filename test_file2.txt extension does not agree with specified file format. Valid extension(s): '.bam'" in descriptions
 
 
+def test_related_files_reciprocal(testapp, processed_file_data):
+    """ Saving related_files gives each related file the reverse relation once committed """
+    parent = testapp.post_json('/files-processed', processed_file_data, status=201).json['@graph'][0]
+    child = testapp.post_json('/files-processed', dict(processed_file_data, related_files=[
+        {'relationship_type': 'derived from', 'file': parent['uuid']}]), status=201).json['@graph'][0]
+    parent = testapp.get(parent['@id'] + '?frame=object').json
+    assert parent['related_files'] == [{'relationship_type': 'parent of', 'file': child['@id']}]
+    # saving the reverse relation again does not add another
+    testapp.patch_json(child['@id'], {'tags': ['edited']}, status=200)
+    assert testapp.get(parent['@id'] + '?frame=object').json['related_files'] == parent['related_files']
+
+
 def test_validate_produced_from_files_invalid_post(testapp, processed_file_data):
     fids = ['not_a_file_id', 'definitely_not']
     processed_file_data['produced_from'] = fids
@@ -1,5 +1,97 @@
+import pytest
+
+from unittest import mock
+from ..types import file_format as ff
+from ..types.file_format import FileFormatCache
+
+
+BAM_FORMAT = {
+    '@id': '/file-formats/bam/',
+    'uuid': 'd13d06cf-218e-4f61-aaf0-91f226248b2c',
+    'file_format': 'bam',
+    'standard_file_extension': 'bam',
+}
+
+
 def test_types_file_format(testapp, file_formats):
     """ Tests loading the file_formats fixture, which posts many formats to the app """
     formats = file_formats
     for atid in formats.keys():
         assert testapp.get(f'/file-formats/{atid}', status=200)
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('bam', 'bam'),
+    ('/file-formats/bam/', 'bam'),
+    ('/d13d06cf-218e-4f61-aaf0-91f226248b2c/', 'd13d06cf-218e-4f61-aaf0-91f226248b2c'),
+    ({'uuid': 'd13d06cf-218e-4f61-aaf0-91f226248b2c'}, 'd13d06cf-218e-4f61-aaf0-91f226248b2c'),
+    ({'@id': '/file-formats/bam/'}, 'bam'),
+    (None, None),
+    ('', None),
+])
+def test_file_format_cache_normalize(value, expected):
+    assert FileFormatCache.normalize(value) == expected
+
+
+def test_file_format_cache_get_object_hits_and_invalidation():
+    """ Looking a format up by any of its identifiers after the first miss is served from the cache """
+    cache = FileFormatCache()
+    request = mock.Mock(_linked_uuids=set(), _indexing_view=False)
+    with mock.patch.object(ff, 'get_item_or_none', return_value=dict(BAM_FORMAT)) as mock_get:
+        assert cache.get_object(request, 'bam') == BAM_FORMAT
+        assert cache.get_object(request, BAM_FORMAT['uuid']) == BAM_FORMAT
+        assert cache.get_object(request, '/file-formats/bam/') == BAM_FORMAT
+        assert mock_get.call_count == 1
+        assert request._linked_uuids == {BAM_FORMAT['uuid']}
+        assert cache.stats() == {'hits': 2, 'misses': 1, 'invalidations': 0, 'size': 2}
+        # callers must not be able to mutate the cached value
+        cache.get_object(request, 'bam')['standard_file_extension'] = 'cram'
+        assert cache.get_object(request, 'bam')['standard_file_extension'] == 'bam'
+        cache.invalidate()
+        assert cache.get_object(request, 'bam') == BAM_FORMAT
+        assert mock_get.call_count == 2
+        assert cache.stats()['invalidations'] == 1
+
+
+def test_file_format_cache_get_object_copies_while_indexing():
+    """ The indexing view gets a copy too - mutating it must not change the cached format """
+    cache = FileFormatCache()
+    request = mock.Mock(_linked_uuids=set(), _indexing_view=True)
+    with mock.patch.object(ff, 'get_item_or_none', return_value=dict(BAM_FORMAT)):
+        cache.get_object(request, 'bam')
+        cache.get_object(request, 'bam')['standard_file_extension'] = 'cram'
+        assert cache.get_object(request, 'bam')['standard_file_extension'] == 'bam'
+
+
+def test_file_format_cache_does_not_cache_missing_formats():
+    cache = FileFormatCache()
+    request = mock.Mock()
+    with mock.patch.object(ff, 'get_item_or_none', return_value=None) as mock_get:
+        assert cache.get_object(request, 'waldo') is None
+        assert cache.get_object(request, 'waldo') is None
+        assert mock_get.call_count == 2
+        assert cache.stats()['hits'] == 0
+
+
+def test_file_format_cache_max_age():
+    cache = FileFormatCache(max_age=0)
+    request = mock.Mock()
+    with mock.patch.object(ff, 'get_item_or_none', return_value=dict(BAM_FORMAT)) as mock_get:
+        cache.get_object(request, 'bam')
+        cache.get_object(request, 'bam')
+        assert mock_get.call_count == 2
+
+
+def test_file_format_cache_get_properties():
+    cache = FileFormatCache()
+    item = mock.Mock(uuid=BAM_FORMAT['uuid'], properties={'file_format': 'bam', 'standard_file_extension': 'bam'})
+    collection = mock.Mock()
+    collection.get.return_value = item
+    registry = {'collections': {'FileFormat': collection}}
+    assert cache.get_properties(registry, '/file-formats/bam/') == {
+        'uuid': BAM_FORMAT['uuid'], 'file_format': 'bam', 'standard_file_extension': 'bam'
+    }
+    assert cache.get_properties(registry, BAM_FORMAT['uuid'])['file_format'] == 'bam'
+    collection.get.assert_called_once_with('bam')
+    collection.get.return_value = None
+    assert cache.get_properties(registry, 'waldo') is None
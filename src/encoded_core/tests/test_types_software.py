@@ -1,4 +1,64 @@
+from unittest import mock
+from ..types.software import SOFTWARE_RELATIONS
+
+
 def test_types_software(testapp, software):
     """ Tests that we can load and retrieve a software item """
     software_atid = software.json['@graph'][0]['@id']
     assert testapp.get(software_atid, status=200)
+
+
+def _post_software(testapp, name, **properties):
+    return testapp.post_json('/software', dict(properties, name=name, version='1.0', status='shared'),
+                             status=201).json['@graph'][0]
+
+
+def test_software_relation_reciprocal(testapp):
+    """ Saving a software_relation gives the related software the reverse relation once committed """
+    container = _post_software(testapp, 'relation-container')
+    tool = _post_software(testapp, 'relation-tool', software_relation=[
+        {'relationship_type': 'contained in', 'software': container['uuid']}])
+    container = testapp.get(container['@id'] + '?frame=object').json
+    assert container['software_relation'] == [{'relationship_type': 'container for', 'software': tool['@id']}]
+
+
+def test_software_relation_cycle_not_duplicated(testapp):
+    """ Relations that already point both ways are not added again """
+    first = _post_software(testapp, 'relation-first')
+    second = _post_software(testapp, 'relation-second', software_relation=[
+        {'relationship_type': 'derived from', 'software': first['uuid']}])
+    testapp.patch_json(second['@id'], {'software_relation': [
+        {'relationship_type': 'derived from', 'software': first['uuid']}]}, status=200)
+    first = testapp.get(first['@id'] + '?frame=object').json
+    second = testapp.get(second['@id'] + '?frame=object').json
+    assert first['software_relation'] == [{'relationship_type': 'parent of', 'software': second['@id']}]
+    assert second['software_relation'] == [{'relationship_type': 'derived from', 'software': first['@id']}]
+
+
+def test_software_relation_of_another_type_gets_its_reverse(testapp):
+    """ A relation back of another type does not stand in for the reverse of a new relation """
+    first = _post_software(testapp, 'relation-first')
+    second = _post_software(testapp, 'relation-second', software_relation=[
+        {'relationship_type': 'derived from', 'software': first['uuid']}])
+    testapp.patch_json(first['@id'], {'software_relation': [
+        {'relationship_type': 'container for', 'software': second['uuid']}]}, status=200)
+    first = testapp.get(first['@id'] + '?frame=object').json
+    second = testapp.get(second['@id'] + '?frame=object').json
+    assert second['software_relation'] == [{'relationship_type': 'derived from', 'software': first['@id']},
+                                           {'relationship_type': 'contained in', 'software': first['@id']}]
+    assert first['software_relation'] == [{'relationship_type': 'container for', 'software': second['@id']},
+                                          {'relationship_type': 'parent of', 'software': second['@id']}]
+
+
+def test_software_relation_invalid_target_fails_the_request(testapp):
+    """ A target that would not validate with its reverse relation fails the save with a 422,
+        and neither software is changed
+    """
+    target = _post_software(testapp, 'relation-target')
+    tool = _post_software(testapp, 'relation-tool')
+    with mock.patch.dict(SOFTWARE_RELATIONS.reverse_types, {'contained in': 'not a relationship type'}):
+        res = testapp.patch_json(tool['@id'], {'software_relation': [
+            {'relationship_type': 'contained in', 'software': target['uuid']}]}, status=422)
+    assert res.json['errors'][0]['name'] == ['software_relation']
+    assert 'software_relation' not in testapp.get(target['@id'] + '?frame=object').json
+    assert 'software_relation' not in testapp.get(tool['@id'] + '?frame=object').json
@@ -1,14 +1,15 @@
 import boto3
+import datetime
 import json
 import logging
 import os
 import structlog
-import transaction
+import threading
 
-from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from dcicutils.ecr_utils import CGAP_ECR_REGION
-from pyramid.threadlocal import get_current_request
 from pyramid.traversal import resource_path
 from dcicutils.secrets_utils import assume_identity
 from snovault import (
@@ -17,12 +18,10 @@ from snovault import (
     load_schema,
     abstract_collection,
 )
-from snovault.invalidation import add_to_indexing_queue
-from snovault.util import make_s3_client
-from snovault.types.base import (
-    Item,
-    get_item_or_none,
-)
+from snovault.types.base import Item
+from .file_format import get_file_format, get_file_format_properties
+from ..relations import ReciprocalRelations
+from ..s3_utils import S3_DELETION_QUEUE
 
 
 logging.getLogger('boto3').setLevel(logging.CRITICAL)
@@ -71,21 +70,338 @@ def show_upload_credentials(request=None, context=None, status=None):
     return request.has_permission('edit', context)
 
 
+# Scoped credentials are reused by external_creds until this many seconds before they
+# expire, so whoever receives them always has at least this long left to use them.
+DEFAULT_EXTERNAL_CREDS_EXPIRY_MARGIN = 30 * 60
+DEFAULT_EXTERNAL_CREDS_CACHE_SIZE = 10000
+# STS sessions for bulk requests are minted on a pool of at most this many threads
+DEFAULT_STS_WORKERS = 8
+
+
+class ExternalCredsCache(object):
+    """ Process-wide cache of the scoped STS credentials minted by external_creds, keyed by
+        (bucket, key, 'upload'/'download', profile_name), and by external_creds_bulk, keyed by
+        the sorted tuple of (bucket, key) pairs covered instead of one bucket and key - along
+        with the one STS client used to mint them and the bounded thread pool they are minted on.
+
+        Entries are reused until expiry_margin seconds before their Expiration, after which
+        they are treated as missing. The safety margin can be set with the
+        EXTERNAL_CREDS_EXPIRY_MARGIN environment variable (in seconds).
+    """
+
+    def __init__(self, expiry_margin=None, max_size=DEFAULT_EXTERNAL_CREDS_CACHE_SIZE, sts_workers=DEFAULT_STS_WORKERS):
+        if expiry_margin is None:
+            expiry_margin = int(os.environ.get('EXTERNAL_CREDS_EXPIRY_MARGIN', DEFAULT_EXTERNAL_CREDS_EXPIRY_MARGIN))
+        self.expiry_margin = expiry_margin
+        self.max_size = max_size
+        self.sts_workers = sts_workers
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._sts_client = None
+        self._executor = None
+        self._executor_pid = None
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.minted = 0
+        self.evictions = 0
+
+    def sts_client(self):
+        """ Returns the shared STS client, creating it on first use (boto3 clients are thread-safe) """
+        with self._lock:
+            if self._sts_client is None:
+                self._sts_client = boto3.client('sts')
+            return self._sts_client
+
+    def executor(self):
+        """ Returns the thread pool for minting STS sessions concurrently, creating it on first
+            use in this process (a forked child cannot use its parent's threads)
+        """
+        pid = os.getpid()
+        with self._lock:
+            if self._executor is None or self._executor_pid != pid:
+                self._executor = ThreadPoolExecutor(max_workers=self.sts_workers, thread_name_prefix='sts')
+                self._executor_pid = pid
+            return self._executor
+
+    def get(self, cache_key):
+        """ Returns a copy of the cached external_creds result for cache_key if it is still
+            valid for at least expiry_margin seconds, otherwise None
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expiration, result = entry
+            if (expiration - now).total_seconds() <= self.expiry_margin:
+                del self._entries[cache_key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return deepcopy(result)
+
+    def contains(self, cache_key):
+        """ Whether get(cache_key) would return credentials, without counting a hit or miss """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            return entry is not None and (entry[0] - now).total_seconds() > self.expiry_margin
+
+    def put(self, cache_key, result, expiration):
+        """ Caches an external_creds result; expiration is the datetime returned by STS.
+            Anything else (e.g. an unparseable value) is not cached.
+        """
+        with self._lock:
+            self.minted += 1
+            if not isinstance(expiration, datetime.datetime):
+                return
+            if expiration.tzinfo is None:
+                expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+            self._entries[cache_key] = (expiration, deepcopy(result))
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """ Drops all cached credentials and the shared STS client, and resets the counters """
+        with self._lock:
+            self._entries.clear()
+            self._sts_client = None
+            self.hits = self.misses = self.expired = self.minted = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'minted': self.minted,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+            }
+
+
+EXTERNAL_CREDS_CACHE = ExternalCredsCache()
+
+
+# AssumeRole rejects session policies longer than this (in characters of JSON)
+STS_SESSION_POLICY_MAX_SIZE = 2048
+
+# 2024-06-02/dmichaels; see usage comments in external_creds.
+ALLOW_FOR_RCLONE_BASED_S3_TO_S3_COPY = True
+
+
+def get_external_creds_role():
+    """ Returns the role assumed to mint scoped S3 credentials, the S3 encryption key id (or None)
+        and the policy statement granting use of that key (or None)
+    """
+    # In the new environment, extract S3 Keys from global application configuration
+    if 'IDENTITY' not in os.environ:
+        return os.environ.get('S3_UPLOAD_ROLE_ARN'), None, None
+    identity = assume_identity()
+    s3_encrypt_key_id = identity.get('ENCODED_S3_ENCRYPT_KEY_ID')
+    kms_statement = None
+    if s3_encrypt_key_id:  # must be used with ACCOUNT_NUMBER as well
+        kms_statement = {
+            'Effect': 'Allow',
+            'Action': [
+                'kms:Encrypt',
+                'kms:Decrypt',
+                'kms:ReEncrypt*',
+                'kms:GenerateDataKey*',
+                'kms:DescribeKey'
+            ],
+            'Resource': f'arn:aws:kms:{CGAP_ECR_REGION}:{identity["ACCOUNT_NUMBER"]}:key/{s3_encrypt_key_id}'
+        }
+    return identity.get('S3_UPLOAD_ROLE_ARN'), s3_encrypt_key_id, kms_statement
+
+
+def build_scoped_policies(objects, upload=False, kms_statement=None, max_size=STS_SESSION_POLICY_MAX_SIZE):
+    """ Packs grants on the given (bucket, key) pairs into as few session policies as fit within
+        max_size, keeping their order. Yields (policy, objects covered) pairs.
+
+        Download policies allow s3:GetObject on each key. Upload policies allow s3:GetObject and
+        s3:PutObject, plus s3:ListBucket limited to each key as a prefix (as external_creds does).
+    """
+    def new_policy():
+        actions = ["s3:GetObject", "s3:PutObject"] if upload else ["s3:GetObject"]
+        policy = {
+            "Version": "2012-10-17",
+            "Statement": [{"Action": actions, "Resource": [], "Effect": "Allow"}]
+        }
+        if kms_statement is not None:
+            policy['Statement'].append(kms_statement)
+        return policy
+
+    def add(policy, bucket, key):
+        """ Adds the grants for bucket/key to policy, returning whether it still fits """
+        policy['Statement'][0]['Resource'].append(f"arn:aws:s3:::{bucket}/{key}")
+        if upload and ALLOW_FOR_RCLONE_BASED_S3_TO_S3_COPY:
+            bucket_arn = f"arn:aws:s3:::{bucket}"
+            for statement in policy['Statement']:
+                if statement.get('Resource') == [bucket_arn] and 's3:ListBucket' in statement['Action']:
+                    break
+            else:
+                statement = {
+                    "Action": ["s3:ListBucket"],
+                    "Resource": [bucket_arn],
+                    "Condition": {"StringLike": {"s3:prefix": []}},
+                    "Effect": "Allow"
+                }
+                policy['Statement'].append(statement)
+            statement['Condition']['StringLike']['s3:prefix'].append(key)
+        return len(json.dumps(policy, separators=(',', ':'))) <= max_size
+
+    policy, covered = new_policy(), []
+    for bucket, key in objects:
+        candidate = deepcopy(policy)
+        if add(candidate, bucket, key):
+            policy = candidate
+            covered.append((bucket, key))
+            continue
+        if not covered:
+            raise ValueError(f'Key too long for a session policy: s3://{bucket}/{key}')
+        yield policy, covered
+        policy, covered = new_policy(), [(bucket, key)]
+        if not add(policy, bucket, key):
+            raise ValueError(f'Key too long for a session policy: s3://{bucket}/{key}')
+    if covered:
+        yield policy, covered
+
+
+def external_creds_bulk(objects, name, profile_name=None, upload=False, max_policy_size=STS_SESSION_POLICY_MAX_SIZE):
+    """ Returns scoped credentials for many (bucket, key) pairs at once - one STS session per policy
+        from build_scoped_policies rather than one per object, with the sessions minted
+        concurrently on EXTERNAL_CREDS_CACHE's bounded pool. Each credential set is returned as
+        {'service', 'objects': [{'bucket', 'key'}], '<upload/download>_credentials'}, in the order
+        of the objects given.
+
+        Each credential set is cached under the whole (sorted) set of objects its policy covers,
+        so a repeated request for the same objects reuses it. It is never cached per object:
+        it grants access to every object in its set, so external_creds must not hand it out for
+        any single one of them - see mint_external_creds for warming the per-object cache.
+    """
+    logging.getLogger('boto3').setLevel(logging.CRITICAL)
+    if not objects:
+        return []
+    upload_or_download = 'upload' if upload else 'download'
+    role_arn, s3_encrypt_key_id, kms_statement = get_external_creds_role()
+    conn = EXTERNAL_CREDS_CACHE.sts_client()
+
+    def mint(policy_and_covered):
+        policy, covered = policy_and_covered
+        cache_key = (tuple(sorted(covered)), upload_or_download, profile_name)
+        cached = EXTERNAL_CREDS_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+        token = conn.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=name,
+            Policy=json.dumps(policy, separators=(',', ':'))
+        )
+        credentials = token.get('Credentials')
+        expiration = credentials['Expiration']
+        credentials['Expiration'] = str(credentials['Expiration'])
+        credentials.update({
+            'federated_user_arn': token.get('AssumedRoleUser').get('Arn'),
+            'federated_user_id': token.get('AssumedRoleUser').get('AssumedRoleId'),
+            's3_encrypt_key_id': s3_encrypt_key_id,
+            'request_id': token.get('ResponseMetadata').get('RequestId'),
+        })
+        result = {
+            'service': 's3',
+            'objects': [{'bucket': bucket, 'key': key} for bucket, key in covered],
+            f'{upload_or_download}_credentials': credentials,
+        }
+        EXTERNAL_CREDS_CACHE.put(cache_key, result, expiration)
+        return result
+
+    policies = list(build_scoped_policies(objects, upload, kms_statement, max_policy_size))
+    if len(policies) == 1:
+        return [mint(policies[0])]
+    return list(EXTERNAL_CREDS_CACHE.executor().map(mint, policies))
+
+
+def external_creds_reusable(external, bucket, key, upload=True):
+    """ Whether external - a propsheet saved from external_creds - holds credentials for bucket/key
+        that remain valid for longer than the EXTERNAL_CREDS_CACHE expiry margin. This lets a file
+        keep the credentials it already has, including ones minted by another process.
+    """
+    if not external or external.get('bucket') != bucket or external.get('key') != key:
+        return False
+    expiration = (external.get('upload_credentials' if upload else 'download_credentials') or {}).get('Expiration')
+    try:
+        expiration = datetime.datetime.fromisoformat(str(expiration))
+    except ValueError:
+        return False
+    if expiration.tzinfo is None:
+        expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+    remaining = expiration - datetime.datetime.now(datetime.timezone.utc)
+    return remaining.total_seconds() > EXTERNAL_CREDS_CACHE.expiry_margin
+
+
+def mint_external_creds(objects, profile_name=None, upload=True):
+    """ Mints external_creds for each (bucket, key, name) in objects that is not already cached,
+        concurrently on EXTERNAL_CREDS_CACHE's bounded pool, so that later external_creds calls
+        for them are cache hits. Each object still gets its own session, scoped to its key alone
+        and named name (the file name, see File.build_upload_session_name) as external_creds does.
+        Returns the results minted, in the order of the objects given.
+    """
+    upload_or_download = 'upload' if upload else 'download'
+    to_mint = OrderedDict()
+    for bucket, key, name in objects:
+        if not EXTERNAL_CREDS_CACHE.contains((bucket, key, upload_or_download, profile_name)):
+            to_mint.setdefault((bucket, key), name)
+    objects = [(bucket, key, name) for (bucket, key), name in to_mint.items()]
+
+    def mint(bucket_key_and_name):
+        bucket, key, name = bucket_key_and_name
+        return external_creds(bucket, key, name=name, profile_name=profile_name, upload=upload)
+
+    if len(objects) <= 1:
+        return [mint(obj) for obj in objects]
+    return list(EXTERNAL_CREDS_CACHE.executor().map(mint, objects))
+
+
+def prefetch_upload_creds(registry, files):
+    """ Batch API for bulk submissions: mints the upload credentials that creating or updating
+        each of files would otherwise mint one by one (see File.build_upload_objects) concurrently,
+        so File.create/_update then find them cached. files is a list of (File class, uuid,
+        properties). Call this before making any writes, so the STS round trips are not made
+        while the transaction holds locks.
+        Returns the credentials minted.
+    """
+    profile_name = registry.settings.get('file_upload_profile_name')
+    objects = []
+    for file_cls, uuid, properties in files:
+        objects.extend(file_cls.build_upload_objects(registry, uuid, properties))
+    return mint_external_creds(objects, profile_name=profile_name, upload=True)
+
+
 def external_creds(bucket, key, name=None, profile_name=None, upload=True):
     """
     if name is None, we want the link to s3 but no need to generate
     an access token.  This is useful for linking metadata to files that
     already exist on s3.
-    """
 
-    # 2024-06-02/dmichaels; see usage comments below.
-    ALLOW_FOR_RCLONE_BASED_S3_TO_S3_COPY = True
+    Credentials are served from EXTERNAL_CREDS_CACHE while they remain valid,
+    so repeated calls for the same object do not each go to STS.
+    """
 
     logging.getLogger('boto3').setLevel(logging.CRITICAL)
     credentials = {}
     upload_or_download = 'upload' if upload else 'download'  # upload is the default
     s3_encrypt_key_id = None  # might be reassigned later from identity.get('ENCODED_S3_ENCRYPT_KEY_ID')
+    cache_key = (bucket, key, upload_or_download, profile_name)
     if name is not None:
+        cached = EXTERNAL_CREDS_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
         policy = {
             "Version": "2012-10-17",
             "Statement": [
@@ -129,26 +445,10 @@ def external_creds(bucket, key, name=None, profile_name=None, upload=True):
                     },
                     "Effect": "Allow"
                 })
-        # In the new environment, extract S3 Keys from global application configuration
-        if 'IDENTITY' in os.environ:
-            identity = assume_identity()
-            s3_encrypt_key_id = identity.get('ENCODED_S3_ENCRYPT_KEY_ID')
-            if s3_encrypt_key_id:  # must be used with ACCOUNT_NUMBER as well
-                policy['Statement'].append({  # NoQA - PyCharm doesn't like this append for some bogus reason
-                    'Effect': 'Allow',
-                    'Action': [
-                        'kms:Encrypt',
-                        'kms:Decrypt',
-                        'kms:ReEncrypt*',
-                        'kms:GenerateDataKey*',
-                        'kms:DescribeKey'
-                    ],
-                    'Resource': f'arn:aws:kms:{CGAP_ECR_REGION}:{identity["ACCOUNT_NUMBER"]}:key/{s3_encrypt_key_id}'
-                })
-            role_arn = identity.get('S3_UPLOAD_ROLE_ARN')
-        else:
-            role_arn = os.environ.get('S3_UPLOAD_ROLE_ARN')
-        conn = boto3.client('sts')
+        role_arn, s3_encrypt_key_id, kms_statement = get_external_creds_role()
+        if kms_statement is not None:
+            policy['Statement'].append(kms_statement)
+        conn = EXTERNAL_CREDS_CACHE.sts_client()
         token = conn.assume_role(
             RoleArn=role_arn,
             RoleSessionName=name,
@@ -156,6 +456,7 @@ def external_creds(bucket, key, name=None, profile_name=None, upload=True):
         )
         # 'access_key' 'secret_key' 'expiration' 'session_token'
         credentials = token.get('Credentials')
+        expiration = credentials['Expiration']
         # Convert Expiration datetime object to string via cast
         # Uncaught serialization error picked up by Docker - Will 2/25/2021
         credentials['Expiration'] = str(credentials['Expiration'])
@@ -167,27 +468,118 @@ def external_creds(bucket, key, name=None, profile_name=None, upload=True):
             'request_id': token.get('ResponseMetadata').get('RequestId'),
             'key': key
         })
-    return {
+    result = {
         'service': 's3',
         'bucket': bucket,
         'key': key,
         f'{upload_or_download}_credentials': credentials,
     }
+    if name is not None:
+        EXTERNAL_CREDS_CACHE.put(cache_key, result, expiration)
+    return result
+
+
+# statuses of linked items that are left out of rev links and provenance graphs
+FILTERED_REV_STATUSES = ('deleted', 'replaced')
 
 
-def property_closure(request, propname, root_uuid):
-    # Must avoid cycles
+def iter_items(request, uuids):
+    """ Yields (uuid, Item) for those of uuids that exist, loading each only as it is reached.
+        Items are loaded through the connection, so from Elasticsearch when the request reads
+        from it and from the item cache when already loaded this request
+    """
     conn = request.registry[CONNECTION]
-    seen = set()
-    remaining = {str(root_uuid)}
-    while remaining:
-        seen.update(remaining)
-        next_remaining = set()
-        for uuid in remaining:
-            obj = conn.get_by_uuid(uuid)
-            next_remaining.update(obj.__json__(request).get(propname, ()))
-        remaining = next_remaining - seen
-    return seen
+    for uuid in dict.fromkeys(str(uuid) for uuid in uuids):
+        item = conn.get_by_uuid(uuid)
+        if item is not None:
+            yield uuid, item
+
+
+def load_items(request, uuids):
+    """ Returns {uuid: Item} for those of uuids that exist """
+    return dict(iter_items(request, uuids))
+
+
+def get_property_values(request, uuids, propname):
+    """ Returns {uuid: value of propname} for the items in uuids that have it, read from their
+        upgraded properties - rather than building and rendering each item
+    """
+    values = {}
+    for uuid, item in load_items(request, uuids).items():
+        value = (item.upgrade_properties() or {}).get(propname)
+        if value is not None:
+            values[uuid] = value
+    return values
+
+
+def get_links(request, uuids, rels, reverse=False):
+    """ Returns (source, rel, target) uuid triples for the links named in rels (e.g. WorkflowRun
+        'input_files.value') from any of uuids - or to any of them if reverse
+    """
+    conn = request.registry[CONNECTION]
+    links = []
+    for uuid, item in load_items(request, uuids).items():
+        if reverse:
+            for rel in rels:
+                links.extend((str(source), rel, uuid) for source in conn.get_rev_links(item.db_model, rel))
+        else:
+            item_links = item.links(item.upgrade_properties() or {})
+            for rel in rels:
+                links.extend((uuid, rel, str(target)) for target in sorted(item_links.get(rel, ())))
+    return links
+
+
+def iter_property_closure(request, propname, root_uuid, max_depth=None, max_size=None):
+    """ Yields (uuid, depth) for root_uuid and every item reachable from it through propname
+        (a list of uuids, e.g. produced_from), breadth first. Each level is fetched with one
+        get_property_values call. Expansion stops below max_depth, and iteration after
+        max_size items, when given. Cycles are followed only once.
+    """
+    root_uuid = str(root_uuid)
+    seen = {root_uuid}
+    frontier = [root_uuid]
+    depth = 0
+    remaining = max_size
+    while frontier:
+        if remaining is not None:
+            frontier = frontier[:remaining]
+            remaining -= len(frontier)
+        for uuid in frontier:
+            yield uuid, depth
+        if remaining == 0 or (max_depth is not None and depth >= max_depth):
+            return
+        values = get_property_values(request, frontier, propname)
+        next_frontier = []
+        for uuid in frontier:
+            for linked in values.get(uuid, ()):
+                linked = str(linked)
+                if linked not in seen:
+                    seen.add(linked)
+                    next_frontier.append(linked)
+        frontier = next_frontier
+        depth += 1
+
+
+def property_closure(request, propname, root_uuid, max_depth=None, max_size=None):
+    """ Returns the set of uuids in iter_property_closure """
+    return {uuid for uuid, _ in iter_property_closure(request, propname, root_uuid,
+                                                      max_depth=max_depth, max_size=max_size)}
+
+
+# At most this many WorkflowRun rev links are rendered (and so embedded and indexed) per file.
+# Reference files and common inputs are used by tens of thousands of runs; their
+# workflow_run_*_count properties give the totals and @@workflow_runs pages through them all.
+MAX_EMBEDDED_REV_LINKS = 100
+
+
+# keeps related_files symmetric - the target of each entry gets the reverse relationship
+RELATED_FILES = ReciprocalRelations('File', 'related_files', 'file', {
+    "derived from": "parent of",
+    "parent of": "derived from",
+    "supercedes": "is superceded by",
+    "is superceded by": "supercedes",
+    "paired with": "paired with"
+})
 
 
 def _build_file_embedded_list():
@@ -225,6 +617,8 @@ class File(Item):
     SHOW_UPLOAD_CREDENTIALS_STATUSES = (
         'uploading', 'to be uploaded by workflow', 'upload failed'
     )
+    # deleted and replaced workflow runs are neither rendered nor counted in rev links
+    filtered_rev_statuses = FILTERED_REV_STATUSES
 
     @calculated_property(schema={
         "title": "Display Title",
@@ -233,7 +627,7 @@ class File(Item):
     })
     def display_title(self, request, file_format, accession=None, external_accession=None):
         accession = accession or external_accession
-        file_format_item = get_item_or_none(request, file_format, 'file-formats')
+        file_format_item = get_file_format(request, file_format)
         try:
             file_extension = '.' + file_format_item.get('standard_file_extension')
         except AttributeError:
@@ -247,7 +641,7 @@ class File(Item):
     })
     def file_type_detailed(self, request, file_format, file_type=None):
         outString = (file_type or 'other')
-        file_format_item = get_item_or_none(request, file_format, 'file-formats')
+        file_format_item = get_file_format(request, file_format)
         try:
             fformat = file_format_item.get('file_format')
             outString = outString + ' (' + fformat + ')'
@@ -296,7 +690,11 @@ class File(Item):
 
         # don't get new creds
         if properties.get('status', None) in self.SHOW_UPLOAD_CREDENTIALS_STATUSES:
-            new_creds = self.build_external_creds(self.registry, uuid, properties)
+            # an unrelated edit to a file still uploading keeps its credentials - only a new
+            # key or credentials close to expiry need another trip to STS
+            key = self.build_upload_key(self.registry, uuid, properties)
+            if not external_creds_reusable(old_creds, self.get_bucket(self.registry), key):
+                new_creds = self.build_external_creds(self.registry, uuid, properties)
             sheets['external'] = new_creds
 
         # handle extra files
@@ -313,17 +711,15 @@ class File(Item):
                 at_id += '/'
 
             file_formats = []
+            xfiles = []
             for xfile in extra_files:
                 # ensure a file_format (identifier for extra_file) is given and non-null
                 if not ('file_format' in xfile and bool(xfile['file_format'])):
                     continue
-                eformat = xfile['file_format']
-                if eformat.startswith('/file-formats/'):
-                    eformat = eformat[len('/file-formats/'):-1]
-                xfile_format = self.registry['collections']['FileFormat'].get(eformat)
-                xff_uuid = str(xfile_format.uuid)
-                if not xff_uuid:
+                xfile_format = get_file_format_properties(self.registry, xfile['file_format'])
+                if xfile_format is None:
                     raise Exception("Cannot find format item for the extra file")
+                xff_uuid = xfile_format['uuid']
 
                 if xff_uuid in file_formats:
                     raise Exception("Each file in extra_files must have unique file_format")
@@ -333,13 +729,30 @@ class File(Item):
                 xfile['accession'] = properties.get('accession')
                 # just need a filename to trigger creation of credentials
                 xfile_name = xfile.get("filename")
-                file_extension = xfile_format.properties.get('standard_file_extension')
+                file_extension = xfile_format.get('standard_file_extension')
                 if xfile_name is None:  # assume if its already there its correct
                     xfile['filename'] = '{}.{}'.format(xfile['accession'], file_extension)
                 xfile['uuid'] = str(uuid)
                 # if not 'status' in xfile or not bool(xfile['status']):
                 #    xfile['status'] = properties.get('status')
-                ext = self.build_external_creds(self.registry, uuid, xfile)
+                xfiles.append((xfile, file_extension))
+
+            # keep extra file credentials that are still good for an unchanged key, and mint
+            # the rest concurrently rather than one after another
+            bucket = self.get_bucket(self.registry)
+            reusable, to_mint = {}, []
+            for xfile, _ in xfiles:
+                key = self.build_upload_key(self.registry, uuid, xfile)
+                old_ext = self.propsheets.get('external' + xfile['file_format'])
+                if external_creds_reusable(old_ext, bucket, key):
+                    reusable[xfile['file_format']] = old_ext
+                else:
+                    to_mint.append((bucket, key, self.build_upload_session_name(xfile)))
+            if len(to_mint) > 1:
+                mint_external_creds(to_mint, profile_name=self.registry.settings.get('file_upload_profile_name'))
+
+            for xfile, file_extension in xfiles:
+                ext = reusable.get(xfile['file_format']) or self.build_external_creds(self.registry, uuid, xfile)
                 # build href
                 filename = '{}.{}'.format(xfile['accession'], file_extension)
                 xfile['href'] = at_id + '@@download/' + filename
@@ -352,68 +765,16 @@ class File(Item):
 
         if old_creds:
             if old_creds.get('key') != new_creds.get('key'):
-                try:
-                    conn = make_s3_client()
-                    bname = old_creds['bucket']
-                    conn.delete_object(Bucket=bname, Key=old_creds['key'])
-                except Exception as e:
-                    print(e)
+                # the old object is superseded - delete it in the background once (and only if) this commits
+                S3_DELETION_QUEUE.delete_after_commit(self.registry, old_creds['bucket'], old_creds['key'])
 
         # update self first to ensure 'related_files' are stored in self.properties
         super(File, self)._update(properties, sheets)
 
-        # handle related_files. This is quite janky; must manually invalidate
-        # the relation made on `related_fl` item because we are calling its
-        # update() method directly, which circumvents snovault.crud_view.item_edit
-        DicRefRelation = {
-            "derived from": "parent of",
-            "parent of": "derived from",
-            "supercedes": "is superceded by",
-            "is superceded by": "supercedes",
-            "paired with": "paired with"
-        }
-
+        # the reverse of each related_files entry is added to its target when this commits,
+        # once per target however many files in the transaction point at it
         if 'related_files' in properties:
-            my_uuid = str(self.uuid)
-            # save these values
-            curr_txn = None
-            curr_request = None
-            for relation in properties["related_files"]:
-                try:
-                    switch = relation["relationship_type"]
-                    rev_switch = DicRefRelation[switch]
-                    related_fl = relation["file"]
-                    relationship_entry = {"relationship_type": rev_switch, "file": my_uuid}
-                except Exception:
-                    log.error('Error updating related_files on %s _update. %s'
-                              % (my_uuid, relation))
-                    continue
-
-                target_fl = self.collection.get(related_fl)
-                target_fl_props = deepcopy(target_fl.properties)
-                # This is a cool python feature. If break is not hit in the loop,
-                # go to the `else` statement. Works for empty lists as well
-                for target_relation in target_fl_props.get('related_files', []):
-                    if (target_relation.get('file') == my_uuid
-                            and target_relation.get('relationship_type') == rev_switch):
-                        break
-                else:
-                    # Get the current request in order to queue the forced
-                    # update for indexing. This is bad form.
-                    # Don't do this anywhere else, please!
-                    if curr_txn is None:
-                        curr_txn = transaction.get()
-                    if curr_request is None:
-                        curr_request = get_current_request()
-                    # handle related_files whether or not any currently exist
-                    target_related_files = target_fl_props.get('related_files', [])
-                    target_related_files.append(relationship_entry)
-                    target_fl_props.update({'related_files': target_related_files})
-                    target_fl._update(target_fl_props)
-                    to_queue = {'uuid': str(target_fl.uuid), 'sid': target_fl.sid,
-                                'info': 'queued from %s _update' % my_uuid}
-                    curr_txn.addAfterCommitHook(add_to_indexing_queue,
-                                                args=(curr_request, to_queue, 'edit'))
+            RELATED_FILES.add(self, properties['related_files'])
 
     @property
     def __name__(self):
@@ -440,7 +801,7 @@ class File(Item):
 
     @calculated_property(schema=HREF_SCHEMA)
     def href(self, request, file_format, accession=None, external_accession=None):
-        fformat = get_item_or_none(request, file_format, 'file-formats')
+        fformat = get_file_format(request, file_format)
         try:
             file_extension = '.' + fformat.get('standard_file_extension')
         except AttributeError:
@@ -451,15 +812,10 @@ class File(Item):
 
     @calculated_property(schema=UPLOAD_KEY_SCHEMA)
     def upload_key(self, request):
-        properties = self.properties
         external = self.propsheets.get('external', {})
         if not external:
-            try:
-                external = self.build_external_creds(self.registry, self.uuid, properties)
-            except ClientError:
-                log.error(os.environ)
-                log.error(properties)
-                return 'UPLOAD KEY FAILED'
+            # derive the key rather than minting credentials - this runs on every render/index
+            return self.build_upload_key(self.registry, self.uuid, self.properties)
         return external['key']
 
     @calculated_property(
@@ -479,10 +835,10 @@ class File(Item):
             extras = []
             for extra in self.properties.get('extra_files', []):
                 eformat = extra.get('file_format')
-                xfile_format = self.registry['collections']['FileFormat'].get(eformat)
+                xfile_format = get_file_format_properties(self.registry, eformat)
                 try:
-                    xff_uuid = str(xfile_format.uuid)
-                except AttributeError:
+                    xff_uuid = xfile_format['uuid']
+                except TypeError:
                     print("Can't find required format uuid for %s" % eformat)
                     continue
                 extra_creds = self.propsheets.get('external' + xff_uuid)
@@ -490,31 +846,91 @@ class File(Item):
                 extras.append(extra)
             return extras
 
+    def filtered_rev_link_uuids(self, request, name):
+        """ Like get_filtered_rev_links, but reads the status of each linked item from its upgraded
+            properties instead of rendering it, and returns them in a stable (uuid) order for paging.
+            Computed once per request for each item and rev link, so the capped list of links
+            and their count (e.g. workflow_run_inputs and workflow_run_inputs_count) share it.
+        """
+        computed = getattr(request, '_filtered_rev_link_uuids', None)
+        if computed is None:
+            computed = request._filtered_rev_link_uuids = {}
+        key = (str(self.uuid), name)
+        if key in computed:
+            return computed[key]
+        rev_uuids = sorted(str(rev_id) for rev_id in self.get_rev_links(request, name))
+        statuses = get_property_values(request, rev_uuids, 'status')
+        filtered_uuids = [rev_id for rev_id in rev_uuids if statuses.get(rev_id) not in self.filtered_rev_statuses]
+        if request._indexing_view is True:
+            # all of them, not just those embedded - any can change the counts
+            request._rev_linked_uuids_by_item.setdefault(str(self.uuid), {})[name] = filtered_uuids
+        computed[key] = filtered_uuids
+        return filtered_uuids
+
+    def capped_rev_link_atids(self, request, name, limit=MAX_EMBEDDED_REV_LINKS):
+        """ rev_link_atids limited to the first `limit` - the rest are paged by @@workflow_runs """
+        conn = request.registry[CONNECTION]
+        return [request.resource_path(conn[rev_id]) for rev_id in self.filtered_rev_link_uuids(request, name)[:limit]]
+
     @classmethod
     def get_bucket(cls, registry):
         return registry.settings['file_upload_bucket']
 
     @classmethod
-    def build_external_creds(cls, registry, uuid, properties):
-        bucket = cls.get_bucket(registry)
-        fformat = properties.get('file_format')
-        if fformat.startswith('/file-formats/'):
-            fformat = fformat[len('/file-formats/'):-1]
-        prop_format = registry['collections']['FileFormat'].get(fformat)
+    def build_upload_key(cls, registry, uuid, properties):
+        """ Returns the S3 key for the file (or extra file) described by properties. This is a
+            pure function of uuid, accession and FileFormat extension - no AWS calls are made.
+        """
+        prop_format = get_file_format_properties(registry, properties.get('file_format'))
         try:
-            file_extension = prop_format.properties['standard_file_extension']
-        except KeyError:
+            file_extension = prop_format['standard_file_extension']
+        except (KeyError, TypeError):
             raise Exception('File format not in list of supported file types')
-        key = '{uuid}/{accession}.{file_extension}'.format(
+        return '{uuid}/{accession}.{file_extension}'.format(
             file_extension=file_extension, uuid=uuid,
             accession=properties.get('accession'))
 
+    @classmethod
+    def build_external_location(cls, registry, uuid, properties):
+        """ Like build_external_creds, but without minting any credentials """
+        return external_creds(cls.get_bucket(registry), cls.build_upload_key(registry, uuid, properties))
+
+    @classmethod
+    def build_upload_objects(cls, registry, uuid, properties):
+        """ Returns the (bucket, key, session name) of every object that create/_update would mint
+            upload credentials for given these properties - the file itself if it has a filename
+            and is in an upload status, and each of its extra files
+        """
+        bucket = cls.get_bucket(registry)
+        objects = []
+        if properties.get('status') in cls.SHOW_UPLOAD_CREDENTIALS_STATUSES and properties.get('filename'):
+            objects.append((bucket, cls.build_upload_key(registry, uuid, properties),
+                            cls.build_upload_session_name(properties)))
+        for xfile in properties.get('extra_files', []):
+            if xfile.get('file_format'):
+                xfile = dict(xfile, accession=properties.get('accession'))
+                key = cls.build_upload_key(registry, uuid, xfile)
+                # _update names extra files without a filename {accession}.{extension}, as in the key
+                xfile.setdefault('filename', key.split('/')[-1])
+                objects.append((bucket, key, cls.build_upload_session_name(xfile)))
+        return objects
+
+    @staticmethod
+    def build_upload_session_name(properties):
+        """ Returns the STS session name upload credentials for properties are minted with, so
+            CloudTrail attributes them to the file - or None if it has no filename to upload
+        """
         # remove the path from the file name and only take first 32 chars
         fname = properties.get('filename')
-        name = None
         if fname:
-            name = fname.split('/')[-1][:32]
+            return fname.split('/')[-1][:32]
+        return None
 
+    @classmethod
+    def build_external_creds(cls, registry, uuid, properties):
+        bucket = cls.get_bucket(registry)
+        key = cls.build_upload_key(registry, uuid, properties)
+        name = cls.build_upload_session_name(properties)
         profile_name = registry.settings.get('file_upload_profile_name')
         return external_creds(bucket, key, name, profile_name)
 
@@ -525,5 +941,8 @@ class File(Item):
             sheets['external'] = cls.build_external_creds(registry, uuid, properties)
         return super(File, cls).create(registry, uuid, properties, sheets)
 
+    class AbstractCollection(Item.AbstractCollection):
+        """ The /files/ collection of every File type, so views can be registered on it """
+
     class Collection(Item.Collection):
         pass
@@ -1,9 +1,139 @@
+import threading
+import time
+import transaction
+from copy import deepcopy
 from snovault import (
     calculated_property,
     collection,
     load_schema,
 )
 from snovault.attachment import ItemWithAttachment
+from snovault.types.base import get_item_or_none
+
+
+# Upper bound (in seconds) on how long a cached FileFormat is trusted. Edits made
+# in this process invalidate the cache immediately; this bounds staleness for
+# edits made by other app/indexer processes, which we are not notified of.
+FILE_FORMAT_CACHE_MAX_AGE = 10 * 60
+
+FILE_FORMATS_PATH_PREFIX = '/file-formats/'
+
+
+class FileFormatCache(object):
+    """ Process-wide cache of FileFormat items, keyed by uuid, file_format name and @id.
+
+        There are only a few dozen FileFormats but they are resolved for nearly every
+        File rendered, validated or downloaded, so caching them avoids an embed (or
+        collection lookup) per use. Two views are cached separately:
+            * the @@object frame, as returned by get_item_or_none (see get_object)
+            * the raw item properties plus uuid, for registry-only callers (see get_properties)
+        Any edit to a FileFormat clears both (see FileFormat._update).
+    """
+
+    def __init__(self, max_age=FILE_FORMAT_CACHE_MAX_AGE):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._objects = {}
+        self._properties = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize(value):
+        """ Reduces a FileFormat identifier (uuid, name, @id or a dict with either) to a cache key """
+        if isinstance(value, dict):
+            value = value.get('uuid') or value.get('@id')
+        if not value:
+            return None
+        value = str(value)
+        if value.startswith(FILE_FORMATS_PATH_PREFIX):
+            value = value[len(FILE_FORMATS_PATH_PREFIX):]
+        return value.strip('/') or None
+
+    def _lookup(self, entries, key):
+        with self._lock:
+            entry = entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.max_age:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def _store(self, entries, value, aliases):
+        now = time.time()
+        with self._lock:
+            for alias in aliases:
+                alias = self.normalize(alias)
+                if alias:
+                    entries[alias] = (now, value)
+
+    def get_object(self, request, value):
+        """ Cached equivalent of get_item_or_none(request, value, 'file-formats') """
+        key = self.normalize(value)
+        if key is None:
+            return None
+        file_format = self._lookup(self._objects, key)
+        if file_format is None:
+            file_format = get_item_or_none(request, value, 'file-formats')
+            if file_format is None:
+                return None
+            self._store(self._objects, deepcopy(file_format),
+                        [key, file_format.get('uuid'), file_format.get('file_format'), file_format.get('@id')])
+            return file_format
+        # a cache hit bypasses request.embed, so record the link ourselves - otherwise
+        # items rendered for indexing would not be invalidated when this format changes
+        linked_uuids = getattr(request, '_linked_uuids', None)
+        if linked_uuids is not None and file_format.get('uuid'):
+            linked_uuids.add(file_format['uuid'])
+        return deepcopy(file_format)
+
+    def get_properties(self, registry, value):
+        """ Cached equivalent of registry['collections']['FileFormat'].get(value), returning
+            the item properties (with 'uuid' set) instead of the resource itself
+        """
+        key = self.normalize(value)
+        if key is None:
+            return None
+        properties = self._lookup(self._properties, key)
+        if properties is None:
+            item = registry['collections']['FileFormat'].get(key)
+            if item is None:
+                return None
+            properties = dict(item.properties, uuid=str(item.uuid))
+            self._store(self._properties, properties, [key, properties['uuid'], properties.get('file_format')])
+        return deepcopy(properties)
+
+    def invalidate(self, *args):
+        """ Drops all cached FileFormats. Accepts (and ignores) the status argument passed
+            to transaction after-commit hooks so it can be registered as one directly.
+        """
+        with self._lock:
+            self._objects.clear()
+            self._properties.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'size': len(self._objects) + len(self._properties),
+            }
+
+
+FILE_FORMAT_CACHE = FileFormatCache()
+
+
+def get_file_format(request, value):
+    """ Returns the @@object frame of the FileFormat identified by value, or None """
+    return FILE_FORMAT_CACHE.get_object(request, value)
+
+
+def get_file_format_properties(registry, value):
+    """ Returns the properties (including uuid) of the FileFormat identified by value, or None """
+    return FILE_FORMAT_CACHE.get_properties(registry, value)
 
 
 @collection(
@@ -20,6 +150,13 @@ class FileFormat(ItemWithAttachment):
     schema = load_schema('encoded_core:schemas/file_format.json')
     name_key = 'file_format'
 
+    def _update(self, properties, sheets=None):
+        super(FileFormat, self)._update(properties, sheets)
+        # drop now so this request sees the edit, and again once committed in case
+        # another request re-cached the old value in the meantime
+        FILE_FORMAT_CACHE.invalidate()
+        transaction.get().addAfterCommitHook(FILE_FORMAT_CACHE.invalidate)
+
     @calculated_property(schema={
         "title": "Display Title",
         "description": "File Format name or extension.",
@@ -33,7 +33,7 @@ class FileProcessed(File):
 
     @calculated_property(schema={
         "title": "Input of Workflow Runs",
-        "description": "All workflow runs that this file serves as an input to",
+        "description": "Workflow runs that this file serves as an input to (at most 100, see @@workflow_runs)",
         "type": "array",
         "items": {
             "title": "Input of Workflow Run",
@@ -44,13 +44,13 @@ class FileProcessed(File):
     def workflow_run_inputs(self, request, disable_wfr_inputs=False):
         # switch this calc prop off for some processed files, i.e. control exp files
         if not disable_wfr_inputs:
-            return self.rev_link_atids(request, "workflow_run_inputs")
+            return self.capped_rev_link_atids(request, "workflow_run_inputs")
         else:
             return []
 
     @calculated_property(schema={
         "title": "Output of Workflow Runs",
-        "description": "All workflow runs that this file serves as an output from",
+        "description": "Workflow runs that this file serves as an output from (at most 100, see @@workflow_runs)",
         "type": "array",
         "items": {
             "title": "Output of Workflow Run",
@@ -59,7 +59,25 @@ class FileProcessed(File):
         }
     })
     def workflow_run_outputs(self, request):
-        return self.rev_link_atids(request, "workflow_run_outputs")
+        return self.capped_rev_link_atids(request, "workflow_run_outputs")
+
+    @calculated_property(schema={
+        "title": "Number of Workflow Runs Using This File",
+        "description": "Number of workflow runs that this file serves as an input to",
+        "type": "integer"
+    })
+    def workflow_run_inputs_count(self, request, disable_wfr_inputs=False):
+        if disable_wfr_inputs:
+            return 0
+        return len(self.filtered_rev_link_uuids(request, "workflow_run_inputs"))
+
+    @calculated_property(schema={
+        "title": "Number of Workflow Runs Producing This File",
+        "description": "Number of workflow runs that this file serves as an output from",
+        "type": "integer"
+    })
+    def workflow_run_outputs_count(self, request):
+        return len(self.filtered_rev_link_uuids(request, "workflow_run_outputs"))
 
     # processed files don't want md5 as unique key
     def unique_keys(self, properties):
@@ -34,7 +34,7 @@ class FileSubmitted(File):
 
     @calculated_property(schema={
         "title": "Input of Workflow Runs",
-        "description": "All workflow runs that this file serves as an input to",
+        "description": "Workflow runs that this file serves as an input to (at most 100, see @@workflow_runs)",
         "type": "array",
         "items": {
             "title": "Input of Workflow Run",
@@ -43,11 +43,11 @@ class FileSubmitted(File):
         }
     })
     def workflow_run_inputs(self, request):
-        return self.rev_link_atids(request, "workflow_run_inputs")
+        return self.capped_rev_link_atids(request, "workflow_run_inputs")
 
     @calculated_property(schema={
         "title": "Output of Workflow Runs",
-        "description": "All workflow runs that this file serves as an output from",
+        "description": "Workflow runs that this file serves as an output from (at most 100, see @@workflow_runs)",
         "type": "array",
         "items": {
             "title": "Output of Workflow Run",
@@ -56,5 +56,21 @@ class FileSubmitted(File):
         }
     })
     def workflow_run_outputs(self, request):
-        return self.rev_link_atids(request, "workflow_run_outputs")
+        return self.capped_rev_link_atids(request, "workflow_run_outputs")
+
+    @calculated_property(schema={
+        "title": "Number of Workflow Runs Using This File",
+        "description": "Number of workflow runs that this file serves as an input to",
+        "type": "integer"
+    })
+    def workflow_run_inputs_count(self, request):
+        return len(self.filtered_rev_link_uuids(request, "workflow_run_inputs"))
+
+    @calculated_property(schema={
+        "title": "Number of Workflow Runs Producing This File",
+        "description": "Number of workflow runs that this file serves as an output from",
+        "type": "integer"
+    })
+    def workflow_run_outputs_count(self, request):
+        return len(self.filtered_rev_link_uuids(request, "workflow_run_outputs"))
 
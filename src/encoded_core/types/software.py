@@ -10,6 +10,16 @@ from snovault import (
 from snovault.types.base import (
     Item,
 )
+from ..relations import ReciprocalRelations
+
+
+# keeps software_relation symmetric - the target of each entry gets the reverse relationship
+SOFTWARE_RELATIONS = ReciprocalRelations('Software', 'software_relation', 'software', {
+    "derived from": "parent of",
+    "parent of": "derived from",
+    "container for": "contained in",
+    "contained in": "container for"
+})
 
 
 @collection(
@@ -34,32 +44,7 @@ class Software(Item):
             properties['title'] = properties['name'].replace(' ', '-').lower()
         super(Software, self)._update(properties, sheets)
 
-        DicRefRelation = {
-            "derived from": "parent of",
-            "parent of": "derived from",
-            "container for": "contained in",
-            "contained in": "container for"
-        }
-        acc = str(self.uuid)
-        if 'software_relation' in properties.keys():
-            for relation in properties["software_relation"]:
-                switch = relation["relationship_type"]
-                rev_switch = DicRefRelation[switch]
-                related_sw = relation["software"]
-                relationship_entry = {"relationship_type": rev_switch, "software": acc}
-                rel_dic = {'software_relation': [relationship_entry, ]}
-
-                target_sw = self.collection.get(related_sw)
-                # case one we don't have relations
-                if 'software_relation' not in target_sw.properties.keys():
-                    target_sw.properties.update(rel_dic)
-                    target_sw.update(target_sw.properties)
-                else:
-                    # case two we have relations but not the one we need
-                    for target_relation in target_sw.properties['software_relation']:
-                        if target_relation['software'] == acc:
-                            break
-                    else:
-                        # make data for new software_relation
-                        target_sw.properties['software_relation'].append(relationship_entry)
-                        target_sw.update(target_sw.properties)
+        # the reverse of each relation is added to its target when this commits - targets
+        # written that way only record their own reverse relations, so nothing cascades
+        if 'software_relation' in properties:
+            SOFTWARE_RELATIONS.add(self, properties['software_relation'])